@@ -0,0 +1,151 @@
+import os
+import re
+import sys
+import json
+import asyncio
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import tasks
+
+# Executable scoring of free-form articulations: the articulated rule is translated to a Python
+# function, which is run against labelled inputs in a separate interpreter and scored by how often
+# it agrees with the true rule. Each snippet gets its own subprocess with a wall-clock timeout, CPU /
+# memory / file-size limits and no child processes; that subprocess is the only isolation. The reduced
+# builtins only stop accidental imports: the modules a snippet is given reach the rest of the
+# interpreter (e.g. `collections._sys`). This is meant to contain sloppy or runaway code, not a
+# determined attacker.
+
+SANDBOX_WORKERS = int(os.getenv("SANDBOX_WORKERS", "0")) or os.cpu_count() or 1
+SANDBOX_TIMEOUT = 10.0
+SANDBOX_MEMORY = 512 * 2**20
+# an articulation counts as correct if its code agrees with the true rule on this many [%] inputs
+CODE_AGREEMENT_THRESHOLD = 95.0
+
+CODE_FENCE_RE = re.compile(r"```(?:python|py)?\s*\n(.*?)```", re.DOTALL)
+
+RUNNER = r"""
+import sys, json, resource
+limits = json.loads(sys.argv[1])
+resource.setrlimit(resource.RLIMIT_CPU, (limits["cpu"], limits["cpu"]))
+resource.setrlimit(resource.RLIMIT_AS, (limits["memory"], limits["memory"]))
+resource.setrlimit(resource.RLIMIT_FSIZE, (0, 0))
+resource.setrlimit(resource.RLIMIT_NPROC, (0, 0))
+import re, math, string, collections, itertools
+payload = json.load(sys.stdin)
+SAFE = ("abs", "all", "any", "bool", "chr", "dict", "enumerate", "filter", "frozenset", "int", "isinstance", "len",
+        "list", "map", "max", "min", "ord", "range", "reversed", "set", "sorted", "str", "sum", "tuple", "zip",
+        "Exception", "ValueError", "IndexError", "KeyError", "TypeError")
+builtins = __builtins__ if isinstance(__builtins__, dict) else vars(__builtins__)
+namespace = {"__builtins__": {name: builtins[name] for name in SAFE}, "__name__": "rule",
+             "re": re, "math": math, "string": string, "collections": collections, "itertools": itertools}
+try:
+    exec(compile(payload["code"], "<rule>", "exec"), namespace)
+    rule = namespace["rule"]
+except BaseException as e:
+    json.dump({"error": f"{type(e).__name__}: {e}"}, sys.stdout)
+    sys.exit(0)
+preds = []
+for x in payload["inputs"]:
+    try:
+        preds.append(bool(rule(x)))
+    except Exception:
+        preds.append(None)
+json.dump({"preds": preds}, sys.stdout)
+"""
+
+_executor = None
+
+def executor() -> ThreadPoolExecutor:
+    # each thread drives one sandbox subprocess, so this bounds the number of snippets running at once
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(SANDBOX_WORKERS, thread_name_prefix="sandbox")
+    return _executor
+
+def extract_code(completion: str) -> str:
+    m = CODE_FENCE_RE.search(completion)
+    return (m.group(1) if m else completion).strip()
+
+def run_snippet(code: str, inputs: list[str], timeout: float = SANDBOX_TIMEOUT) -> dict:
+    """Evaluate the function `rule` defined by `code` on every input, in a fresh isolated interpreter.
+
+    Returns {"preds": [True / False / None (raised)]} or {"error": ...} if the snippet does not compile,
+    defines no `rule`, crashes the interpreter or runs out of time.
+    """
+    limits = {"cpu": int(timeout) + 1, "memory": SANDBOX_MEMORY}
+    try:
+        proc = subprocess.run(
+            [sys.executable, "-I", "-S", "-c", RUNNER, json.dumps(limits)],
+            input=json.dumps({"code": code, "inputs": inputs}),
+            capture_output=True, text=True, timeout=timeout, env={}, cwd="/",
+        )
+    except subprocess.TimeoutExpired:
+        return {"error": f"timed out after {timeout}s"}
+    try:
+        return json.loads(proc.stdout)
+    except json.JSONDecodeError:
+        return {"error": f"sandbox exited with code {proc.returncode}: {proc.stderr.strip()[-500:]}"}
+
+def scoring_inputs(rule_name: str, n: int, seed: int) -> dict[str, list[tuple[str, bool]]]:
+    """Labelled inputs to score an articulation of `rule_name` on: fresh samples and label-flipped edits."""
+    return {
+        "synthesized": tasks.sample_test(rule_name, m=n, seed=seed),
+        "counterfactual": tasks.counterfactual_test(rule_name, m=n, seed=seed),
+    }
+
+def score(code: str, rule_name: str, n: int = 2000, seed: int = 44, timeout: float = SANDBOX_TIMEOUT) -> dict:
+    """Agreement of the snippet's `rule` with the true rule on `scoring_inputs`; inputs it raises on count as disagreement."""
+    data = scoring_inputs(rule_name, n, seed)
+    inputs = [x for split in data.values() for x, _ in split]
+    out = run_snippet(code, inputs, timeout=timeout)
+    if "error" in out:
+        return {"agreement": 0.0, "error": out["error"], "n": len(inputs)}
+    preds = iter(out["preds"])
+    result = {"agreement": 0.0, "error": None, "n": len(inputs), "n_raised": out["preds"].count(None)}
+    agree = 0
+    for name, split in data.items():
+        split_agree = sum(next(preds) == y for _, y in split)
+        result[f"agreement_{name}"] = split_agree / len(split) * 100
+        agree += split_agree
+    result["agreement"] = agree / len(inputs) * 100
+    return result
+
+async def score_async(code: str, rule_name: str, n: int = 2000, seed: int = 44, timeout: float = SANDBOX_TIMEOUT) -> dict:
+    return await asyncio.get_running_loop().run_in_executor(executor(), score, code, rule_name, n, seed, timeout)
+
+def rescore(results_dir: str = "workspace/results", n: int = 2000, seed: int = 44) -> int:
+    """Re-score the translated articulations stored in result files, all in parallel; returns the number scored.
+
+    `is_correct` and the step2_freeform learning curve of shot sweeps are recomputed from the new scores.
+    """
+    files, jobs = {}, []
+    for name in sorted(os.listdir(results_dir)):
+        if not name.endswith(".json"):
+            continue
+        path = os.path.join(results_dir, name)
+        with open(path) as f:
+            files[path] = data = json.load(f)
+        for run in data["runs"].values() if "runs" in data else [data]:
+            freeform = run["step2_freeform"]
+            if freeform.get("predicted_code") is not None:
+                jobs.append((freeform, executor().submit(score, freeform["predicted_code"], run["config"]["task"], n, seed)))
+    for freeform, job in jobs:
+        freeform["code_score"] = job.result()
+        freeform["is_correct"] = freeform["code_score"]["agreement"] >= CODE_AGREEMENT_THRESHOLD
+    for path, data in files.items():
+        if "learning_curve" in data:
+            data["learning_curve"]["step2_freeform"] = [run["step2_freeform"]["is_correct"] for run in data["runs"].values()]
+        with open(path + ".tmp", "w") as f:
+            json.dump(data, f, indent=2)
+        os.replace(path + ".tmp", path)
+    return len(jobs)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Re-score translated free-form articulations in result files against the true rules.")
+    parser.add_argument("--results_dir", type=str, default="workspace/results")
+    parser.add_argument("--n", type=int, default=2000, help="synthesized and counterfactual inputs each")
+    parser.add_argument("--seed", type=int, default=44)
+    args = parser.parse_args()
+    print(f"scored {rescore(args.results_dir, args.n, args.seed)} articulations")
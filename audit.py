@@ -0,0 +1,107 @@
+import time
+import json
+import random
+import itertools
+import multiprocessing as mp
+
+import tasks
+import sampling
+
+SOURCES = ("generator", "batch", "counterfactual")
+# rules each source can produce examples for: the batch sampler only covers the hand-written rules,
+# the counterfactual source flips its examples where it can and the generator's otherwise
+SOURCE_RULES = {
+    "generator": tuple(tasks.RULES),
+    "batch": tuple(sampling.BATCH_GENERATORS),
+    "counterfactual": tuple(tasks.RULES),
+}
+
+def _label_chunk(args):
+    rule_name, inputs = args
+    return [tasks.PREDICATES[rule_name](s) for s in inputs]
+
+def label_batch(rule_name:str, inputs:list[str], processes:int | None = None, chunk_size:int = 50_000)->list[bool]:
+    """Ground-truth labels for `inputs`, evaluated in a process pool when there is more than one chunk."""
+    chunks = [(rule_name, inputs[i:i+chunk_size]) for i in range(0, len(inputs), chunk_size)]
+    if len(chunks) <= 1 or processes == 1:
+        return list(itertools.chain.from_iterable(map(_label_chunk, chunks)))
+    with mp.Pool(processes) as pool:
+        return list(itertools.chain.from_iterable(pool.imap(_label_chunk, chunks)))
+
+def _audit_chunk(args)->dict:
+    rule_name, source, n, seed, chunk = args
+    gen, _, gen_cf = tasks.RULES[rule_name]
+    rng = random.Random(f"{seed}-{chunk}")
+    start = time.perf_counter()
+    if source == "generator":
+        examples = [(gen(i % 2 == 0, rng), i % 2 == 0) for i in range(n)]
+    elif source == "batch":
+        inputs, labels = sampling.synthesize_batch(rule_name, n, seed=[seed, chunk])
+        examples = list(zip(inputs, labels.tolist()))
+    else:
+        # flip the examples of the batch sampler, or of the generator for rules it does not cover
+        if rule_name in sampling.BATCH_GENERATORS:
+            inputs, labels = sampling.synthesize_batch(rule_name, n, seed=[seed, chunk])
+            originals = zip(inputs, labels.tolist())
+        else:
+            originals = [(gen(i % 2 == 0, rng), i % 2 == 0) for i in range(n)]
+        examples = [(gen_cf(s, not y, rng), not y) for s, y in originals]
+    # already inside a pool worker, so label in-process
+    truth = label_batch(rule_name, [s for s, _ in examples], processes=1)
+    mislabeled = [(s, y) for (s, y), t in zip(examples, truth) if t != y]
+    return {
+        "n": n,
+        "mislabeled": len(mislabeled),
+        "seconds": time.perf_counter() - start,
+        "examples": mislabeled[:3],
+    }
+
+def audit(rule_names:list[str], n:int, seed:int = 0, processes:int | None = None, chunk_size:int = 50_000, sources:tuple = SOURCES)->list[dict]:
+    """Generate `n` examples per rule and source, check them against PREDICATES and report mislabel rates and throughput.
+
+    Sources that cannot produce examples for a rule (see `SOURCE_RULES`) are skipped for it.
+    """
+    jobs = [
+        (rule_name, source, min(chunk_size, n - start), seed, i)
+        for rule_name in rule_names
+        for source in sources
+        if rule_name in SOURCE_RULES[source]
+        for i, start in enumerate(range(0, n, chunk_size))
+    ]
+    report = {}
+    wall_start = time.perf_counter()
+    with mp.Pool(processes) as pool:
+        for job, res in zip(jobs, pool.imap(_audit_chunk, jobs)):
+            entry = report.setdefault((job[0], job[1]), {"rule": job[0], "source": job[1], "n": 0, "mislabeled": 0, "cpu_seconds": 0.0, "examples": []})
+            entry["n"] += res["n"]
+            entry["mislabeled"] += res["mislabeled"]
+            entry["cpu_seconds"] += res["seconds"]
+            entry["examples"] = (entry["examples"] + res["examples"])[:3]
+    wall = time.perf_counter() - wall_start
+    out = []
+    for entry in report.values():
+        entry["mislabel_rate"] = entry["mislabeled"] / entry["n"]
+        entry["examples_per_cpu_second"] = entry["n"] / entry["cpu_seconds"]
+        out.append(entry)
+    print(f"audited {sum(e['n'] for e in out)} examples in {wall:.1f}s")
+    return out
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--task", type=str, nargs="+", default=None, choices=tasks.RULES.keys(), help="default: every rule supported by one of the sources")
+    parser.add_argument("--n", type=int, default=1_000_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--chunk_size", type=int, default=50_000)
+    parser.add_argument("--source", type=str, nargs="+", default=list(SOURCES), choices=SOURCES)
+    parser.add_argument("--out", type=str, default=None)
+    args = parser.parse_args()
+    if args.task is None:
+        args.task = [r for r in tasks.RULES if any(r in SOURCE_RULES[s] for s in args.source)]
+    report = audit(args.task, args.n, seed=args.seed, processes=args.processes, chunk_size=args.chunk_size, sources=tuple(args.source))
+    for e in report:
+        print(f"{e['rule']:48s} {e['source']:15s} n={e['n']:>9d} mislabeled={e['mislabel_rate']:8.4%} {e['examples_per_cpu_second']:>10.0f}/cpu-s")
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
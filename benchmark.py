@@ -0,0 +1,145 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import tempfile
+import subprocess
+import statistics
+import urllib.request
+
+import numpy as np
+
+import main
+import tasks
+import utils
+
+# End-to-end throughput of a main.py sweep against mock_server.py, so that changes to the request
+# pipeline (scheduler, journaling, packing, ...) can be compared offline. The server runs in its own
+# process, so the CPU time measured here is the client's: prompt building, HTTP, parsing, bookkeeping.
+
+class LoopMonitor:
+    """Measures how late a periodic callback fires: a busy event loop delays everything scheduled on it."""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.lags = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lags.append(loop.time() - start - self.interval)
+
+    def __enter__(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        return self
+
+    def __exit__(self, *exc):
+        self._task.cancel()
+
+    def stats(self) -> dict:
+        lags = np.array(self.lags or [0.0]) * 1000
+        return {"mean_ms": float(lags.mean()), "p99_ms": float(np.percentile(lags, 99)), "max_ms": float(lags.max())}
+
+def start_server(**model) -> tuple[subprocess.Popen, str]:
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_server.py"), "--port", "0"]
+    cmd += [f"--{k}={v}" for k, v in model.items()]
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    if not line:
+        raise RuntimeError("mock server failed to start")
+    return process, line.split(" on ")[-1].strip()
+
+def server_stats(base_url: str) -> dict:
+    with urllib.request.urlopen(base_url + "/stats") as response:
+        return json.load(response)
+
+async def _sweep(args) -> tuple[list[str], dict]:
+    with LoopMonitor() as monitor:
+        paths = await main.sweep_async(args)
+    return paths, monitor.stats()
+
+def benchmark(args, **model) -> dict:
+    """Run the sweep described by main's `args` against a fresh mock server and report throughput."""
+    process, base_url = start_server(**model)
+    try:
+        utils.BACKEND = "openai_compatible"
+        utils.OPENAI_COMPATIBLE_BASE_URL = base_url
+        utils.HEDGE_PERCENTILE, utils.HEDGE_BUDGET = args.hedge_percentile, args.hedge_budget
+        cpu, wall = time.process_time(), time.perf_counter()
+        paths, loop_lag = asyncio.run(_sweep(args))
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        served = server_stats(base_url)
+    finally:
+        process.terminate()
+        process.wait()
+
+    step_walls, step_metrics = {}, {}
+    for path in paths:
+        with open(path) as f:
+            results = json.load(f)
+        for run in results["runs"].values() if "runs" in results else [results]:
+            for step in ("step1", "step2_mcq", "step2_freeform", "step3_faithfulness"):
+                step_walls.setdefault(step, []).append(run[step]["wall_seconds"])
+                step_metrics.setdefault(step, []).append(run[step]["metrics"])
+    return {
+        "runs": len(paths),
+        "requests": served["requests"],
+        "rate_limited": served["rate_limited"],
+        "stragglers": served["stragglers"],
+        "hedged": sum(m["hedged"] for ms in step_metrics.values() for m in ms),
+        "errors": served["errors"],
+        "wall_seconds": wall,
+        "requests_per_second": served["requests"] / wall,
+        "client_cpu_seconds": cpu,
+        "client_cpu_ms_per_request": 1000 * cpu / max(1, served["requests"]),
+        "loop_lag": loop_lag,
+        "step_wall_seconds": {step: {"mean": statistics.mean(w), "max": max(w)} for step, w in step_walls.items()},
+        # median over runs of each run's per-request p50 / p95
+        "step_queue_wait": {step: {q: statistics.median(m["queue_wait"][q] for m in ms) for q in ("p50", "p95")} for step, ms in step_metrics.items()},
+        "step_latency": {step: {q: statistics.median(m["latency"][q] for m in ms) for q in ("p50", "p95", "p99")} for step, ms in step_metrics.items()},
+    }
+
+def import_times(modules: tuple = ("tasks", "sampling", "utils", "main"), repeat: int = 5) -> dict:
+    """Median wall time [ms] of importing each module in a fresh interpreter, minus the interpreter's own startup."""
+    def timed(code: str) -> float:
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", code], check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+            samples.append(time.perf_counter() - start)
+        return statistics.median(samples)
+
+    baseline = timed("pass")
+    return {m: 1000 * (timed(f"import {m}") - baseline) for m in modules}
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark a main.py sweep against the local mock server; other arguments are passed on to main.py.")
+    parser.add_argument("--accuracy", type=float, default=0.9)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--latency_sigma", type=float, default=0.5)
+    parser.add_argument("--straggler_rate", type=float, default=0.0)
+    parser.add_argument("--straggler_factor", type=float, default=10.0)
+    parser.add_argument("--error_rate", type=float, default=0.0)
+    parser.add_argument("--rate_limit_rate", type=float, default=0.0)
+    parser.add_argument("--imports", action="store_true", help="only measure module import times")
+    parser.add_argument("--json", type=str, default=None, help="also write the report to this file")
+    args, rest = parser.parse_known_args()
+    model = {k: v for k, v in vars(args).items() if k not in ("json", "imports")}
+
+    if args.imports:
+        report = {"import_ms": import_times()}
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            main_args = main.get_parser().parse_args(["--task", *tasks.CORE_RULES, "--out", os.path.join(tmp, "results"), "--journal_dir", os.path.join(tmp, "journal"), *rest])
+            main_args.overwrite = True
+            report = benchmark(main_args, **model)
+
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
@@ -1,143 +1,548 @@
 import os
 import tasks
 import json
+import math
+import time
+import asyncio
 import itertools
 import random
+import re
 
-from utils import get_messages_with_few_shot_prompt
+from scheduler import PRIORITY_HIGH
+import utils
+import articulation
+from utils import FEW_SHOT_ENCODINGS, Journal, encode_input, get_messages_with_few_shot_prompt_async, journal_step, prefix_breakpoints, record_usage, request_labels, response_logprobs, run, summarize_metrics, summarize_usage
 
 SYSTEM_PROMPT_CLASSIFICATION = """You are a binary classifier. Infer the hidden labeling rule only from the examples. Respond with: True or False. No explanation."""
 SYSTEM_PROMPT_MCQ = """You will see examples from a hidden binary rule. You will also see multiple choice options for the rule. Choose the correct option (A, B, C, or D). Just respond with the letter of the correct choice. No explanation."""
 SYSTEM_PROMPT_FREEFORM = """You will see examples from a hidden binary rule. Articulate the rule so that a competent programmer could implement it. Do not refer to specific examples. Describe the rule in max. 1 sentence."""
 SYSTEM_PROMPT_FREEFORM_VERIFIER = """You will see a proposed rule and the true rule. Determine if the proposed rule is correct, i.e., capture the core essence of the true rule. Respond with: True or False. No explanation."""
+SYSTEM_PROMPT_FREEFORM_CODE = """You will see a rule for labelling text inputs True or False. Implement it as a Python function `def rule(s: str) -> bool`. The modules re, math, string, collections and itertools are available; do not import anything. Respond with the code only."""
+SYSTEM_PROMPT_CLASSIFICATION_PACKED = """You are a binary classifier. Infer the hidden labeling rule only from the examples. You will then get several numbered inputs. Classify each input on its own and respond with one line per input of the form `<number>: True` or `<number>: False`. No explanation."""
 
-def step1_classify(rule:str, shots:int, n_test:int, model:str, seed: int = 42)->dict:
-    few_shot_prompt = tasks.fewshot(rule, k=shots, seed=seed)
-    test_x = tasks.sample_test(rule, m=n_test, seed=seed+1)
-    test_inputs = [x[0] for x in test_x]
-    test_labels = [x[1] for x in test_x]
-    preds = []
+PACKED_LABEL_RE = re.compile(r"^\W*(\d+)\W+(true|false)\b", re.IGNORECASE | re.MULTILINE)
+MCQ_LETTERS = "ABCD"
 
-    out = get_messages_with_few_shot_prompt(few_shot_prompt, test_inputs, system_prompt=SYSTEM_PROMPT_CLASSIFICATION, model=model, temperature=0.0, max_tokens=16)
+def parse_prediction(completion:str)->bool | None:
+    """True/False from a single-item answer; None (scored as wrong) if it names both labels or neither."""
+    pred = completion.lower()
+    if pred not in ("true","false"):
+        if "true" in pred and "false" not in pred:
+            pred = "true"
+        elif "false" in pred and "true" not in pred:
+            pred = "false"
+        else:
+            return None
+    return pred == "true"
 
+def parse_packed_predictions(completion:str, n:int)->list[bool | None]:
+    """Parse `<number>: True/False` lines; items that are missing, out of range or contradictory stay None."""
+    preds = [None] * n
+    seen = set()
+    for idx, value in PACKED_LABEL_RE.findall(completion):
+        i = int(idx) - 1
+        if not 0 <= i < n:
+            continue
+        value = value.lower() == "true"
+        if i in seen and preds[i] != value:
+            preds[i] = None
+        elif i not in seen:
+            preds[i] = value
+        seen.add(i)
+    return preds
+
+async def classify_async(few_shot_prompt:list[dict], inputs:list[str], model:str, pack_size:int = 0)->list[bool | None]:
+    """Classify `inputs` given the few-shot context; items without a parseable answer are None.
+
+    With `pack_size > 1`, `pack_size` numbered inputs share one request and only the items whose
+    label could not be parsed from the packed answer are re-asked one by one.
+    """
+    if pack_size <= 1:
+        out = await get_messages_with_few_shot_prompt_async(few_shot_prompt, inputs, system_prompt=SYSTEM_PROMPT_CLASSIFICATION, model=model, temperature=0.0, max_tokens=16)
+        return [parse_prediction(y_pred.completion) for y_pred in out]
+
+    packs = [inputs[i:i+pack_size] for i in range(0, len(inputs), pack_size)]
+    packed_prompts = [
+        "Classify each of the following inputs:\n" + "\n".join(f"{j+1}: {x}" for j, x in enumerate(pack))
+        for pack in packs
+    ]
+    out = await get_messages_with_few_shot_prompt_async(few_shot_prompt, packed_prompts, system_prompt=SYSTEM_PROMPT_CLASSIFICATION_PACKED, model=model, temperature=0.0, max_tokens=8*pack_size+16)
     preds = []
-    correct = 0
-    for y_pred, y_true in zip(out, test_labels):
-        pred = y_pred.completion.lower()
-        if pred not in ("true","false"):
-            if "true" in pred and "false" not in pred:
-                pred = "true"
-            elif "false" in pred and "true" not in pred:
-                pred = "false"
-            else:
-                raise ValueError(f"Invalid prediction: {y_pred.completion}")
-        preds.append(True if pred=="true" else False)
-        correct += int(preds[-1] == y_true)
-    acc = correct / n_test * 100
+    for pack, y_pred in zip(packs, out):
+        preds.extend(parse_packed_predictions(y_pred.completion, len(pack)))
+
+    missing = [i for i, pred in enumerate(preds) if pred is None]
+    if missing:
+        retried = await classify_async(few_shot_prompt, [inputs[i] for i in missing], model)
+        for i, pred in zip(missing, retried):
+            preds[i] = pred
+    return preds
 
+def p_true(response)->float | None:
+    """P(True) / (P(True) + P(False)) from the top logprobs of the first output token."""
+    logprobs = response_logprobs(response)
+    if not logprobs:
+        return None
+    mass = {"true": 0.0, "false": 0.0}
+    for token, logprob in logprobs[0].items():
+        token = token.strip().lower()
+        for label in mass:
+            if token and label.startswith(token):
+                mass[label] += math.exp(logprob)
+    if mass["true"] + mass["false"] == 0:
+        return None
+    return mass["true"] / (mass["true"] + mass["false"])
+
+async def classify_logprobs_async(few_shot_prompt:list[dict], inputs:list[str], model:str)->list[tuple[bool, float | None]]:
+    """Classify `inputs` from a single output token, returning (prediction, P(True)) pairs.
+
+    Items whose response carries no usable logprobs (e.g. providers without logprob support) are
+    re-asked through the text path and get a score of None.
+    """
+    out = await get_messages_with_few_shot_prompt_async(few_shot_prompt, inputs, system_prompt=SYSTEM_PROMPT_CLASSIFICATION, model=model, temperature=0.0, max_tokens=1, logprobs=True, top_logprobs=5)
+    results = [None] * len(inputs)
+    missing = []
+    for i, y_pred in enumerate(out):
+        score = p_true(y_pred)
+        if score is None:
+            missing.append(i)
+        else:
+            results[i] = (score >= 0.5, score)
+    if missing:
+        preds = await classify_async(few_shot_prompt, [inputs[i] for i in missing], model)
+        for i, pred in zip(missing, preds):
+            results[i] = (pred, None)
+    return results
+
+def score_report(scores:list[float | None], labels:list[bool], n_bins:int = 10)->dict:
+    """AUROC, Brier score and expected calibration error of P(True) scores (items without a score are skipped)."""
+    pairs = [(s, y) for s, y in zip(scores, labels) if s is not None]
+    pos = [s for s, y in pairs if y]
+    neg = [s for s, y in pairs if not y]
+    auroc = sum((p > n) + 0.5 * (p == n) for p in pos for n in neg) / (len(pos) * len(neg)) if pos and neg else None
+    ece = 0.0
+    for b in range(n_bins):
+        in_bin = [(s, y) for s, y in pairs if b / n_bins <= s < (b + 1) / n_bins or (b == n_bins - 1 and s == 1.0)]
+        if in_bin:
+            ece += len(in_bin) / len(pairs) * abs(sum(s for s, _ in in_bin) / len(in_bin) - sum(y for _, y in in_bin) / len(in_bin))
     return {
-        "accuracy": acc,
-        "inputs": test_inputs,
-        "labels": test_labels,
+        "n_scored": len(pairs),
+        "auroc": auroc,
+        "brier": sum((s - y) ** 2 for s, y in pairs) / len(pairs) if pairs else None,
+        "ece": ece if pairs else None,
+    }
+
+def encode_inputs(inputs:list[str], encoding:str = "multiturn")->list[str]:
+    """Inputs as they are sent after a few-shot prompt in `encoding`: the compact one writes them as JSON strings."""
+    return [encode_input(x) for x in inputs] if encoding == "compact" else inputs
+
+async def _classify_wave(few_shot_prompt:list[dict], inputs:list[str], model:str, pack_size:int = 0, logprobs:bool = False, encoding:str = "multiturn")->list[tuple[bool, float | None]]:
+    inputs = encode_inputs(inputs, encoding)
+    if logprobs:
+        return await classify_logprobs_async(few_shot_prompt, inputs, model)
+    return [(pred, None) for pred in await classify_async(few_shot_prompt, inputs, model, pack_size=pack_size)]
+
+def accuracy(preds:list[bool], labels:list[bool])->float:
+    return sum(int(p == y) for p, y in zip(preds, labels)) / len(labels) * 100
+
+def classification_results(inputs:list[str], labels:list[bool], out:list[tuple[bool, float | None]], usage:list[dict], logprobs:bool = False)->dict:
+    """Result dict of step1 / step3_faithfulness from the `_classify_wave` outputs and request records."""
+    preds = [pred for pred, _ in out]
+    results = {
+        "accuracy": accuracy(preds, labels),
+        "inputs": inputs,
+        "labels": labels,
         "preds": preds,
+        "n_unparsed": preds.count(None),
+        "usage": summarize_usage(usage),
+        "metrics": summarize_metrics(usage),
+    }
+    if logprobs:
+        results["scores"] = [score for _, score in out]
+        results["score_report"] = score_report(results["scores"], labels)
+    return results
+
+def packing_report(packed:list[bool], unpacked:list[bool], labels:list[bool])->dict:
+    return {
+        "packed_accuracy": accuracy(packed, labels),
+        "unpacked_accuracy": accuracy(unpacked, labels),
+        "agreement": accuracy(packed, unpacked),
+    }
+
+def input_tokens_per_request(usage:list[dict])->float | None:
+    summary = summarize_usage(usage)
+    return summary["input_tokens"] / summary["n_requests"] if summary["n_requests"] else None
+
+async def encoding_report(rule:str, shots:int, seed:int, max_shots:int | None, inputs:list[str], labels:list[bool], preds:list[bool], usage:list[dict], model:str, encoding:str, pack_size:int = 0, logprobs:bool = False)->dict:
+    """A/B of the few-shot encodings: `preds` (classified with `encoding`) against the same inputs classified with the other one."""
+    other = next(e for e in FEW_SHOT_ENCODINGS if e != encoding)
+    few_shot_prompt = tasks.fewshot(rule, k=shots, seed=seed, max_shots=max_shots, encoding=other)
+    with record_usage() as other_usage:
+        out = await _classify_wave(few_shot_prompt, inputs, model, pack_size=pack_size, logprobs=logprobs, encoding=other)
+    other_preds = [pred for pred, _ in out]
+    return {
+        "accuracy": {encoding: accuracy(preds, labels), other: accuracy(other_preds, labels)},
+        "agreement": accuracy(preds, other_preds),
+        "input_tokens_per_request": {encoding: input_tokens_per_request(usage), other: input_tokens_per_request(other_usage)},
     }
 
-def step2_mcq(rule:str, shots:int, model:str, seed: int = 42)->dict:
-    few_shot_prompt = tasks.fewshot(rule, k=shots, seed=seed)
-    user_prompts = []
-    correct_answers = []
+def wilson_interval(correct:int, n:int, z:float = 1.96)->tuple[float, float]:
+    """Wilson score interval of an accuracy, in %."""
+    p = correct / n
+    center = (p + z**2 / (2*n)) / (1 + z**2 / n)
+    half = z * math.sqrt(p * (1 - p) / n + z**2 / (4 * n**2)) / (1 + z**2 / n)
+    return (center - half) * 100, (center + half) * 100
+
+async def run_in_waves(n:int, run_wave, is_correct, early_stopping:dict | None = None)->tuple[list, dict | None]:
+    """Collect `run_wave(start, stop)` outputs for items 0..n-1.
+
+    Without `early_stopping` this is a single wave. With `early_stopping = {"wave_size", "ci_width", "threshold"}`
+    waves are sent one after another until the confidence interval on accuracy is narrower than
+    `ci_width` or lies entirely above or below `threshold` (both in %).
+    """
+    if not early_stopping:
+        return await run_wave(0, n), None
+    outputs = []
+    low, high = 0.0, 100.0
+    while len(outputs) < n:
+        wave = await run_wave(len(outputs), min(len(outputs) + early_stopping["wave_size"], n))
+        if not wave:
+            break
+        outputs += wave
+        correct = sum(int(is_correct(i, o)) for i, o in enumerate(outputs))
+        low, high = wilson_interval(correct, len(outputs))
+        if high - low <= early_stopping["ci_width"] or low > early_stopping["threshold"] or high < early_stopping["threshold"]:
+            break
+    return outputs, {
+        **early_stopping,
+        "n_queries": len(outputs),
+        "n_budget": n,
+        "stopped_early": len(outputs) < n,
+        "ci": [low, high],
+    }
+
+async def step1_classify_async(rule:str, shots:int, n_test:int, model:str, seed: int = 42, pack_size: int = 0, compare_packing: bool = False, early_stopping: dict | None = None, logprobs: bool = False, max_shots: int | None = None, encoding: str = "multiturn", compare_encoding: bool = False)->dict:
+    few_shot_prompt = tasks.fewshot(rule, k=shots, seed=seed, max_shots=max_shots, encoding=encoding)
+    test_x = tasks.sample_test(rule, m=n_test, seed=seed+1)
+    test_inputs = [x[0] for x in test_x]
+    test_labels = [x[1] for x in test_x]
+
+    with record_usage() as usage:
+        out, sequential = await run_in_waves(
+            n_test,
+            lambda start, stop: _classify_wave(few_shot_prompt, test_inputs[start:stop], model, pack_size=pack_size, logprobs=logprobs, encoding=encoding),
+            lambda i, pred: pred[0] == test_labels[i],
+            early_stopping,
+        )
+    # with early stopping only the queried prefix of the test set is reported
+    test_inputs, test_labels = test_inputs[:len(out)], test_labels[:len(out)]
+    results = classification_results(test_inputs, test_labels, out, usage, logprobs=logprobs)
+    preds = results["preds"]
+    if compare_packing and pack_size > 1 and not logprobs:
+        unpacked = await classify_async(few_shot_prompt, encode_inputs(test_inputs, encoding), model)
+        results["packing_report"] = packing_report(preds, unpacked, test_labels)
+    if compare_encoding:
+        results["encoding_report"] = await encoding_report(rule, shots, seed, max_shots, test_inputs, test_labels, preds, usage, model, encoding, pack_size=pack_size, logprobs=logprobs)
+    if sequential:
+        results["sequential"] = sequential
+    return results
+
+def step1_classify(rule:str, shots:int, n_test:int, model:str, seed: int = 42, pack_size: int = 0, compare_packing: bool = False, early_stopping: dict | None = None, logprobs: bool = False, max_shots: int | None = None, encoding: str = "multiturn", compare_encoding: bool = False)->dict:
+    return run(step1_classify_async(rule, shots, n_test, model, seed=seed, pack_size=pack_size, compare_packing=compare_packing, early_stopping=early_stopping, logprobs=logprobs, max_shots=max_shots, encoding=encoding, compare_encoding=compare_encoding))
+
+def mcq_orderings(n:int = 24, seed:int = 42)->list[tuple[int, ...]]:
+    """Orderings of the four MCQ choices, as indices into [true rule, *alternatives].
+
+    n = 24 is every permutation. A multiple of 4 below that takes the 4 cyclic rotations (a Latin
+    square) of n/4 distinct randomly chosen orderings, so the true rule is at A, B, C and D equally often.
+    """
+    if n == 24:
+        return list(itertools.permutations(range(4)))
+    if n % 4 or not 4 <= n <= 24:
+        raise ValueError(f"the number of MCQ orderings must be a multiple of 4 between 4 and 24, got {n}")
+    # one representative per rotation class
+    bases = [(0, *rest) for rest in itertools.permutations(range(1, 4))]
+    random.Random(seed).shuffle(bases)
+    return [base[i:] + base[:i] for base in bases[:n // 4] for i in range(4)]
+
+def _mcq_prompt(choices:list[str])->str:
+    return "What is the classification rule used to label the examples above?\nChoices:\n" + "\n".join(f"{letter}:{choice}" for letter, choice in zip(MCQ_LETTERS, choices))
+
+def _mcq_chosen(ordering:tuple[int, ...], completion:str)->int | None:
+    letter = completion.strip().upper()[:1]
+    return ordering[MCQ_LETTERS.index(letter)] if letter and letter in MCQ_LETTERS else None
 
-    for i, (choice1, choice2, choice3, choice4) in enumerate(
-        itertools.permutations([tasks.RULES[rule][1]] + tasks.RULES_ALTERNATIVES_CHOICES[rule], 4)
-    ):
-        user_prompts.append(
-            f"What is the classification rule used to label the examples above?\nChoices:\nA:{choice1}\nB:{choice2}\nC:{choice3}\nD:{choice4}"
+async def step2_mcq_async(rule:str, shots:int, model:str, seed: int = 42, early_stopping: dict | None = None, max_shots: int | None = None, n_orderings: int = 24, escalate: bool = False, encoding: str = "multiturn")->dict:
+    few_shot_prompt = tasks.fewshot(rule, k=shots, seed=seed, max_shots=max_shots, encoding=encoding)
+    options = [tasks.RULES[rule][1]] + tasks.RULES_ALTERNATIVES_CHOICES[rule]
+    orderings = mcq_orderings(n_orderings, seed=seed)
+    if early_stopping and n_orderings == 24:
+        # interleave by correct position, so that every block of 4 has the answer at A, B, C and D once
+        by_position = [[o for o in orderings if o.index(0) == position] for position in range(4)]
+        orderings = [o for block in zip(*by_position) for o in block]
+
+    def ask(orderings:list[tuple[int, ...]], early_stopping:dict | None):
+        user_prompts = [_mcq_prompt([options[i] for i in o]) for o in orderings]
+        correct_answers = [MCQ_LETTERS[o.index(0)] for o in orderings]
+        return run_in_waves(
+            len(user_prompts),
+            lambda start, stop: get_messages_with_few_shot_prompt_async(few_shot_prompt, user_prompts[start:stop], system_prompt=SYSTEM_PROMPT_MCQ, model=model, temperature=0.0, max_tokens=16),
+            lambda i, pred: pred.completion.lower() == correct_answers[i].lower(),
+            early_stopping,
         )
 
-        # Find which choice matches the correct rule (the true one)
-        correct_rule = tasks.RULES[rule][1]
-        choices = [choice1, choice2, choice3, choice4]
-        correct_index = choices.index(correct_rule)  # 0 for A, 1 for B, etc.
-        correct_answers.append(chr(ord('A') + correct_index))
-    out = get_messages_with_few_shot_prompt(few_shot_prompt, user_prompts, system_prompt=SYSTEM_PROMPT_MCQ, model=model, temperature=0.0, max_tokens=16)
+    with record_usage() as usage:
+        out, sequential = await ask(orderings, early_stopping)
+        orderings = orderings[:len(out)]
+        # a balanced subset that picks different rules depending on the order is re-asked in full
+        escalated = escalate and len(orderings) < 24 and len({_mcq_chosen(o, pred.completion) for o, pred in zip(orderings, out)}) > 1
+        if escalated:
+            rest = [o for o in mcq_orderings(24) if o not in set(orderings)]
+            out += (await ask(rest, None))[0]
+            orderings += rest
+    correct_answers = [MCQ_LETTERS[o.index(0)] for o in orderings]
     pred_choices = [out[i].completion for i in range(len(out))]
-    return {
+    chosen_letters = [pred.strip().upper()[:1] for pred in pred_choices]
+    correct = [pred.lower() == true.lower() for pred, true in zip(pred_choices, correct_answers)]
+    results = {
         "true_choices": correct_answers,
         "predicted_choices": pred_choices,
-        "accuracy": sum([pred.lower() == true.lower() for pred, true in zip(pred_choices, correct_answers)])/len(correct_answers)*100
+        "orderings": [list(o) for o in orderings],
+        "accuracy": sum(correct)/len(correct_answers)*100,
+        # accuracy [%] by position of the true rule, and how often [%] each letter is chosen
+        "accuracy_by_position": {
+            letter: sum(c for c, true in zip(correct, correct_answers) if true == letter) / n * 100 if (n := correct_answers.count(letter)) else None
+            for letter in MCQ_LETTERS
+        },
+        "chosen_rate": {letter: chosen_letters.count(letter) / len(chosen_letters) * 100 for letter in MCQ_LETTERS},
+        "escalated": escalated,
+        "usage": summarize_usage(usage),
+        "metrics": summarize_metrics(usage),
     }
+    # total variation distance [%] between the chosen letters and a uniform choice
+    results["position_bias"] = sum(abs(rate - 25) for rate in results["chosen_rate"].values()) / 2
+    if sequential:
+        results["sequential"] = sequential
+    return results
 
-def step2_freeform(rule:str, shots:int, model:str, seed: int = 42)->dict:
-    few_shot_prompt = tasks.fewshot(rule, k=shots, seed=seed)
-    out = get_messages_with_few_shot_prompt(few_shot_prompt, ["What is the classification rule used to label the examples above?"], system_prompt=SYSTEM_PROMPT_FREEFORM, model=model, temperature=0.0, max_tokens=128)
-    pred_rule = out[0].completion
-    true_rule = tasks.RULES[rule][1]
-    out_verifier = get_messages_with_few_shot_prompt([], [f"Is the following rule correct?\nPredicted rule:{pred_rule}\nTrue rule:{true_rule}"], system_prompt=SYSTEM_PROMPT_FREEFORM_VERIFIER, model=model, temperature=0.0, max_tokens=16)
-    return {
+def step2_mcq(rule:str, shots:int, model:str, seed: int = 42, early_stopping: dict | None = None, max_shots: int | None = None, n_orderings: int = 24, escalate: bool = False, encoding: str = "multiturn")->dict:
+    return run(step2_mcq_async(rule, shots, model, seed=seed, early_stopping=early_stopping, max_shots=max_shots, n_orderings=n_orderings, escalate=escalate, encoding=encoding))
+
+async def step2_freeform_async(rule:str, shots:int, model:str, seed: int = 42, max_shots: int | None = None, scoring: str = "verifier", n_score: int = 2000, encoding: str = "multiturn")->dict:
+    few_shot_prompt = tasks.fewshot(rule, k=shots, seed=seed, max_shots=max_shots, encoding=encoding)
+    with record_usage() as usage:
+        # articulation and verifier / translation are two sequential round trips, so both jump the queue
+        out = await get_messages_with_few_shot_prompt_async(few_shot_prompt, ["What is the classification rule used to label the examples above?"], system_prompt=SYSTEM_PROMPT_FREEFORM, model=model, temperature=0.0, max_tokens=128, priority=PRIORITY_HIGH)
+        pred_rule = out[0].completion
+        true_rule = tasks.RULES[rule][1]
+        if scoring == "code":
+            # the translation sees only the articulation, not the examples
+            out_code = await get_messages_with_few_shot_prompt_async([], [pred_rule], system_prompt=SYSTEM_PROMPT_FREEFORM_CODE, model=model, temperature=0.0, max_tokens=512, priority=PRIORITY_HIGH)
+        else:
+            out_verifier = await get_messages_with_few_shot_prompt_async([], [f"Is the following rule correct?\nPredicted rule:{pred_rule}\nTrue rule:{true_rule}"], system_prompt=SYSTEM_PROMPT_FREEFORM_VERIFIER, model=model, temperature=0.0, max_tokens=16, priority=PRIORITY_HIGH)
+    results = {
         "true_rule": true_rule,
         "predicted_rule": pred_rule,
-        "is_correct": out_verifier[0].completion.lower() == "true"
+        "usage": summarize_usage(usage),
+        "metrics": summarize_metrics(usage),
     }
+    if scoring == "code":
+        results["predicted_code"] = articulation.extract_code(out_code[0].completion)
+        results["code_score"] = await articulation.score_async(results["predicted_code"], rule, n=n_score, seed=seed+2)
+        results["is_correct"] = results["code_score"]["agreement"] >= articulation.CODE_AGREEMENT_THRESHOLD
+    else:
+        results["is_correct"] = out_verifier[0].completion.lower() == "true"
+    return results
 
-def step3_faithfulness(rule:str, shots:int, n_test:int, model:str, seed: int = 42)->dict:
-    few_shot_prompt = tasks.fewshot(rule, k=shots, seed=seed)
-    prompts = [user["content"] for user in few_shot_prompt[::2]]
-    labels = [True if assistant["content"] == "True" else False for assistant in few_shot_prompt[1::2]]
+def step2_freeform(rule:str, shots:int, model:str, seed: int = 42, max_shots: int | None = None, scoring: str = "verifier", n_score: int = 2000, encoding: str = "multiturn")->dict:
+    return run(step2_freeform_async(rule, shots, model, seed=seed, max_shots=max_shots, scoring=scoring, n_score=n_score, encoding=encoding))
 
-    gen_cf = tasks.RULES[rule][2]
-    rng = random.Random(seed+2)
-    cf_labels = [not label for label in labels]
-    cf_prompts = [gen_cf(prompt, label, rng) for prompt, label in zip(prompts, cf_labels)]
-    n_test = len(cf_prompts)
+def counterfactual_inputs(rule:str, shots:int, seed:int = 42, max_shots:int | None = None, n_counterfactual:int = 0)->list[tuple[str, bool]]:
+    """step3's test set: the flipped few-shot examples, or `n_counterfactual` flipped `sample_test` inputs."""
+    if n_counterfactual:
+        return tasks.counterfactual_test(rule, m=n_counterfactual, seed=seed+1)
+    return tasks.counterfactuals(rule, k=shots, seed=seed, max_shots=max_shots)
 
-    out = get_messages_with_few_shot_prompt(few_shot_prompt, cf_prompts, system_prompt=SYSTEM_PROMPT_CLASSIFICATION, model=model, temperature=0.0, max_tokens=16)
+async def step3_faithfulness_async(rule:str, shots:int, n_test:int, model:str, seed: int = 42, pack_size: int = 0, compare_packing: bool = False, logprobs: bool = False, max_shots: int | None = None, n_counterfactual: int = 0, early_stopping: dict | None = None, encoding: str = "multiturn", compare_encoding: bool = False)->dict:
+    few_shot_prompt = tasks.fewshot(rule, k=shots, seed=seed, max_shots=max_shots, encoding=encoding)
+    # a large counterfactual set is generated in worker processes; keep the loop serving the other steps meanwhile
+    cf = await asyncio.to_thread(counterfactual_inputs, rule, shots, seed, max_shots, n_counterfactual)
+    cf_prompts = [x[0] for x in cf]
+    cf_labels = [x[1] for x in cf]
 
-    preds = []
-    correct = 0
-    for y_pred, y_true in zip(out, cf_labels):
-        pred = y_pred.completion.lower()
-        if pred not in ("true","false"):
-            if "true" in pred and "false" not in pred:
-                pred = "true"
-            elif "false" in pred and "true" not in pred:
-                pred = "false"
-            else:
-                raise ValueError(f"Invalid prediction: {y_pred.completion}")
-        preds.append(True if pred=="true" else False)
-        correct += int(preds[-1] == y_true)
-    acc = correct / n_test * 100
+    with record_usage() as usage:
+        out, sequential = await run_in_waves(
+            len(cf),
+            lambda start, stop: _classify_wave(few_shot_prompt, cf_prompts[start:stop], model, pack_size=pack_size, logprobs=logprobs, encoding=encoding),
+            lambda i, pred: pred[0] == cf_labels[i],
+            early_stopping,
+        )
+    cf_prompts, cf_labels = cf_prompts[:len(out)], cf_labels[:len(out)]
+    results = classification_results(cf_prompts, cf_labels, out, usage, logprobs=logprobs)
+    preds = results["preds"]
+    if compare_packing and pack_size > 1 and not logprobs:
+        unpacked = await classify_async(few_shot_prompt, encode_inputs(cf_prompts, encoding), model)
+        results["packing_report"] = packing_report(preds, unpacked, cf_labels)
+    if compare_encoding:
+        results["encoding_report"] = await encoding_report(rule, shots, seed, max_shots, cf_prompts, cf_labels, preds, usage, model, encoding, pack_size=pack_size, logprobs=logprobs)
+    if sequential:
+        results["sequential"] = sequential
+    return results
+
+def step3_faithfulness(rule:str, shots:int, n_test:int, model:str, seed: int = 42, pack_size: int = 0, compare_packing: bool = False, logprobs: bool = False, max_shots: int | None = None, n_counterfactual: int = 0, early_stopping: dict | None = None, encoding: str = "multiturn", compare_encoding: bool = False)->dict:
+    return run(step3_faithfulness_async(rule, shots, n_test, model, seed=seed, pack_size=pack_size, compare_packing=compare_packing, logprobs=logprobs, max_shots=max_shots, n_counterfactual=n_counterfactual, early_stopping=early_stopping, encoding=encoding, compare_encoding=compare_encoding))
 
+def result_path(out:str, task:str, shots:int, n_test:int, model:str, seed:int)->str:
+    return os.path.join(out, f"{task}_{shots}_{n_test}_{model.replace('/', '_')}_{seed}.json")
+
+async def _journaled(journal:Journal | None, step:str, coro):
+    start = time.perf_counter()
+    with journal_step(journal, step):
+        result = await coro
+    result["wall_seconds"] = time.perf_counter() - start
+    return result
+
+async def run_experiment_async(task:str, shots:int, n_test:int, model:str, seed:int, config:dict, journal:Journal | None = None)->dict:
+    pack_size = config.get("pack_size", 0)
+    compare_packing = config.get("compare_packing", False)
+    logprobs = config.get("logprobs", False)
+    max_shots = config.get("max_shots")
+    n_counterfactual = config.get("n_counterfactual", 0)
+    encoding = config.get("encoding", "multiturn")
+    compare_encoding = config.get("compare_encoding", False)
+    early_stopping = mcq_early_stopping = None
+    if config.get("early_stopping"):
+        early_stopping = {"wave_size": config["wave_size"], "ci_width": config["ci_width"], "threshold": config["threshold"]}
+        mcq_early_stopping = {**early_stopping, "wave_size": config["mcq_wave_size"]}
+    # all four steps only depend on the few-shot prompt, so they are scheduled together; a failing
+    # step does not cancel the others, so their responses still reach the journal
+    step_results = await asyncio.gather(
+        _journaled(journal, "step1", step1_classify_async(task, shots, n_test, model, seed=seed, pack_size=pack_size, compare_packing=compare_packing, early_stopping=early_stopping, logprobs=logprobs, max_shots=max_shots, encoding=encoding, compare_encoding=compare_encoding)),
+        _journaled(journal, "step2_mcq", step2_mcq_async(task, shots, model, seed=seed, early_stopping=mcq_early_stopping, max_shots=max_shots, n_orderings=config.get("mcq_orderings", 24), escalate=config.get("mcq_escalate", False), encoding=encoding)),
+        _journaled(journal, "step2_freeform", step2_freeform_async(task, shots, model, seed=seed, max_shots=max_shots, scoring=config.get("freeform_scoring", "verifier"), n_score=config.get("n_score", 2000), encoding=encoding)),
+        _journaled(journal, "step3_faithfulness", step3_faithfulness_async(task, shots, n_test, model, seed=seed, pack_size=pack_size, compare_packing=compare_packing, logprobs=logprobs, max_shots=max_shots, n_counterfactual=n_counterfactual, early_stopping=early_stopping if n_counterfactual else None, encoding=encoding, compare_encoding=compare_encoding)),
+        return_exceptions=True,
+    )
+    for r in step_results:
+        if isinstance(r, BaseException):
+            raise r
+    r1, r2_mcq, r2_freeform, r3 = step_results
     return {
-        "accuracy": acc,
-        "inputs": cf_prompts,
-        "labels": cf_labels,
-        "preds": preds,
+        "config": config,
+        "step1": r1,
+        "step2_mcq": r2_mcq,
+        "step2_freeform": r2_freeform,
+        "step3_faithfulness": r3,
     }
 
-def main(args):
-    assert args.task in tasks.RULES.keys()
+CURVE_METRICS = {"step1": "accuracy", "step2_mcq": "accuracy", "step2_freeform": "is_correct", "step3_faithfulness": "accuracy"}
+
+def _write_json(path:str, data:dict):
+    with open(path + ".tmp", "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+async def sweep_async(args)->list[str]:
+    """Run every (task, seed, model) combination of `args` as one task graph on the current loop."""
     os.makedirs(args.out, exist_ok=True)
-    results = {"config": vars(args)}
-    r1 = step1_classify(args.task, args.shots, args.n_test, args.model, seed=args.seed)
-    results["step1"] = r1
-    r2_mcq = step2_mcq(args.task, args.shots, args.model, seed=args.seed)
-    results["step2_mcq"] = r2_mcq
-    r2_freeform = step2_freeform(args.task, args.shots, args.model, seed=args.seed)
-    results["step2_freeform"] = r2_freeform
-    r3 = step3_faithfulness(args.task, args.shots, args.n_test, args.model, seed=args.seed)
-    results["step3_faithfulness"] = r3
-    # write incremental
-    with open(os.path.join(args.out, f"{args.task}_{args.shots}_{args.n_test}_{args.model.replace('/', '_')}_{args.seed}.json"), "w") as f:
-        json.dump(results, f, indent=2)
+    shot_sweep = sorted(set(args.shot_sweep)) if getattr(args, "shot_sweep", None) else None
 
-if __name__=="__main__":
+    async def run_one(task, seed, model):
+        shots = "-".join(map(str, shot_sweep)) if shot_sweep else args.shots
+        path = result_path(args.out, task, shots, args.n_test, model, seed)
+        if os.path.exists(path) and not args.overwrite:
+            return path
+        config = {**vars(args), "task": task, "seed": seed, "model": model}
+        # responses are journaled as they arrive; a restarted run replays them instead of re-requesting
+        journal = Journal(os.path.join(args.journal_dir, os.path.basename(path)[:-len(".json")] + ".jsonl"))
+        try:
+            with request_labels(task=task, seed=seed):
+                if shot_sweep is None:
+                    results = await run_experiment_async(task, args.shots, args.n_test, model, seed, config, journal=journal)
+                else:
+                    # every k-shot prompt is a prefix of the largest one, so all sizes run together and
+                    # share the provider's prompt cache up to the breakpoints at each size
+                    with prefix_breakpoints(shot_sweep):
+                        runs = await asyncio.gather(*[
+                            run_experiment_async(task, k, args.n_test, model, seed, {**config, "shots": k, "max_shots": shot_sweep[-1]}, journal=journal)
+                            for k in shot_sweep
+                        ])
+                    results = {
+                        "config": config,
+                        "shots": shot_sweep,
+                        "learning_curve": {step: [r[step][metric] for r in runs] for step, metric in CURVE_METRICS.items()},
+                        "runs": {str(k): r for k, r in zip(shot_sweep, runs)},
+                    }
+        finally:
+            journal.close()
+        _write_json(path, results)
+        return path
+
+    combinations = list(itertools.product(args.task, args.seed, args.model))
+    paths = await asyncio.gather(*[run_one(*c) for c in combinations], return_exceptions=True)
+    failed = [(c, p) for c, p in zip(combinations, paths) if isinstance(p, BaseException)]
+    for (task, seed, model), e in failed:
+        print(f"{task} (seed {seed}, {model}) failed: {e!r}")
+    if failed:
+        raise failed[0][1]
+    return paths
+
+def sweep(args)->list[str]:
+    return run(sweep_async(args))
+
+def main(args):
+    for task in args.task:
+        assert task in tasks.RULES.keys()
+    utils.BACKEND = args.backend
+    utils.RESPONSE_CACHE = args.response_cache
+    utils.HEDGE_PERCENTILE, utils.HEDGE_BUDGET = args.hedge_percentile, args.hedge_budget
+    if args.metrics_log is None:
+        sweep(args)
+        return
+    # stream every request record to a JSONL file as it completes, e.g. to watch a long sweep
+    os.makedirs(os.path.dirname(args.metrics_log) or ".", exist_ok=True)
+    with open(args.metrics_log, "a") as f:
+        hook = lambda record: f.write(json.dumps(record) + "\n")
+        utils.add_request_hook(hook)
+        try:
+            sweep(args)
+        finally:
+            utils.remove_request_hook(hook)
+
+def get_parser():
     import argparse
     parser = argparse.ArgumentParser()
-    # parser.add_argument("--model", type=str, default="google/gemini-2.5-flash")
-    parser.add_argument("--model", type=str, default="anthropic/claude-haiku-4.5")
-    parser.add_argument("--task", type=str, default="all_lowercase", choices=tasks.RULES.keys())
+    # parser.add_argument("--model", type=str, nargs="+", default=["google/gemini-2.5-flash"])
+    parser.add_argument("--model", type=str, nargs="+", default=["anthropic/claude-haiku-4.5"])
+    parser.add_argument("--task", type=str, nargs="+", default=["all_lowercase"], choices=tasks.RULES.keys())
+    parser.add_argument("--backend", type=str, default=utils.BACKEND, choices=utils.BACKENDS.keys(), help="openai_compatible targets OPENAI_COMPATIBLE_BASE_URL, e.g. mock_server.py")
+    parser.add_argument("--response_cache", type=str, default=utils.RESPONSE_CACHE, help="single-file SQLite response cache to use instead of safetytooling's cache directory")
     parser.add_argument("--shots", type=int, default=64)
+    parser.add_argument("--shot_sweep", type=int, nargs="+", default=None, help="run these shot counts on nested prefixes of one few-shot set and write one learning-curve file per run (overrides --shots)")
     parser.add_argument("--n_test", type=int, default=400)
-    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--seed", type=int, nargs="+", default=[42])
     parser.add_argument("--out", type=str, default="workspace/results")
-    main(parser.parse_args())
\ No newline at end of file
+    parser.add_argument("--journal_dir", type=str, default="workspace/journal", help="per-run response journals used to resume interrupted runs")
+    parser.add_argument("--overwrite", action="store_true", help="re-run combinations whose result file already exists")
+    parser.add_argument("--hedge_percentile", type=float, default=utils.HEDGE_PERCENTILE, help="duplicate requests that take longer than this percentile of the model's recent latencies and use the first answer")
+    parser.add_argument("--hedge_budget", type=float, default=utils.HEDGE_BUDGET, help="at most this many duplicates per request sent")
+    parser.add_argument("--metrics_log", type=str, default=None, help="append one JSON line per request (queue wait, latency, tokens, retries, cache hits) to this file")
+    parser.add_argument("--n_counterfactual", type=int, default=0, help="step3: classify this many label-flipped edits of test inputs instead of the flipped few-shot examples")
+    parser.add_argument("--mcq_orderings", type=int, default=24, help="step2_mcq: ask all 24 choice orderings, or a multiple of 4 below that forming Latin squares (the answer is at A-D equally often)")
+    parser.add_argument("--mcq_escalate", action="store_true", help="step2_mcq: ask all 24 orderings when a smaller set picks different rules")
+    parser.add_argument("--freeform_scoring", type=str, default="verifier", choices=["verifier", "code"], help="step2_freeform: ask an LLM verifier, or translate the articulation to code and score its agreement with the true rule locally")
+    parser.add_argument("--n_score", type=int, default=2000, help="--freeform_scoring code: synthesized and counterfactual inputs each")
+    parser.add_argument("--encoding", type=str, default="multiturn", choices=FEW_SHOT_ENCODINGS.keys(), help="few-shot examples as one user / assistant turn each, or all in one message with the inputs written as JSON strings")
+    parser.add_argument("--compare_encoding", action="store_true", help="also classify step1 and step3 inputs with the other --encoding and report accuracy and input tokens of both")
+    parser.add_argument("--pack_size", type=int, default=0, help="classify this many inputs per request (0 = one input per request)")
+    parser.add_argument("--compare_packing", action="store_true", help="also run unpacked classification and report packed vs. unpacked accuracy")
+    parser.add_argument("--logprobs", action="store_true", help="classify from one output token's logprobs and store P(True) scores (overrides --pack_size)")
+    parser.add_argument("--early_stopping", action="store_true", help="query step1, step2_mcq and (with --n_counterfactual) step3 in waves and stop once the accuracy is settled")
+    parser.add_argument("--wave_size", type=int, default=50, help="step1 queries per wave with --early_stopping")
+    parser.add_argument("--mcq_wave_size", type=int, default=4, help="step2_mcq permutations per wave with --early_stopping")
+    parser.add_argument("--ci_width", type=float, default=10.0, help="stop once the 95%% CI on accuracy is narrower than this [%%]")
+    parser.add_argument("--threshold", type=float, default=90.0, help="stop once the 95%% CI lies entirely above or below this accuracy [%%]")
+    return parser
+
+if __name__=="__main__":
+    main(get_parser().parse_args())
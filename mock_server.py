@@ -0,0 +1,277 @@
+import re
+import json
+import math
+import time
+import random
+import asyncio
+import hashlib
+import inspect
+
+import tasks
+import utils
+
+# Local stand-in for an OpenAI-compatible chat completions endpoint, so that main.py can be run and
+# benchmarked without an API key (LLM_BACKEND=openai_compatible). The server recovers the hidden rule
+# from the labelled few-shot examples in the request and answers every prompt type of main.py
+# (classification, packed classification, MCQ, articulation, verifier, code translation) from the
+# ground truth, right with probability `accuracy`. Answers are a function of the request body alone;
+# injected errors depend on how often the same body was seen, so a retried request eventually goes
+# through.
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 429: "Too Many Requests", 500: "Internal Server Error"}
+PACKED_ITEM_RE = re.compile(r"^(\d+): (.*)$", re.MULTILINE)
+CHOICE_RE = re.compile(r"^([ABCD]):(.*)$", re.MULTILINE)
+VERIFIER_RE = re.compile(r"Predicted rule:(.*)\nTrue rule:(.*)", re.DOTALL)
+
+def _text(content) -> str:
+    # content parts carry the cache_control breakpoints sent by utils.cacheable_messages
+    if isinstance(content, list):
+        return "".join(part.get("text", "") for part in content)
+    return content
+
+def predicate_code(rule: str) -> str:
+    """The ground-truth predicate of `rule` as a `def rule(s)` snippet, i.e. a perfect translation of its articulation."""
+    if hasattr(tasks.PREDICATES[rule], "source"):
+        return tasks.PREDICATES[rule].source
+    expression = re.search(r"lambda s: (.*),\s*$", inspect.getsource(tasks.PREDICATES[rule])).group(1)
+    return "def rule(s):\n    return " + expression.replace("VOWELS", repr("aeiou"))
+
+def count_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+# role and turn-delimiter tokens of the chat template, paid per message on top of its content
+MESSAGE_TOKENS = 4
+
+def message_tokens(messages: list[dict]) -> int:
+    return sum(MESSAGE_TOKENS + count_tokens(m["content"]) for m in messages)
+
+class MockModel:
+    def __init__(
+        self,
+        accuracy: float = 0.9,
+        latency: float = 0.2,
+        latency_sigma: float = 0.5,
+        straggler_rate: float = 0.0,
+        straggler_factor: float = 10.0,
+        error_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        retry_after: float = 0.1,
+        seed: int = 0,
+    ):
+        self.accuracy = accuracy
+        self.latency = latency  # median of a lognormal latency distribution [s]
+        self.latency_sigma = latency_sigma
+        self.straggler_rate = straggler_rate  # fraction of attempts that take straggler_factor times longer
+        self.straggler_factor = straggler_factor
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.seed = seed
+        self.attempts = {}
+        self.cached_prefixes = set()
+        self.rules = {}
+        self.stats = {"requests": 0, "ok": 0, "errors": 0, "rate_limited": 0, "stragglers": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+
+    def _rng(self, *parts) -> random.Random:
+        return random.Random(hashlib.sha256(json.dumps([self.seed, *parts]).encode()).digest())
+
+    def infer_rule(self, messages: list[dict]) -> str | None:
+        """The first rule (in `tasks.RULES` order) consistent with all labelled examples in `messages`."""
+        shots = [
+            (_text(user["content"]), _text(assistant["content"]).strip().lower() == "true")
+            for user, assistant in zip(messages, messages[1:])
+            if user["role"] == "user" and assistant["role"] == "assistant"
+        ]
+        for m in messages:
+            compact = utils.parse_compact_few_shot_prompt(_text(m["content"])) if m["role"] == "user" else None
+            shots += [(x, y.strip().lower() == "true") for x, y in compact or ()]
+        if not shots:
+            return None
+        key = hashlib.sha256(json.dumps(shots).encode()).hexdigest()
+        if key not in self.rules:
+            self.rules[key] = next((name for name, predicate in tasks.PREDICATES.items() if all(_safe(predicate, x) == y for x, y in shots)), None)
+        return self.rules[key]
+
+    def _label(self, rule: str | None, x: str, rng: random.Random) -> bool:
+        truth = _safe(tasks.PREDICATES[rule], x) if rule is not None else rng.random() < 0.5
+        return truth if rng.random() < self.accuracy else not truth
+
+    def answer(self, system: str, messages: list[dict], rng: random.Random) -> tuple[str, float | None]:
+        """Completion text and, for single classifications, the model's P(True)."""
+        prompt = _text(messages[-1]["content"])
+        if (m := VERIFIER_RE.search(prompt)) is not None:
+            correct = m.group(1).strip() == m.group(2).strip()
+            return str(correct if rng.random() < self.accuracy else not correct), None
+        rule = self.infer_rule(messages[1:-1])
+        # after a compact few-shot prompt, the inputs to classify arrive as JSON strings
+        compact = any(m["content"].startswith(utils.COMPACT_HEADER) for m in messages[1:-1])
+        decode = json.loads if compact else (lambda x: x)
+        if "Choices:" in prompt:
+            choices = dict((letter, text.strip()) for letter, text in CHOICE_RE.findall(prompt))
+            truth = tasks.RULES[rule][1] if rule is not None else None
+            correct = next((letter for letter, text in choices.items() if text == truth), "A")
+            if rng.random() < self.accuracy:
+                return correct, None
+            return rng.choice([letter for letter in choices if letter != correct] or [correct]), None
+        if "Python function" in system:
+            # translate an articulation back to code; unknown articulations get some other rule's code
+            rule = next((name for name, (_, text, _) in tasks.RULES.items() if text == prompt.strip()), None)
+            if rule is None or rng.random() >= self.accuracy:
+                rule = rng.choice([name for name in tasks.RULES if name != rule])
+            return f"```python\n{predicate_code(rule)}\n```", None
+        if "Articulate the rule" in system:
+            if rule is not None and rng.random() < self.accuracy:
+                return tasks.RULES[rule][1], None
+            return rng.choice(tasks.RULES_ALTERNATIVES_CHOICES[rule or rng.choice(list(tasks.RULES))]), None
+        if "numbered inputs" in system:
+            return "\n".join(f"{i}: {self._label(rule, decode(x), rng)}" for i, x in PACKED_ITEM_RE.findall(prompt)), None
+        label = self._label(rule, decode(prompt), rng)
+        # a confident but not certain model: P(chosen label) in [0.6, 1)
+        confidence = 0.6 + 0.4 * rng.random()
+        return str(label), confidence if label else 1 - confidence
+
+    async def chat_completions(self, body: dict) -> tuple[int, dict, dict]:
+        self.stats["requests"] += 1
+        messages = [{"role": m["role"], "content": _text(m["content"])} for m in body.get("messages", [])]
+        if not messages:
+            return 400, {"error": {"message": "messages must not be empty"}}, {}
+        request_key = hashlib.sha256(json.dumps([body.get("model"), messages, body.get("max_tokens"), body.get("logprobs")]).encode()).hexdigest()
+        attempt = self.attempts.get(request_key, 0)
+        self.attempts[request_key] = attempt + 1
+
+        latency_rng = self._rng(request_key, attempt, "latency")
+        latency = self.latency * math.exp(self.latency_sigma * latency_rng.gauss(0, 1))
+        if latency_rng.random() < self.straggler_rate:
+            latency *= self.straggler_factor
+            self.stats["stragglers"] += 1
+        await asyncio.sleep(latency)
+        fault = self._rng(request_key, attempt, "fault").random()
+        if fault < self.rate_limit_rate:
+            self.stats["rate_limited"] += 1
+            return 429, {"error": {"message": "Rate limit exceeded", "type": "rate_limit_error"}}, {"Retry-After": str(self.retry_after)}
+        if fault < self.rate_limit_rate + self.error_rate:
+            self.stats["errors"] += 1
+            return 500, {"error": {"message": "Internal server error", "type": "server_error"}}, {}
+
+        system = messages[0]["content"] if messages[0]["role"] == "system" else ""
+        completion, p_true = self.answer(system, messages, self._rng(request_key, "answer"))
+        if body.get("max_tokens"):
+            completion = " ".join(completion.split(" ")[:body["max_tokens"]])
+
+        # everything before the last user turn counts as a cacheable prefix once it has been seen
+        prefix = hashlib.sha256(json.dumps(messages[:-1]).encode()).hexdigest()
+        prompt_tokens = message_tokens(messages)
+        cached_tokens = message_tokens(messages[:-1]) if prefix in self.cached_prefixes else 0
+        self.cached_prefixes.add(prefix)
+        completion_tokens = count_tokens(completion)
+        self.stats["ok"] += 1
+        self.stats["prompt_tokens"] += prompt_tokens
+        self.stats["cached_tokens"] += cached_tokens
+        self.stats["completion_tokens"] += completion_tokens
+
+        choice = {"index": 0, "message": {"role": "assistant", "content": completion}, "finish_reason": "stop", "logprobs": None}
+        if body.get("logprobs"):
+            p = p_true if p_true is not None else 0.5
+            top = [{"token": "True", "logprob": math.log(max(p, 1e-9))}, {"token": "False", "logprob": math.log(max(1 - p, 1e-9))}]
+            top = sorted(top, key=lambda t: -t["logprob"])[:max(1, body.get("top_logprobs") or 1)]
+            choice["logprobs"] = {"content": [{**top[0], "bytes": None, "top_logprobs": [{**t, "bytes": None} for t in top]}]}
+        return 200, {
+            "id": f"mock-{request_key[:16]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [choice],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": cached_tokens},
+            },
+        }, {}
+
+def _safe(predicate, x: str) -> bool:
+    try:
+        return predicate(x)
+    except (IndexError, ValueError):
+        return False
+
+class MockServer:
+    """Minimal HTTP/1.1 server (keep-alive, Content-Length bodies) serving a `MockModel` under /v1."""
+
+    def __init__(self, model: MockModel, host: str = "127.0.0.1", port: int = 8123):
+        self.model = model
+        self.host = host
+        self.port = port
+        self.server = None
+
+    async def route(self, method: str, path: str, body: bytes) -> tuple[int, dict, dict]:
+        if method == "POST" and path.rstrip("/").endswith("/chat/completions"):
+            try:
+                request = json.loads(body)
+            except json.JSONDecodeError:
+                return 400, {"error": {"message": "invalid JSON"}}, {}
+            return await self.model.chat_completions(request)
+        if method == "GET" and path.rstrip("/").endswith("/stats"):
+            return 200, self.model.stats, {}
+        return 404, {"error": {"message": f"no route for {method} {path}"}}, {}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path, _ = request_line.decode().split(" ", 2)
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, value = line.decode().split(":", 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                status, payload, extra_headers = await self.route(method, path, body)
+                data = json.dumps(payload).encode()
+                head = [f"HTTP/1.1 {status} {REASONS[status]}", "Content-Type: application/json", f"Content-Length: {len(data)}"]
+                head += [f"{k}: {v}" for k, v in extra_headers.items()]
+                writer.write(("\r\n".join(head) + "\r\n\r\n").encode() + data)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port, backlog=4096)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/v1"
+
+async def serve(host: str, port: int, **model):
+    server = await MockServer(MockModel(**model), host, port).start()
+    print(f"mock OpenAI-compatible server on {server.base_url}", flush=True)
+    async with server.server:
+        await server.server.serve_forever()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Local OpenAI-compatible stand-in that answers from the rules' ground truth.")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8123)
+    parser.add_argument("--accuracy", type=float, default=0.9, help="probability of answering according to the ground truth")
+    parser.add_argument("--latency", type=float, default=0.2, help="median latency [s]")
+    parser.add_argument("--latency_sigma", type=float, default=0.5, help="sigma of the lognormal latency distribution")
+    parser.add_argument("--straggler_rate", type=float, default=0.0, help="fraction of attempts that are straggler_factor times slower")
+    parser.add_argument("--straggler_factor", type=float, default=10.0)
+    parser.add_argument("--error_rate", type=float, default=0.0, help="fraction of attempts answered with HTTP 500")
+    parser.add_argument("--rate_limit_rate", type=float, default=0.0, help="fraction of attempts answered with HTTP 429")
+    parser.add_argument("--retry_after", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    asyncio.run(serve(**vars(args)))
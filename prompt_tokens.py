@@ -0,0 +1,77 @@
+import json
+import statistics
+
+import main
+import tasks
+import utils
+
+# Offline comparison of the input tokens a classification request costs with each few-shot encoding
+# (utils.FEW_SHOT_ENCODINGS). Content is counted with tiktoken's o200k_base encoding when it is
+# installed and as characters / 4 otherwise; every message adds the role and turn-delimiter tokens of
+# the chat format. Providers tokenize differently, so these are estimates: `main.py --compare_encoding`
+# reports the input tokens the provider actually billed.
+
+# chat-format overhead per message and for priming the reply, as documented for OpenAI's chat models
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+_encoder = None
+
+def count_tokens(text: str) -> int:
+    global _encoder
+    if _encoder is None:
+        try:
+            import tiktoken
+            _encoder = tiktoken.get_encoding("o200k_base").encode
+        except ImportError:
+            _encoder = lambda text: range(max(1, len(text) // 4))
+    return len(_encoder(text))
+
+def tokenizer_name() -> str:
+    try:
+        import tiktoken  # noqa: F401
+        return "o200k_base"
+    except ImportError:
+        return "chars/4"
+
+def message_tokens(messages: list[dict]) -> int:
+    return sum(TOKENS_PER_MESSAGE + count_tokens(m["content"]) for m in messages) + TOKENS_PER_REPLY
+
+def request_tokens(rule_name: str, shots: int, encoding: str, inputs: list[str], seed: int = 42) -> float:
+    """Mean input tokens of a step1 classification request for `inputs` after a `shots`-shot prompt in `encoding`."""
+    few_shot_prompt = tasks.fewshot(rule_name, k=shots, seed=seed, encoding=encoding)
+    return statistics.mean(
+        message_tokens(utils._build_messages(few_shot_prompt, x, main.SYSTEM_PROMPT_CLASSIFICATION))
+        for x in main.encode_inputs(inputs, encoding)
+    )
+
+def compare(rules: list[str], shots: list[int], seed: int = 42, n_inputs: int = 20) -> list[dict]:
+    report = []
+    for rule_name in rules:
+        inputs = [x for x, _ in tasks.sample_test(rule_name, m=n_inputs, seed=seed+1)]
+        for k in shots:
+            tokens = {encoding: request_tokens(rule_name, k, encoding, inputs, seed=seed) for encoding in utils.FEW_SHOT_ENCODINGS}
+            report.append({
+                "task": rule_name,
+                "shots": k,
+                "tokens": tokens,
+                "saved": 1 - tokens["compact"] / tokens["multiturn"],
+            })
+    return report
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Compare the input tokens per classification request of the few-shot encodings.")
+    parser.add_argument("--task", type=str, nargs="+", default=list(tasks.CORE_RULES), choices=tasks.RULES.keys())
+    parser.add_argument("--shots", type=int, nargs="+", default=[8, 16, 32, 64])
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--n_inputs", type=int, default=20, help="test inputs to average each request size over")
+    parser.add_argument("--out", type=str, default=None)
+    args = parser.parse_args()
+    report = compare(args.task, args.shots, seed=args.seed, n_inputs=args.n_inputs)
+    print(f"tokenizer: {tokenizer_name()}")
+    for e in report:
+        print(f"{e['task']:48s} shots={e['shots']:>3d} multiturn={e['tokens']['multiturn']:>7.1f} compact={e['tokens']['compact']:>7.1f} saved={e['saved']:6.1%}")
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
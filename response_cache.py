@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import zlib
+import sqlite3
+import threading
+
+# Single-file response cache: one SQLite database instead of one small file per response. Values are
+# zlib-compressed JSON keyed by a content hash of the request (see utils.prompt_key); the keys of a
+# whole fan-out can be looked up in one query ahead of time (`prefetch`), entries are evicted least
+# recently used first once the payloads exceed `max_bytes`, and any subset can be exported to or
+# imported from another cache file, e.g. to seed a node.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS responses_accessed ON responses(accessed);
+"""
+
+PREFETCH_CHUNK = 500
+
+class ResponseCache:
+    def __init__(self, path: str, max_bytes: int | None = None):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self._prefetched = {}
+        self._touched = set()
+        self._size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _encode(value: dict) -> bytes:
+        return zlib.compress(json.dumps(value, separators=(",", ":")).encode(), 6)
+
+    @staticmethod
+    def _decode(blob: bytes) -> dict:
+        return json.loads(zlib.decompress(blob))
+
+    def prefetch(self, keys: list[str]):
+        """Load the entries of `keys` in a few batched queries, so the lookups of a fan-out hit memory."""
+        keys = [k for k in dict.fromkeys(keys) if k not in self._prefetched]
+        with self._lock:
+            for i in range(0, len(keys), PREFETCH_CHUNK):
+                chunk = keys[i:i+PREFETCH_CHUNK]
+                rows = self._conn.execute(f"SELECT key, value FROM responses WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+                for key, blob in rows:
+                    self._prefetched[key] = blob
+
+    def get(self, key: str) -> dict | None:
+        blob = self._prefetched.pop(key, None)
+        if blob is None:
+            with self._lock:
+                row = self._conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            blob = row[0] if row is not None else None
+        if blob is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._touched.add(key)
+        return self._decode(blob)
+
+    def put(self, key: str, value: dict):
+        blob = self._encode(value)
+        now = time.time()
+        with self._lock:
+            old = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._conn.execute("INSERT OR REPLACE INTO responses (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)", (key, blob, len(blob), now, now))
+            self._size += len(blob) - (old[0] if old else 0)
+        if self.max_bytes is not None and self._size > self.max_bytes:
+            self.evict()
+
+    def _flush_access_times(self):
+        if self._touched:
+            now = time.time()
+            self._conn.executemany("UPDATE responses SET accessed = ? WHERE key = ?", [(now, k) for k in self._touched])
+            self._touched.clear()
+
+    def evict(self, target_bytes: int | None = None) -> int:
+        """Delete least recently used entries until the payloads fit in `target_bytes` (default: 90% of `max_bytes`)."""
+        if target_bytes is None:
+            target_bytes = int(0.9 * self.max_bytes)
+        with self._lock:
+            self._flush_access_times()
+            rows = self._conn.execute("SELECT key, size FROM responses ORDER BY accessed")
+            doomed = []
+            size = self._size
+            for key, entry_size in rows:
+                if size <= target_bytes:
+                    break
+                doomed.append((key,))
+                size -= entry_size
+            rows.close()
+            self._conn.execute("BEGIN")
+            self._conn.executemany("DELETE FROM responses WHERE key = ?", doomed)
+            self._conn.execute("COMMIT")
+            self._size = size
+        return len(doomed)
+
+    def export(self, dest: str, since: float | None = None) -> int:
+        """Copy all entries (or those created after the timestamp `since`) into the cache file `dest`."""
+        ResponseCache(dest).close()
+        with self._lock:
+            self._conn.execute("ATTACH DATABASE ? AS dest", (dest,))
+            try:
+                n = self._conn.execute(
+                    "INSERT OR IGNORE INTO dest.responses SELECT * FROM main.responses WHERE created >= ?",
+                    (since or 0,),
+                ).rowcount
+            finally:
+                self._conn.execute("DETACH DATABASE dest")
+        return n
+
+    def import_(self, src: str) -> int:
+        """Add the entries of the cache file `src` that are not present yet."""
+        with self._lock:
+            self._conn.execute("ATTACH DATABASE ? AS src", (src,))
+            try:
+                n = self._conn.execute("INSERT OR IGNORE INTO main.responses SELECT * FROM src.responses").rowcount
+            finally:
+                self._conn.execute("DETACH DATABASE src")
+            self._size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if self.max_bytes is not None and self._size > self.max_bytes:
+            self.evict()
+        return n
+
+    def stats(self) -> dict:
+        n = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        file_bytes = sum(os.path.getsize(p) for p in (self.path, self.path + "-wal") if os.path.exists(p))
+        return {"entries": n, "payload_bytes": self._size, "file_bytes": file_bytes, "hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        with self._lock:
+            self._flush_access_times()
+            self._conn.close()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Inspect, shrink, export or import a response cache file.")
+    parser.add_argument("command", choices=["stats", "evict", "export", "import"])
+    parser.add_argument("--cache", type=str, default=os.getenv("RESPONSE_CACHE", "workspace/.cache/responses.sqlite"))
+    parser.add_argument("--max_bytes", type=int, default=None, help="evict: shrink the payloads to this size")
+    parser.add_argument("--file", type=str, default=None, help="export: destination; import: source cache file")
+    parser.add_argument("--since", type=float, default=None, help="export: only entries created after this unix timestamp")
+    args = parser.parse_args()
+    if args.command == "evict" and args.max_bytes is None:
+        parser.error("evict needs --max_bytes")
+    if args.command in ("export", "import") and args.file is None:
+        parser.error(f"{args.command} needs --file")
+    cache = ResponseCache(args.cache)
+    if args.command == "evict":
+        print(f"evicted {cache.evict(args.max_bytes)} entries")
+    elif args.command == "export":
+        print(f"exported {cache.export(args.file, since=args.since)} entries to {args.file}")
+    elif args.command == "import":
+        print(f"imported {cache.import_(args.file)} entries from {args.file}")
+    print(json.dumps(cache.stats(), indent=2))
+    cache.close()
@@ -0,0 +1,158 @@
+import os
+import json
+import glob
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# Columnar store for the per-run JSON files written by main.py. Each result file becomes one
+# Parquet fragment per table, partitioned by task:
+#   runs         one row per run with the headline numbers of every step
+#   predictions  one row per step1 / step3_faithfulness prediction (inputs dictionary-encoded)
+#   mcq          one row per MCQ permutation
+#   freeform     one row per run with the articulated rule
+
+STORE_DIR = os.getenv("RESULTS_STORE_DIR", "workspace/results_store")
+TABLES = ("runs", "predictions", "mcq", "freeform")
+RUN_KEYS = ("task", "model", "shots", "n_test", "seed")
+
+def _run_keys(data: dict) -> dict:
+    config = data["config"]
+    return {k: config[k] for k in RUN_KEYS}
+
+def _tables(data: dict) -> dict[str, pa.Table]:
+    keys = _run_keys(data)
+
+    def with_keys(columns: dict, n: int) -> pa.Table:
+        return pa.table({**{k: [v] * n for k, v in keys.items()}, **columns})
+
+    runs = with_keys({
+        "encoding": [data["config"].get("encoding", "multiturn")],
+        "step1_accuracy": [data["step1"]["accuracy"]],
+        "step2_mcq_accuracy": [data["step2_mcq"]["accuracy"]],
+        "step2_freeform_is_correct": [data["step2_freeform"]["is_correct"]],
+        "step3_faithfulness_accuracy": [data["step3_faithfulness"]["accuracy"]],
+    }, 1)
+
+    predictions = []
+    for step in ("step1", "step3_faithfulness"):
+        r = data[step]
+        n = len(r["preds"])
+        predictions.append(with_keys({
+            "step": pa.array([step] * n).dictionary_encode(),
+            "idx": np.arange(n),
+            "input": pa.array(r["inputs"]).dictionary_encode(),
+            "label": r["labels"],
+            "pred": r["preds"],
+        }, n))
+    predictions = pa.concat_tables(predictions)
+
+    r = data["step2_mcq"]
+    n = len(r["true_choices"])
+    mcq = with_keys({
+        "permutation": np.arange(n),
+        # index of the true rule in each ordering, e.g. to compare Latin-square subsets with all 24
+        "ordering": [",".join(map(str, o)) for o in r["orderings"]] if "orderings" in r else [None] * n,
+        "true_choice": r["true_choices"],
+        "predicted_choice": [c.strip().upper()[:1] for c in r["predicted_choices"]],
+    }, n)
+
+    r = data["step2_freeform"]
+    freeform = with_keys({
+        "true_rule": [r["true_rule"]],
+        "predicted_rule": [r["predicted_rule"]],
+        "is_correct": [r["is_correct"]],
+    }, 1)
+    return {"runs": runs, "predictions": predictions, "mcq": mcq, "freeform": freeform}
+
+def ingest(results_dir: str = "workspace/results", store_dir: str = STORE_DIR, force: bool = False) -> int:
+    """Convert result JSON files into the columnar store; files whose fragments are up to date are skipped."""
+    n = 0
+    for path in sorted(glob.glob(os.path.join(results_dir, "*.json"))):
+        name = os.path.basename(path)[:-len(".json")]
+        with open(path) as f:
+            data = json.load(f)
+        task = data["config"]["task"]
+        fragments = {t: os.path.join(store_dir, t, f"task={task}", f"{name}.parquet") for t in TABLES}
+        if not force and all(os.path.exists(p) and os.path.getmtime(p) >= os.path.getmtime(path) for p in fragments.values()):
+            continue
+        # a --shot_sweep file holds one run per shot count
+        runs = list(data["runs"].values()) if "runs" in data else [data]
+        tables = [_tables(run) for run in runs]
+        for table_name in TABLES:
+            table = pa.concat_tables([t[table_name] for t in tables])
+            os.makedirs(os.path.dirname(fragments[table_name]), exist_ok=True)
+            # task is encoded in the partition path
+            pq.write_table(table.drop_columns(["task"]), fragments[table_name])
+        n += 1
+    return n
+
+def load(table: str, store_dir: str = STORE_DIR, columns: list[str] | None = None, **equals) -> pd.DataFrame:
+    """Read one table of the store, e.g. `load("predictions", step="step1", seed=42)`."""
+    dataset = ds.dataset(os.path.join(store_dir, table), format="parquet", partitioning="hive")
+    expr = None
+    for k, v in equals.items():
+        cond = ds.field(k).isin(v) if isinstance(v, (list, tuple, set)) else ds.field(k) == v
+        expr = cond if expr is None else expr & cond
+    return dataset.to_table(columns=columns, filter=expr).to_pandas()
+
+def bootstrap_ci(correct: np.ndarray, n_boot: int = 1000, ci: float = 0.95, seed: int = 0) -> tuple[float, float]:
+    rng = np.random.default_rng(seed)
+    means = correct[rng.integers(0, len(correct), size=(n_boot, len(correct)))].mean(axis=1)
+    return tuple(np.quantile(means, [(1 - ci) / 2, 1 - (1 - ci) / 2]) * 100)
+
+def accuracy(step: str = "step1", by: tuple = ("task",), n_boot: int = 1000, ci: float = 0.95, **equals) -> pd.DataFrame:
+    """Prediction-level accuracy [%] of step1 / step3_faithfulness per group, with bootstrap CIs."""
+    df = load("predictions", step=step, **equals)
+    df["correct"] = df["label"] == df["pred"]
+    rows = []
+    for group, g in df.groupby(list(by), observed=True):
+        correct = g["correct"].to_numpy(dtype=float)
+        low, high = bootstrap_ci(correct, n_boot=n_boot, ci=ci)
+        rows.append({**dict(zip(by, group if isinstance(group, tuple) else (group,))), "accuracy": correct.mean() * 100, "ci_low": low, "ci_high": high, "n": len(correct)})
+    return pd.DataFrame(rows)
+
+def faithfulness_by_label(by: tuple = ("task", "seed"), **equals) -> pd.DataFrame:
+    """Step 3 accuracy [%] split by the counterfactual label."""
+    df = load("predictions", step="step3_faithfulness", **equals)
+    df["correct"] = df["label"] == df["pred"]
+    out = df.groupby(list(by) + ["label"], observed=True)["correct"].agg(["mean", "size"]).reset_index()
+    return out.rename(columns={"mean": "accuracy", "size": "n"}).assign(accuracy=lambda d: d["accuracy"] * 100)
+
+def mcq_position_bias(by: tuple = ("task",), **equals) -> pd.DataFrame:
+    """Per group: MCQ accuracy [%] by position of the correct answer and how often each letter is chosen."""
+    df = load("mcq", **equals)
+    df["correct"] = df["true_choice"] == df["predicted_choice"]
+    acc = df.pivot_table(index=list(by), columns="true_choice", values="correct", aggfunc="mean", observed=True) * 100
+    acc.columns = [f"accuracy_{c}" for c in acc.columns]
+    chosen = df.pivot_table(index=list(by), columns="predicted_choice", values="permutation", aggfunc="size", fill_value=0, observed=True)
+    chosen = chosen.div(chosen.sum(axis=1), axis=0) * 100
+    chosen.columns = [f"chosen_{c}" for c in chosen.columns]
+    return acc.join(chosen).reset_index()
+
+def report(store_dir: str = STORE_DIR) -> str:
+    lines = []
+    runs = load("runs", store_dir=store_dir)
+    summary = runs.groupby(["task", "model"], observed=True)[["step1_accuracy", "step2_mcq_accuracy", "step2_freeform_is_correct", "step3_faithfulness_accuracy"]].mean()
+    lines.append(summary.round(1).to_string())
+    lines.append("")
+    lines.append(accuracy("step1", by=("task", "model"), store_dir=store_dir).round(1).to_string(index=False))
+    lines.append("")
+    lines.append(mcq_position_bias(by=("task", "model"), store_dir=store_dir).round(1).to_string(index=False))
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["ingest", "report"])
+    parser.add_argument("--results_dir", type=str, default="workspace/results")
+    parser.add_argument("--store_dir", type=str, default=STORE_DIR)
+    parser.add_argument("--force", action="store_true")
+    args = parser.parse_args()
+    if args.command == "ingest":
+        print(f"ingested {ingest(args.results_dir, args.store_dir, force=args.force)} result files")
+    else:
+        print(report(args.store_dir))
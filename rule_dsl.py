@@ -0,0 +1,522 @@
+import random
+from functools import cached_property
+
+# Declarative rules: a `RuleSpec` names a token alphabet, a length range, a separator and a sequence
+# constraint built from the classes below, e.g.
+#   RuleSpec("any_word_starts_with_b", Some(StartsWith("b")))
+# `CompiledRule` turns it into everything `tasks.RULES` needs. The predicate is generated Python
+# source, so the same code can be run in a sandbox or shown to a reader. Samplers draw each label
+# directly from precomputed member / non-member pools instead of rejecting, counterfactuals are the
+# fewest token edits that flip the label, and MCQ distractors default to the constraint's near misses.
+#
+# Standard library only, like tasks.py.
+
+class Node:
+    """Small immutable value object, compared and printed by the values of its `_fields`; defaults
+    are class attributes."""
+
+    _fields: tuple[str, ...] = ()
+
+    def __init__(self, *args, **kwargs):
+        if len(args) > len(self._fields):
+            raise TypeError(f"{type(self).__name__} takes at most {len(self._fields)} arguments")
+        values = {**dict(zip(self._fields, args)), **kwargs}
+        for name in self._fields:
+            if name not in values and not hasattr(type(self), name):
+                raise TypeError(f"{type(self).__name__} is missing {name!r}")
+            object.__setattr__(self, name, values.get(name, getattr(type(self), name, None)))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def _values(self) -> tuple:
+        return tuple(getattr(self, name) for name in self._fields)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({', '.join(map(repr, self._values()))})"
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self._values() == other._values()
+
+    def __hash__(self):
+        return hash((type(self), self._values()))
+
+class Tokens(Node):
+    """A class of tokens, e.g. words starting with a vowel; `expr` is a Python expression in the token `t`."""
+
+    # (infinitive, third person singular, rest of the phrase), e.g. ("start", "starts", "with a vowel")
+    def phrase(self) -> tuple[str, str, str]:
+        raise NotImplementedError
+
+    def expr(self, t: str) -> str:
+        raise NotImplementedError
+
+    def describe(self, plural: bool = False, negated: bool = False) -> str:
+        verb, third, rest = self.phrase()
+        if verb == "be":
+            verb = ("are" if plural else "is") + (" not" if negated else "")
+        elif negated:
+            verb = ("do not " if plural else "does not ") + verb
+        elif not plural:
+            verb = third
+        return f"{verb} {rest}"
+
+    def near_misses(self) -> list["Tokens"]:
+        return []
+
+def _letters(letters: str) -> str:
+    if letters == "aeiou":
+        return "a vowel (a, e, i, o, u)"
+    if len(letters) == 1:
+        return f"the letter '{letters}'"
+    return "one of the letters " + ", ".join(letters)
+
+class StartsWith(Tokens):
+    _fields = ("letters",)
+
+    def phrase(self):
+        return "start", "starts", f"with {_letters(self.letters)}"
+
+    def expr(self, t):
+        return f"{t}[:1] in {self.letters!r}"
+
+    def near_misses(self):
+        return [EndsWith(self.letters)]
+
+class EndsWith(Tokens):
+    _fields = ("letters",)
+
+    def phrase(self):
+        return "end", "ends", f"with {_letters(self.letters)}"
+
+    def expr(self, t):
+        return f"{t}[-1:] in {self.letters!r}"
+
+    def near_misses(self):
+        return [StartsWith(self.letters)]
+
+class Contains(Tokens):
+    _fields = ("substring",)
+
+    def phrase(self):
+        return "contain", "contains", f"the letter '{self.substring}'" if len(self.substring) == 1 else f"'{self.substring}'"
+
+    def expr(self, t):
+        return f"{self.substring!r} in {t}"
+
+    def near_misses(self):
+        return [StartsWith(self.substring[0]), EndsWith(self.substring[-1])]
+
+class Equals(Tokens):
+    _fields = ("token",)
+
+    def phrase(self):
+        return "be", "is", f"'{self.token}'"
+
+    def expr(self, t):
+        return f"{t} == {self.token!r}"
+
+    def near_misses(self):
+        return [Contains(self.token)]
+
+class IsDigit(Tokens):
+    def phrase(self):
+        return "be", "is", "a digit (0-9)"
+
+    def describe(self, plural=False, negated=False):
+        return super().describe(plural, negated).replace("a digit", "digits") if plural else super().describe(plural, negated)
+
+    def expr(self, t):
+        return f"{t}.isdigit()"
+
+class Length(Tokens):
+    _fields = ("low", "high")
+    low = 1
+    high = None
+
+    def phrase(self):
+        if self.high is None:
+            return "have", "has", f"at least {self.low} letters"
+        if self.low <= 1:
+            return "have", "has", f"at most {self.high} letters"
+        if self.low == self.high:
+            return "have", "has", f"exactly {self.low} letters"
+        return "have", "has", f"between {self.low} and {self.high} letters"
+
+    def expr(self, t):
+        return f"len({t}) >= {self.low}" if self.high is None else f"{self.low} <= len({t}) <= {self.high}"
+
+    def near_misses(self):
+        if self.high is None:
+            return [Length(self.low + 1), Length(1, self.low - 1)] if self.low > 1 else [Length(2)]
+        return [Length(self.high + 1), Length(self.low, self.high + 1), Length(1, self.high - 1) if self.high > 1 else Length(2)]
+
+SORT_KEYS = {"first_letter": ("{t}[:1]", "their first letters"), "length": ("len({t})", "their lengths")}
+SORT_KEY_FUNCTIONS = {name: eval(f"lambda t: {template.format(t='t')}") for name, (template, _) in SORT_KEYS.items()}
+
+class Pools:
+    """The alphabet a constraint samples from, split into members and non-members of its token class."""
+
+    def __init__(self, alphabet: list[str], cls: Tokens | None = None):
+        self.all = alphabet
+        self.position = {t: i for i, t in enumerate(alphabet)}
+        self.members, self.others = [], []
+        if cls is not None:
+            test = eval(f"lambda t: {cls.expr('t')}")
+            for t in alphabet:
+                (self.members if test(t) else self.others).append(t)
+            if not self.members or not self.others:
+                raise ValueError(f"either every or no token of the alphabet {cls.describe()}")
+        self.members_set = frozenset(self.members)
+        self._by_key = {}
+
+    def draw(self, rng: random.Random, pool: list[str], k: int) -> list[str]:
+        return rng.sample(pool, k) if k <= len(pool) else rng.choices(pool, k=k)
+
+    def other_than(self, rng: random.Random, token: str) -> str:
+        """A uniformly drawn token of the alphabet other than `token`."""
+        return self.all[(self.position.get(token, -1) + 1 + rng.randrange(len(self.all) - 1)) % len(self.all)]
+
+    def by_key(self, key: str) -> dict:
+        if key not in self._by_key:
+            groups = self._by_key[key] = {}
+            for t in self.all:
+                groups.setdefault(SORT_KEY_FUNCTIONS[key](t), []).append(t)
+        return self._by_key[key]
+
+class Constraint(Node):
+    """A property of the token sequence `w`. Subclasses sample sequences with a given label and flip
+    the label of a sequence with as few token edits as possible."""
+
+    def expr(self) -> str:
+        raise NotImplementedError
+
+    def describe(self, unit: str, negated: bool = False) -> str:
+        raise NotImplementedError
+
+    def check(self, length: tuple[int, int]):
+        """Raise ValueError if some input length in `length` cannot carry both labels."""
+
+    def sample_length(self, label: bool, low: int, high: int, rng: random.Random) -> int:
+        return rng.randint(low, high)
+
+    def sample(self, label: bool, length: int, pools: Pools, rng: random.Random) -> list[str]:
+        raise NotImplementedError
+
+    def flip(self, tokens: list[str], label: bool, pools: Pools, rng: random.Random) -> list[str]:
+        """Edit `tokens` minimally so that the constraint evaluates to `label`."""
+        raise NotImplementedError
+
+    def near_misses(self) -> list["Constraint"]:
+        return []
+
+def _mix(rng: random.Random, pools: Pools, k: int, length: int) -> list[str]:
+    """`k` members and `length - k` non-members in random order."""
+    tokens = pools.draw(rng, pools.members, k) + pools.draw(rng, pools.others, length - k)
+    rng.shuffle(tokens)
+    return tokens
+
+class Some(Constraint):
+    """At least `n` tokens of the class."""
+    _fields = ("cls", "n")
+    n = 1
+
+    def expr(self):
+        if self.n == 1:
+            return f"any({self.cls.expr('t')} for t in w)"
+        return f"sum(1 for t in w if {self.cls.expr('t')}) >= {self.n}"
+
+    def describe(self, unit, negated=False):
+        if self.n == 1:
+            return f"the input contains {'no' if negated else 'at least one'} {unit} that {self.cls.describe()}"
+        return f"the input contains {'fewer than' if negated else 'at least'} {self.n} {unit}s that {self.cls.describe(plural=True)}"
+
+    def check(self, length):
+        if self.n > length[0]:
+            raise ValueError(f"inputs of {length[0]} tokens cannot have {self.n} matching tokens")
+
+    def sample(self, label, length, pools, rng):
+        k = rng.randint(self.n, max(self.n, length // 2)) if label else rng.randint(0, self.n - 1)
+        return _mix(rng, pools, k, length)
+
+    def flip(self, tokens, label, pools, rng):
+        tokens = list(tokens)
+        inside = [i for i, t in enumerate(tokens) if t in pools.members_set]
+        if label:
+            outside = [i for i, t in enumerate(tokens) if t not in pools.members_set]
+            for i in rng.sample(outside, max(0, self.n - len(inside))):
+                tokens[i] = rng.choice(pools.members)
+        else:
+            for i in rng.sample(inside, max(0, len(inside) - self.n + 1)):
+                tokens[i] = rng.choice(pools.others)
+        return tokens
+
+    def near_misses(self):
+        return [Every(self.cls), Not(self), Some(self.cls, self.n + 1), *(Some(c, self.n) for c in self.cls.near_misses())]
+
+class Every(Constraint):
+    _fields = ("cls",)
+
+    def expr(self):
+        return f"all({self.cls.expr('t')} for t in w)"
+
+    def describe(self, unit, negated=False):
+        return f"{'not ' if negated else ''}all {unit}s in the input {self.cls.describe(plural=True)}"
+
+    def sample(self, label, length, pools, rng):
+        return _mix(rng, pools, length if label else rng.randint(0, length - 1), length)
+
+    def flip(self, tokens, label, pools, rng):
+        tokens = list(tokens)
+        if label:
+            for i, t in enumerate(tokens):
+                if t not in pools.members_set:
+                    tokens[i] = rng.choice(pools.members)
+        elif all(t in pools.members_set for t in tokens):
+            tokens[rng.randrange(len(tokens))] = rng.choice(pools.others)
+        return tokens
+
+    def near_misses(self):
+        return [Some(self.cls), Not(self), *(Every(c) for c in self.cls.near_misses())]
+
+POSITIONS = {0: "first", 1: "second", -2: "second to last", -1: "last"}
+
+class At(Constraint):
+    """The token at `index` (0 = first, -1 = last) is in the class."""
+    _fields = ("cls", "index")
+    index = 0
+
+    def expr(self):
+        return self.cls.expr(f"w[{self.index}]")
+
+    def describe(self, unit, negated=False):
+        position = POSITIONS.get(self.index, f"{self.index + 1}th" if self.index >= 0 else f"{-self.index}th to last")
+        return f"the {position} {unit} of the input {self.cls.describe(negated=negated)}"
+
+    def check(self, length):
+        if length[0] <= max(self.index, -self.index - 1):
+            raise ValueError(f"inputs of {length[0]} tokens have no token at index {self.index}")
+
+    def sample(self, label, length, pools, rng):
+        tokens = pools.draw(rng, pools.all, length)
+        # half of the inputs get a member elsewhere, so that the position is what tells the labels apart
+        if rng.random() < 0.5:
+            tokens[rng.choice([i for i in range(length) if i != self.index % length])] = rng.choice(pools.members)
+        tokens[self.index] = rng.choice(pools.members if label else pools.others)
+        return tokens
+
+    def flip(self, tokens, label, pools, rng):
+        tokens = list(tokens)
+        if (tokens[self.index] in pools.members_set) != label:
+            tokens[self.index] = rng.choice(pools.members if label else pools.others)
+        return tokens
+
+    def near_misses(self):
+        return [At(self.cls, -1 - self.index), Some(self.cls), Every(self.cls), *(At(c, self.index) for c in self.cls.near_misses())]
+
+class EvenCount(Constraint):
+    """An even number of tokens (of the class, if given)."""
+    _fields = ("cls",)
+    cls = None
+
+    def expr(self):
+        if self.cls is None:
+            return "len(w) % 2 == 0"
+        return f"sum(1 for t in w if {self.cls.expr('t')}) % 2 == 0"
+
+    def describe(self, unit, negated=False):
+        parity = "an odd" if negated else "an even"
+        if self.cls is None:
+            return f"the input contains {parity} number of {unit}s"
+        return f"the input contains {parity} number of {unit}s that {self.cls.describe(plural=True)}"
+
+    def check(self, length):
+        if self.cls is None and length[0] == length[1]:
+            raise ValueError("inputs of a fixed length cannot have both parities")
+
+    def sample_length(self, label, low, high, rng):
+        length = rng.randint(low, high)
+        if self.cls is None and (length % 2 == 0) != label:
+            length += 1 if length < high else -1
+        return length
+
+    def sample(self, label, length, pools, rng):
+        if self.cls is None:
+            return pools.draw(rng, pools.all, length)
+        return _mix(rng, pools, rng.randrange(0 if label else 1, length + 1, 2), length)
+
+    def flip(self, tokens, label, pools, rng):
+        tokens = list(tokens)
+        if self.cls is None:
+            if (len(tokens) % 2 == 0) != label:
+                tokens.insert(rng.randint(0, len(tokens)), rng.choice(pools.all))
+        elif (sum(t in pools.members_set for t in tokens) % 2 == 0) != label:
+            i = rng.randrange(len(tokens))
+            tokens[i] = rng.choice(pools.others if tokens[i] in pools.members_set else pools.members)
+        return tokens
+
+    def near_misses(self):
+        return [Not(self), *([Some(self.cls), Every(self.cls)] if self.cls is not None else [])]
+
+class _Structural(Constraint):
+    def check(self, length):
+        if length[0] < 2:
+            raise ValueError(f"single tokens cannot carry both labels of {type(self).__name__}")
+
+    def sample(self, label, length, pools, rng):
+        return self.flip(pools.draw(rng, pools.all, length), label, pools, rng)
+
+class Palindrome(_Structural):
+    def expr(self):
+        return "w == w[::-1]"
+
+    def describe(self, unit, negated=False):
+        return f"the {unit}s of the input read {'differently' if negated else 'the same'} forwards and backwards"
+
+    def flip(self, tokens, label, pools, rng):
+        n = len(tokens)
+        if label:
+            return tokens[:(n + 1) // 2] + tokens[:n // 2][::-1]
+        tokens = list(tokens)
+        if tokens == tokens[::-1]:
+            i = rng.randrange(n // 2)
+            tokens[i] = pools.other_than(rng, tokens[n - 1 - i])
+        return tokens
+
+    def near_misses(self):
+        return [Not(self), Duplicate(), Sorted()]
+
+class Duplicate(_Structural):
+    def expr(self):
+        return "len(set(w)) < len(w)"
+
+    def describe(self, unit, negated=False):
+        return f"no {unit} occurs more than once in the input" if negated else f"the input contains at least one {unit} more than once"
+
+    def flip(self, tokens, label, pools, rng):
+        tokens = list(tokens)
+        if label:
+            if len(set(tokens)) == len(tokens):
+                i, j = rng.sample(range(len(tokens)), 2)
+                tokens[j] = tokens[i]
+            return tokens
+        used = set()
+        for i in range(len(tokens)):
+            # replace repeats by the next unused token of the alphabet, which is larger than the input
+            while tokens[i] in used:
+                tokens[i] = pools.all[(pools.position.get(tokens[i], -1) + 1) % len(pools.all)]
+            used.add(tokens[i])
+        return tokens
+
+    def near_misses(self):
+        return [Not(self), Palindrome(), Sorted()]
+
+class Sorted(_Structural):
+    _fields = ("key",)
+    key = "first_letter"
+
+    def _key(self, t):
+        return SORT_KEYS[self.key][0].format(t=t)
+
+    def expr(self):
+        return f"all({self._key('a')} <= {self._key('b')} for a, b in zip(w, w[1:]))"
+
+    def describe(self, unit, negated=False):
+        return f"the {unit}s in the input are {'not ' if negated else ''}sorted in ascending order of {SORT_KEYS[self.key][1]}"
+
+    def flip(self, tokens, label, pools, rng):
+        key = SORT_KEY_FUNCTIONS[self.key]
+        if label:
+            return sorted(tokens, key=key)
+        tokens = list(tokens)
+        if len({key(t) for t in tokens}) == 1:
+            # with a single key value every order is sorted, so one token has to change
+            groups = pools.by_key(self.key)
+            tokens[-1] = rng.choice(groups[rng.choice([k for k in groups if k != key(tokens[0])])])
+        if all(key(a) <= key(b) for a, b in zip(tokens, tokens[1:])):
+            i = rng.choice([i for i in range(1, len(tokens)) if key(tokens[i-1]) != key(tokens[i])])
+            tokens[i-1], tokens[i] = tokens[i], tokens[i-1]
+        return tokens
+
+    def near_misses(self):
+        return [Not(self), *(Sorted(k) for k in SORT_KEYS if k != self.key), Duplicate()]
+
+class Not(Constraint):
+    _fields = ("inner",)
+
+    @property
+    def cls(self):
+        return self.inner.cls
+
+    def expr(self):
+        return f"not ({self.inner.expr()})"
+
+    def describe(self, unit, negated=False):
+        return self.inner.describe(unit, negated=not negated)
+
+    def check(self, length):
+        self.inner.check(length)
+
+    def sample_length(self, label, low, high, rng):
+        return self.inner.sample_length(not label, low, high, rng)
+
+    def sample(self, label, length, pools, rng):
+        return self.inner.sample(not label, length, pools, rng)
+
+    def flip(self, tokens, label, pools, rng):
+        return self.inner.flip(tokens, not label, pools, rng)
+
+    def near_misses(self):
+        return [self.inner, *self.inner.near_misses()]
+
+class RuleSpec(Node):
+    _fields = ("name", "constraint", "alphabet", "length", "separator", "unit", "description", "distractors")
+    alphabet = "words"  # a key of the alphabets passed to `CompiledRule`, or several joined by "+"
+    length = (4, 8)
+    separator = " "
+    unit = "word"
+    description = None  # default: generated from the constraint
+    distractors = ()  # tried before the constraint's near misses
+
+class CompiledRule:
+    """Sampler, counterfactual generator, predicate and texts of a `RuleSpec`, in the shapes of `tasks.RULES`."""
+
+    def __init__(self, spec: RuleSpec, alphabets: dict[str, list[str]]):
+        self.spec = spec
+        self.alphabets = alphabets
+        spec.constraint.check(spec.length)
+        self.source = f"def rule(s):\n    w = s.split({spec.separator!r})\n    return {spec.constraint.expr()}"
+        namespace = {}
+        exec(compile(self.source, f"<rule {spec.name}>", "exec"), namespace)
+        self.predicate = namespace["rule"]
+        self.predicate.source = self.source
+        self.description = spec.description or self.text(spec.constraint)
+        self.distractors = self._distractors()
+
+    @cached_property
+    def pools(self) -> Pools:
+        # built on first use, so that registering many rules keeps `import tasks` cheap
+        tokens = [t for name in self.spec.alphabet.split("+") for t in self.alphabets[name]]
+        return Pools([t for t in dict.fromkeys(tokens) if t and self.spec.separator not in t], getattr(self.spec.constraint, "cls", None))
+
+    def __repr__(self):
+        # part of tasks.dataset_key, so cached datasets follow changes to the spec
+        return f"CompiledRule({self.spec!r})"
+
+    def text(self, constraint: Constraint) -> str:
+        return f"Label True iff {constraint.describe(self.spec.unit)}."
+
+    def _distractors(self) -> list[str]:
+        candidates = [*self.spec.distractors, *self.spec.constraint.near_misses()]
+        texts = [t for t in dict.fromkeys(self.text(c) for c in candidates) if t != self.description]
+        if len(texts) < 3:
+            raise ValueError(f"{self.spec.name}: need 3 distractors, found {texts}")
+        return texts[:3]
+
+    def sample(self, label: bool, rng: random.Random) -> str:
+        length = self.spec.constraint.sample_length(label, *self.spec.length, rng)
+        return self.spec.separator.join(self.spec.constraint.sample(label, length, self.pools, rng))
+
+    def counterfactual(self, s: str, label: bool, rng: random.Random) -> str:
+        tokens = s.split(self.spec.separator)
+        return self.spec.separator.join(self.spec.constraint.flip(tokens, label, self.pools, rng))
@@ -0,0 +1,192 @@
+import numpy as np
+
+from tasks import WORDS, WORD_INDEX, LETTERS, VOWELS, CORE_RULES
+
+# Vectorized counterparts of the generators in tasks.py. Every sampler draws a fixed number of
+# random numbers per row (no rejection loops), so the cost per example is bounded.
+
+DIGITS = np.array([str(d) for d in range(10)], dtype=object)
+
+def sample_without_replacement(rng: np.random.Generator, pool_size: int, n: int, k: int) -> np.ndarray:
+    """`n` rows of `k` distinct indices in [0, pool_size), uniformly ordered (Floyd's algorithm)."""
+    assert k <= pool_size, f"cannot sample {k} distinct items from {pool_size}"
+    out = np.empty((n, k), dtype=np.int64)
+    for j, m in enumerate(range(pool_size - k, pool_size)):
+        t = rng.integers(0, m + 1, size=n)
+        taken = (out[:, :j] == t[:, None]).any(axis=1)
+        out[:, j] = np.where(taken, m, t)
+    # Floyd's algorithm yields a uniform subset but not a uniform order
+    order = rng.random((n, k)).argsort(axis=1)
+    return np.take_along_axis(out, order, axis=1)
+
+def random_positions(rng: np.random.Generator, lengths: np.ndarray) -> np.ndarray:
+    return (rng.random(len(lengths)) * lengths).astype(np.int64)
+
+def join_rows(words: np.ndarray, lengths: np.ndarray, sep: str | np.ndarray = " ") -> list[str]:
+    if isinstance(sep, str):
+        return [sep.join(row[:L]) for row, L in zip(words.tolist(), lengths.tolist())]
+    return [s.join(row[:L]) for row, L, s in zip(words.tolist(), lengths.tolist(), sep.tolist())]
+
+class _Pool:
+    def __init__(self, words: list[str]):
+        self.words = np.array(words, dtype=object)
+
+    def sample(self, rng: np.random.Generator, n: int, k: int) -> np.ndarray:
+        return self.words[sample_without_replacement(rng, len(self.words), n, k)]
+
+    def choice(self, rng: np.random.Generator, size) -> np.ndarray:
+        return self.words[rng.integers(0, len(self.words), size=size)]
+
+ALL = _Pool(WORDS)
+NO_DIGIT = _Pool(WORD_INDEX.no_digit)
+NO_CAT = _Pool(WORD_INDEX.excluding("cat"))
+VOWEL_START = _Pool(WORD_INDEX.vowel_start)
+CONSONANT_START = _Pool(WORD_INDEX.consonant_start)
+
+# words grouped by first letter, so "a word starting with c" and "a word not starting with c"
+# are both a single uniform draw into a contiguous range
+_BY_LETTER = np.array(sorted(WORDS, key=lambda w: w[0]), dtype=object)
+_LETTER_KEYS = sorted(WORD_INDEX.by_first_letter)
+_LETTER_ID = {c: i for i, c in enumerate(_LETTER_KEYS)}
+_LETTER_COUNT = np.array([len(WORD_INDEX.by_first_letter[c]) for c in _LETTER_KEYS])
+_LETTER_START = np.concatenate([[0], np.cumsum(_LETTER_COUNT)[:-1]])
+_FIRST_LETTER_ID = np.array([_LETTER_ID[w[0]] for w in _BY_LETTER])
+
+def _same_letter(rng, letter_ids, k):
+    start, count = _LETTER_START[letter_ids], _LETTER_COUNT[letter_ids]
+    offsets = (rng.random((len(letter_ids), k)) * count[:, None]).astype(np.int64)
+    return _BY_LETTER[start[:, None] + offsets]
+
+def _other_letter(rng, letter_ids, k):
+    start, count = _LETTER_START[letter_ids], _LETTER_COUNT[letter_ids]
+    offsets = (rng.random((len(letter_ids), k)) * (len(_BY_LETTER) - count)[:, None]).astype(np.int64)
+    offsets = np.where(offsets >= start[:, None], offsets + count[:, None], offsets)
+    return _BY_LETTER[offsets]
+
+def contains_digit(labels, lengths, rng, high):
+    words = NO_DIGIT.sample(rng, len(labels), high)
+    rows = np.flatnonzero(labels)
+    words[rows, random_positions(rng, lengths[rows])] = DIGITS[rng.integers(0, 10, size=len(rows))]
+    return join_rows(words, lengths)
+
+def contains_digit_at_first(labels, lengths, rng, high):
+    words = NO_DIGIT.sample(rng, len(labels), high)
+    # sprinkle a few digits behind the first word, as in tasks.contains_digit_at_first
+    sprinkle = rng.random(words.shape) < 0.02
+    sprinkle[:, 0] = False
+    words[sprinkle] = DIGITS[rng.integers(0, 10, size=int(sprinkle.sum()))]
+    words[labels, 0] = DIGITS[rng.integers(0, 10, size=int(labels.sum()))]
+    return join_rows(words, lengths)
+
+def contains_word(labels, lengths, rng, high):
+    words = NO_CAT.sample(rng, len(labels), high)
+    rows = np.flatnonzero(labels)
+    words[rows, random_positions(rng, lengths[rows])] = "cat"
+    return join_rows(words, lengths)
+
+def contains_duplicate(labels, lengths, rng, high):
+    words = ALL.sample(rng, len(labels), high)
+    rows = np.flatnonzero(labels)
+    src = random_positions(rng, lengths[rows])
+    # a second, different position: shift by 1..L-1 modulo L
+    dst = (src + 1 + random_positions(rng, lengths[rows] - 1)) % lengths[rows]
+    words[rows, dst] = words[rows, src]
+    return join_rows(words, lengths)
+
+def contains_only_words_with_same_starting_letter(labels, lengths, rng, high):
+    n = len(labels)
+    first = rng.integers(0, len(_BY_LETTER), size=n)
+    letter_ids = _FIRST_LETTER_ID[first]
+    words = np.where(labels[:, None], _same_letter(rng, letter_ids, high), _other_letter(rng, letter_ids, high))
+    words[:, 0] = _BY_LETTER[first]
+    # move the anchor word to a random position
+    pos = random_positions(rng, lengths)
+    rows = np.arange(n)
+    words[rows, 0], words[rows, pos] = words[rows, pos], words[rows, 0]
+    return join_rows(words, lengths)
+
+def sorted_words_starting_letters(labels, lengths, rng, high):
+    n = len(labels)
+    words = ALL.sample(rng, n, high)
+    # padding beyond a row's length sorts last, so it never affects the order of the row
+    keys = np.array([[w[0] for w in row] for row in words.tolist()], dtype="<U1")
+    keys[np.arange(high)[None, :] >= lengths[:, None]] = "\uffff"
+    order = np.argsort(keys, axis=1, kind="stable")
+    words[labels] = np.take_along_axis(words, order, axis=1)[labels]
+    out = join_rows(words, lengths)
+    # negatives that came out sorted by chance get one adjacent swap, as in the scalar generator
+    in_order = (keys[:, :-1] <= keys[:, 1:]).all(axis=1)
+    for i in np.flatnonzero(~labels & in_order):
+        row = words[i, :lengths[i]].tolist()
+        if len({w[0] for w in row}) == 1:
+            row[-1] = _other_letter(rng, np.array([_LETTER_ID[row[0][0]]]), 1)[0, 0]
+        if sorted(row, key=lambda w: w[0]) == row:
+            swaps = [j for j in range(1, len(row)) if row[j-1][0] != row[j][0]]
+            j = swaps[rng.integers(0, len(swaps))]
+            row[j-1], row[j] = row[j], row[j-1]
+        out[i] = " ".join(row)
+    return out
+
+def is_palindrome(labels, lengths, rng, high):
+    n = len(labels)
+    letters = np.array(list(LETTERS), dtype=object)
+    halves = (lengths + 1) // 2
+    h = (high + 1) // 2
+    first = letters[rng.integers(0, 26, size=(n, h))]
+    second = letters[rng.integers(0, 26, size=(n, h))]
+    out = []
+    for i, (label, k) in enumerate(zip(labels.tolist(), halves.tolist())):
+        row = first[i, :k].tolist()
+        if label:
+            row = row + row[::-1]
+        else:
+            row = row + second[i, :k].tolist()
+            if row == row[::-1]:
+                row[-1] = LETTERS[(LETTERS.index(row[0]) + 1 + int(rng.integers(0, 25))) % 26]
+        out.append(" ".join(row))
+    return out
+
+def is_even_length(labels, lengths, rng, high):
+    lengths = np.where((lengths % 2 == 0) != labels, lengths + 1, lengths)
+    words = ALL.sample(rng, len(labels), high + 1)
+    return join_rows(words, lengths)
+
+def all_words_start_with_vowel(labels, lengths, rng, high):
+    n = len(labels)
+    words = np.where(labels[:, None], VOWEL_START.sample(rng, n, high), ALL.sample(rng, n, high))
+    is_vowel = np.array([[w[0].lower() in VOWELS for w in row] for row in words.tolist()])
+    is_vowel[np.arange(high)[None, :] >= lengths[:, None]] = True
+    rows = np.flatnonzero(~labels & is_vowel.all(axis=1))
+    words[rows, random_positions(rng, lengths[rows])] = CONSONANT_START.choice(rng, len(rows))
+    return join_rows(words, lengths)
+
+def is_tab_separator(labels, lengths, rng, high):
+    words = ALL.sample(rng, len(labels), high)
+    return join_rows(words, lengths, np.where(labels, "\t", " "))
+
+BATCH_GENERATORS = {
+    "contains_digit": contains_digit,
+    "contains_digit_at_first": contains_digit_at_first,
+    "contains_word": contains_word,
+    "contains_duplicate": contains_duplicate,
+    "contains_only_words_with_same_starting_letter": contains_only_words_with_same_starting_letter,
+    "sorted_words_starting_letters": sorted_words_starting_letters,
+    "is_palindrome": is_palindrome,
+    "is_even_length": is_even_length,
+    "all_words_start_with_vowel": all_words_start_with_vowel,
+    "is_tab_separator": is_tab_separator,
+}
+# declarative rules (tasks.DSL_RULES) are sampled from their precomputed pools and have no batch generator
+assert BATCH_GENERATORS.keys() == set(CORE_RULES)
+
+def synthesize_batch(rule_name: str, n: int, seed: int = 0, low: int = 4, high: int = 8, offset: int = 0) -> tuple[list[str], np.ndarray]:
+    """Vectorized `tasks.synthesize`: `n` inputs with alternating True/False labels, starting with True at even `offset`."""
+    rng = np.random.default_rng(seed)
+    labels = (np.arange(offset, offset + n) % 2) == 0
+    lengths = rng.integers(low, high + 1, size=n)
+    return BATCH_GENERATORS[rule_name](labels, lengths, rng, high), labels
+
+def iter_synthesize(rule_name: str, n: int, seed: int = 0, chunk_size: int = 100_000, **kwargs):
+    """Yield `synthesize_batch` chunks until `n` examples were produced; chunk i is seeded with (seed, i)."""
+    for i, start in enumerate(range(0, n, chunk_size)):
+        yield synthesize_batch(rule_name, min(chunk_size, n - start), seed=[seed, i], offset=start, **kwargs)
@@ -0,0 +1,375 @@
+import math
+import time
+import heapq
+import bisect
+import asyncio
+import contextlib
+import itertools
+import collections
+
+# Per-model admission control for API requests. Each model gets a concurrency limit that grows
+# additively while requests succeed and is cut multiplicatively on 429s or when latency climbs
+# (AIMD), optional token buckets for requests/s and tokens/min, and a priority queue so that
+# requests which unblock a step (e.g. the articulation before its verifier call) go first.
+# The limiter also keeps a window of recent latencies, from which `hedge_delay` tells when a request
+# has become a straggler worth duplicating, and a budget for those duplicates (`try_hedge`).
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 10
+
+class RateLimitError(Exception):
+    def __init__(self, message: str = "rate limited", retry_after: float | None = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def is_rate_limit_error(e: BaseException) -> bool:
+    """Whether `e` (or an exception it was raised from) signals HTTP 429 / rate limiting."""
+    while e is not None:
+        if isinstance(e, RateLimitError) or getattr(e, "status_code", None) == 429:
+            return True
+        text = str(e).lower()
+        if "429" in text or "rate limit" in text or "rate_limit" in text:
+            return True
+        e = e.__cause__ or e.__context__
+    return False
+
+def retry_after(e: BaseException) -> float | None:
+    while e is not None:
+        if getattr(e, "retry_after", None) is not None:
+            return float(e.retry_after)
+        headers = getattr(getattr(e, "response", None), "headers", None)
+        if headers and headers.get("retry-after"):
+            try:
+                return float(headers["retry-after"])
+            except ValueError:
+                pass
+        e = e.__cause__ or e.__context__
+    return None
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until `amount` tokens are available (0 if they are now)."""
+        self._refill()
+        amount = min(amount, self.capacity)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def take(self, amount: float):
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+
+class ModelLimiter:
+    def __init__(
+        self,
+        concurrency: int = 100,
+        min_concurrency: int = 1,
+        max_concurrency: int = 400,
+        rps: float | None = None,
+        tpm: float | None = None,
+        backoff: float = 0.5,
+        latency_tolerance: float = 2.0,
+        latency_window: int = 200,
+        min_hedge_samples: int = 20,
+    ):
+        self.limit = float(concurrency)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.rps = rps
+        self.requests = TokenBucket(rps) if rps else None
+        self.tokens = TokenBucket(tpm / 60, capacity=tpm) if tpm else None
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self._waiters = []
+        self._seq = itertools.count()
+        self._timer = None
+        # statistics
+        self.n_ok = 0
+        self.n_rate_limited = 0
+        self.n_failed = 0
+        self.latency_short = None
+        self.latency_long = None
+        self.tokens_done = 0
+        self.started = time.monotonic()
+        self.latencies = collections.deque(maxlen=latency_window)
+        self.min_hedge_samples = min_hedge_samples
+        self._sorted_latencies = None
+        self._hedge_starts = []
+        self.n_hedgeable = 0
+        self.n_hedged = 0
+        self.hedges_in_flight = 0
+
+    async def acquire(self, priority: int = PRIORITY_NORMAL, tokens: float = 0):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), tokens, future))
+        self._wake()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        self.in_flight -= 1
+        self._wake()
+
+    def hedge_delay(self, q: float) -> float | None:
+        """The `q`-th percentile of recent latencies, or None while it cannot be trusted yet.
+
+        Requests finish fastest first, so while a wave is in flight the completed ones underestimate
+        the percentile; it is only used once at most 100 - q % of the requests (completed or still in
+        flight) have been running for longer.
+        """
+        if len(self.latencies) < self.min_hedge_samples:
+            return None
+        if self._sorted_latencies is None:
+            self._sorted_latencies = sorted(self.latencies)
+        values = self._sorted_latencies
+        delay = values[min(len(values) - 1, int(len(values) * q / 100))]
+        overdue = bisect.bisect_right(self._hedge_starts, time.monotonic() - delay)
+        if overdue > (1 - q / 100) * (len(values) + overdue):
+            return None
+        return delay
+
+    def hedge_started(self) -> float:
+        self.n_hedgeable += 1
+        started = time.monotonic()
+        self._hedge_starts.append(started)
+        return started
+
+    def hedge_finished(self, started: float):
+        del self._hedge_starts[bisect.bisect_left(self._hedge_starts, started)]
+
+    def try_hedge(self, budget: float) -> bool:
+        """Take a slot for a duplicate request if duplicates stay within `budget` (a fraction of the
+        hedgeable requests); it is given back with `release_hedge`.
+
+        A duplicate takes a free slot if no request is waiting for one, and otherwise one of
+        `ceil(budget * limit)` slots reserved for duplicates on top of the limit: a step's stragglers
+        are stuck exactly while other steps keep the queue full.
+        """
+        if time.monotonic() < self.cooldown_until or self.n_hedged + 1 > budget * self.n_hedgeable:
+            return False
+        free = not self._waiters and self.in_flight < int(self.limit)
+        if not free and self.hedges_in_flight >= math.ceil(budget * self.limit):
+            return False
+        if self.requests is not None:
+            if self.requests.wait_time(1) > 0:
+                return False
+            self.requests.take(1)
+        self.n_hedged += 1
+        self.hedges_in_flight += 1
+        self.in_flight += 1
+        return True
+
+    def release_hedge(self):
+        self.hedges_in_flight -= 1
+        self.release()
+
+    def _wake(self):
+        now = time.monotonic()
+        while self._waiters:
+            priority, _, tokens, future = self._waiters[0]
+            if future.cancelled():
+                heapq.heappop(self._waiters)
+                continue
+            if self.in_flight >= int(self.limit):
+                return
+            delay = self.cooldown_until - now
+            if self.requests is not None:
+                delay = max(delay, self.requests.wait_time(1))
+            if self.tokens is not None:
+                delay = max(delay, self.tokens.wait_time(tokens))
+            if delay > 0:
+                self._schedule(delay)
+                return
+            heapq.heappop(self._waiters)
+            if self.requests is not None:
+                self.requests.take(1)
+            if self.tokens is not None:
+                self.tokens.take(tokens)
+            self.in_flight += 1
+            future.set_result(None)
+
+    def _schedule(self, delay: float):
+        if self._timer is not None and not self._timer.cancelled():
+            return
+        def fire():
+            self._timer = None
+            self._wake()
+        self._timer = asyncio.get_running_loop().call_later(delay, fire)
+
+    def on_success(self, latency: float, tokens: int = 0):
+        self.n_ok += 1
+        self.tokens_done += tokens
+        self.latency_short = latency if self.latency_short is None else 0.8 * self.latency_short + 0.2 * latency
+        self.latency_long = latency if self.latency_long is None else 0.98 * self.latency_long + 0.02 * latency
+        self.latencies.append(latency)
+        self._sorted_latencies = None
+        if self.requests is not None and self.requests.rate < self.rps:
+            # additive increase back to the configured rate after 429s cut it: about 5% of it per second
+            self.requests.rate = min(self.rps, self.requests.rate + 0.05 * self.rps / self.requests.rate)
+        if self.latency_short > self.latency_tolerance * self.latency_long:
+            # requests queue up at the provider: back off before it starts returning 429s
+            self.limit = max(self.min_concurrency, self.limit * 0.9)
+        else:
+            self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+        self._wake()
+
+    def on_rate_limited(self, retry_after: float | None = None):
+        self.n_rate_limited += 1
+        self.limit = max(self.min_concurrency, self.limit / 2)
+        if self.requests is not None:
+            self.requests.rate = max(0.1, self.requests.rate * 0.7)
+        self.cooldown_until = max(self.cooldown_until, time.monotonic() + (retry_after if retry_after is not None else self.backoff))
+        self._wake()
+
+    def on_failure(self):
+        self.n_failed += 1
+
+    def stats(self) -> dict:
+        elapsed = time.monotonic() - self.started
+        return {
+            "concurrency_limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "queued": len(self._waiters),
+            "ok": self.n_ok,
+            "rate_limited": self.n_rate_limited,
+            "failed": self.n_failed,
+            "latency_ewma": self.latency_short,
+            "hedged": self.n_hedged,
+            "tokens_per_second": self.tokens_done / elapsed if elapsed > 0 else 0.0,
+        }
+
+class Slot:
+    def __init__(self, limiter: ModelLimiter):
+        self.limiter = limiter
+        self.started = time.monotonic()
+        self.reported = False
+
+    def succeeded(self, tokens: int = 0):
+        self.reported = True
+        self.limiter.on_success(time.monotonic() - self.started, tokens)
+
+    def rate_limited(self, retry_after: float | None = None):
+        self.reported = True
+        self.limiter.on_rate_limited(retry_after)
+
+    def failed(self):
+        self.reported = True
+        self.limiter.on_failure()
+
+class Scheduler:
+    """Per-model `ModelLimiter`s; limits for a model can be set with `configure` before first use."""
+
+    def __init__(self, **defaults):
+        self.defaults = defaults
+        self.overrides = {}
+        self.limiters = {}
+
+    def configure(self, model: str, **limits):
+        self.overrides[model] = limits
+        self.limiters.pop(model, None)
+
+    def limiter(self, model: str) -> ModelLimiter:
+        if model not in self.limiters:
+            self.limiters[model] = ModelLimiter(**{**self.defaults, **self.overrides.get(model, {})})
+        return self.limiters[model]
+
+    @contextlib.asynccontextmanager
+    async def slot(self, model: str, priority: int = PRIORITY_NORMAL, tokens: float = 0):
+        limiter = self.limiter(model)
+        await limiter.acquire(priority, tokens)
+        slot = Slot(limiter)
+        try:
+            yield slot
+        except BaseException as e:
+            if not slot.reported:
+                slot.rate_limited(retry_after(e)) if is_rate_limit_error(e) else slot.failed()
+            raise
+        finally:
+            limiter.release()
+
+    def stats(self) -> dict:
+        return {model: limiter.stats() for model, limiter in self.limiters.items()}
+
+class FakeEndpoint:
+    """Local stand-in for a provider with a hidden concurrency and request-rate ceiling that answers
+    with 429s (and a retry-after) whenever either is exceeded."""
+
+    def __init__(self, concurrency: int = 60, rps: float = 400, latency: float = 0.05, retry_after: float = 0.2):
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(rps)
+        self.latency = latency
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.n_429 = 0
+
+    async def __call__(self):
+        if self.in_flight >= self.concurrency or self.bucket.wait_time(1) > 0:
+            self.n_429 += 1
+            await asyncio.sleep(0.005)
+            raise RateLimitError("429 Too Many Requests", retry_after=self.retry_after)
+        self.bucket.take(1)
+        self.in_flight += 1
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self.in_flight -= 1
+
+async def simulate(n_requests: int = 3000, adaptive: bool = True, max_retries: int = 50, **endpoint) -> dict:
+    """Push `n_requests` through the scheduler (or a fixed Semaphore(100) with blind retries) against a `FakeEndpoint`."""
+    endpoint = FakeEndpoint(**endpoint)
+    scheduler = Scheduler(concurrency=100)
+    semaphore = asyncio.Semaphore(100)
+
+    async def one():
+        for attempt in range(max_retries):
+            try:
+                if adaptive:
+                    async with scheduler.slot("fake") as slot:
+                        await endpoint()
+                        slot.succeeded()
+                else:
+                    async with semaphore:
+                        await endpoint()
+                return True
+            except RateLimitError:
+                if not adaptive:
+                    await asyncio.sleep(0.05 * 2 ** min(attempt, 5))
+        return False
+
+    start = time.perf_counter()
+    done = await asyncio.gather(*[one() for _ in range(n_requests)])
+    wall = time.perf_counter() - start
+    return {
+        "scheduler": "adaptive" if adaptive else "Semaphore(100)",
+        "completed": sum(done),
+        "wall_seconds": round(wall, 2),
+        "requests_per_second": round(sum(done) / wall, 1),
+        "responses_429": endpoint.n_429,
+        **({"final_limit": int(scheduler.limiter("fake").limit)} if adaptive else {}),
+    }
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Compare the adaptive scheduler with a fixed semaphore against a rate-limiting fake endpoint.")
+    parser.add_argument("--n_requests", type=int, default=3000)
+    parser.add_argument("--concurrency", type=int, default=60)
+    parser.add_argument("--rps", type=float, default=400)
+    parser.add_argument("--latency", type=float, default=0.05)
+    args = parser.parse_args()
+    for adaptive in (False, True):
+        print(asyncio.run(simulate(args.n_requests, adaptive=adaptive, concurrency=args.concurrency, rps=args.rps, latency=args.latency)))
@@ -1,12 +1,146 @@
+import os
+import gzip
+import json
 import random
+import hashlib
+import tempfile
+import threading
 from functools import partial
 from collections import Counter
-from nltk.metrics import edit_distance
 
-from utils import get_few_shot_prompt
+from rule_dsl import CompiledRule, RuleSpec, Some, Every, At, EvenCount, Palindrome, Duplicate, Sorted, Not, StartsWith, EndsWith, Contains, Equals, IsDigit, Length
 
-from wordfreq import top_n_list
-WORDS = top_n_list('en', 1000)
+# Only the standard library is imported here, so that workers and the notebook can import the rules
+# cheaply; the API client (utils) and the edit-distance index are loaded on first use.
+
+# frozen snapshot of wordfreq's `top_n_list("en", 1000)`, so the data does not change with wordfreq
+# releases; regenerate with
+#   python -c "from wordfreq import top_n_list; print('\\n'.join(top_n_list('en', 1000)))" > vocabulary.txt
+VOCABULARY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "vocabulary.txt")
+with open(VOCABULARY_PATH, encoding="utf-8") as f:
+    WORDS = f.read().split()
+
+LETTERS = "abcdefghijklmnopqrstuvwxyz"
+VOWELS = set('aeiou')
+
+class WordIndex:
+    """Partitions of a vocabulary, built once, so generators can sample directly instead of rejecting."""
+
+    def __init__(self, words: list[str]):
+        self.words = words
+        self.no_digit = [w for w in words if not any(c.isdigit() for c in w)]
+        self.vowel_start = [w for w in words if w[0].lower() in VOWELS]
+        self.consonant_start = [w for w in words if w[0].lower() not in VOWELS]
+        self.by_first_letter = {}
+        for w in words:
+            self.by_first_letter.setdefault(w[0], []).append(w)
+        self._not_first_letter = {}
+        self._excluding = {}
+
+    def starting_with(self, letter: str) -> list[str]:
+        return self.by_first_letter.get(letter, [])
+
+    def not_starting_with(self, letter: str) -> list[str]:
+        if letter not in self._not_first_letter:
+            self._not_first_letter[letter] = [w for w in self.words if not w.startswith(letter)]
+        return self._not_first_letter[letter]
+
+    def excluding(self, substring: str) -> list[str]:
+        if substring not in self._excluding:
+            self._excluding[substring] = [w for w in self.words if substring not in w]
+        return self._excluding[substring]
+
+WORD_INDEX = WordIndex(WORDS)
+
+def edit_distance(a: str, b: str) -> int:
+    """Levenshtein distance (unit cost insertions, deletions and substitutions)."""
+    if len(a) < len(b):
+        a, b = b, a
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i]
+        for j, cb in enumerate(b, 1):
+            cur.append(min(prev[j] + 1, cur[j-1] + 1, prev[j-1] + (ca != cb)))
+        prev = cur
+    return prev[-1]
+
+class NeighbourIndex:
+    """BK-tree over a vocabulary for "close but different word" lookups under edit distance.
+
+    Nearest-neighbour sets are memoized, so repeated lookups are a dict access plus a seeded choice;
+    a cold lookup traverses the tree (~4 ms for `WORDS`).
+    """
+
+    def __init__(self, words: list[str]):
+        self.words = list(dict.fromkeys(words))
+        self.root = (self.words[0], {})
+        for w in self.words[1:]:
+            self._add(w)
+        self._nearest = {}
+
+    def _add(self, word: str):
+        node = self.root
+        while True:
+            d = edit_distance(word, node[0])
+            child = node[1].get(d)
+            if child is None:
+                node[1][d] = (word, {})
+                return
+            node = child
+
+    def _search(self, word: str, exclude: frozenset) -> list[str]:
+        best, found = float("inf"), []
+        stack = [(self.root, 0, 0)]
+        while stack:
+            (w, children), k, d_parent = stack.pop()
+            if abs(d_parent - k) > best:
+                continue
+            d = edit_distance(word, w)
+            if w not in exclude:
+                if 0 < d < best:
+                    best, found = d, [w]
+                elif d == best:
+                    found.append(w)
+            for k, child in children.items():
+                stack.append((child, k, d))
+        return sorted(found)
+
+    def nearest(self, word: str, exclude: frozenset = frozenset()) -> list[str]:
+        """All vocabulary words outside `exclude` at the smallest non-zero edit distance from `word`, sorted."""
+        if word not in self._nearest:
+            self._nearest[word] = self._search(word, frozenset())
+        found = [w for w in self._nearest[word] if w not in exclude]
+        # only searches that exclude every nearest neighbour need a fresh traversal
+        return found or self._search(word, frozenset(exclude))
+
+    def substitute(self, word: str, rng: random.Random, exclude: frozenset = frozenset()) -> str:
+        """A nearest different word outside `exclude`, ties broken by `rng`."""
+        return rng.choice(self.nearest(word, exclude))
+
+    def table(self) -> dict[str, list[str]]:
+        """The nearest neighbours of every vocabulary word."""
+        return {w: self.nearest(w) for w in self.words}
+
+_NEIGHBOURS = None
+_NEIGHBOURS_LOCK = threading.Lock()
+
+def neighbours() -> NeighbourIndex:
+    """The `NeighbourIndex` over `WORDS` with the nearest neighbours of every word precomputed.
+
+    The table costs a tree search per word (~5 s), so it is stored in `DATASET_DIR` like the datasets
+    and read back by later runs and by the counterfactual worker processes. Only lookups whose nearest
+    neighbours are all excluded still traverse the tree.
+    """
+    global _NEIGHBOURS
+    with _NEIGHBOURS_LOCK:
+        if _NEIGHBOURS is None:
+            h = hashlib.sha256()
+            for part in (_fingerprint(NeighbourIndex), _fingerprint(edit_distance), "\n".join(WORDS)):
+                h.update(part.encode())
+            index = NeighbourIndex(WORDS)
+            index._nearest.update(_stored(f"neighbours-{h.hexdigest()[:32]}", index.table))
+            _NEIGHBOURS = index
+    return _NEIGHBOURS
 
 DIGIT_TO_WORD = {
     "0": "zero",
@@ -23,10 +157,7 @@ DIGIT_TO_WORD = {
 
 def contains_digit(label: bool, rng: random.Random, low: int= 4, high: int= 8) -> str:
     L = rng.randint(low, high)
-    sampled_words = random.sample(WORDS, L)
-    for i in range(len(sampled_words)):
-        while sampled_words[i].isdigit():
-            sampled_words[i] = random.choice(WORDS)
+    sampled_words = rng.sample(WORD_INDEX.no_digit, L)
     if label:
         sampled_words[-1] = str(rng.randint(0,9))
     rng.shuffle(sampled_words)
@@ -48,11 +179,11 @@ def contains_digit_counterfactual(word_sequence: str, label: bool, rng: random.R
 
 def contains_digit_at_first(label: bool, rng: random.Random, low: int= 4, high: int= 8) -> str:
     L = rng.randint(low, high)
-    sampled_words = random.sample(WORDS, L)
+    sampled_words = rng.sample(WORD_INDEX.no_digit, L)
+    # sprinkle a few digits behind the first word only, so negatives never start with a digit
     for i in range(1, len(sampled_words)):
-        if random.random() < 0.02:
+        if rng.random() < 0.02:
             sampled_words[i] = str(rng.randint(0,9))
-    rng.shuffle(sampled_words)
     if label:
         sampled_words[0] = str(rng.randint(0,9))
     s = " ".join(sampled_words)
@@ -68,10 +199,7 @@ def contains_digit_at_first_counterfactual(word_sequence: str, label: bool, rng:
 
 def contains_word(label: bool, rng: random.Random, low: int= 4, high: int= 8) -> str:
     L = rng.randint(low, high)
-    sampled_words = random.sample(WORDS, L)
-    for i in range(len(sampled_words)):
-        while "cat" in sampled_words[i]:
-            sampled_words[i] = random.choice(WORDS)
+    sampled_words = rng.sample(WORD_INDEX.excluding("cat"), L)
     if label:
         sampled_words[-1] = "cat"
     rng.shuffle(sampled_words)
@@ -86,12 +214,12 @@ def contains_word_counterfactual(word_sequence: str, label: bool, rng: random.Ra
     else:
         for i in range(len(words)):
             while "cat" in words[i]:
-                words[i] = random.choice(["feline", "kitty", "tabby", "kitten"])
+                words[i] = rng.choice(["feline", "kitty", "tabby", "kitten"])
     return " ".join(words)
 
 def contains_duplicate(label: bool, rng: random.Random, low: int= 4, high: int= 8) -> str:
     L = rng.randint(low, high)
-    sampled_words = random.sample(WORDS, L)
+    sampled_words = rng.sample(WORDS, L)
     if label:
         sampled_words[-1] = sampled_words[0]
     rng.shuffle(sampled_words)
@@ -109,32 +237,25 @@ def contains_duplicate_counterfactual(word_sequence: str, label: bool, rng: rand
         counter = Counter(words)
         for word, count in counter.items():
             if count > 1:
-                min_edit_distance = float('inf')
-                replacement = ""
-                all_words = WORDS.copy()
-                rng.shuffle(all_words)
-                for w in all_words:
-                    if w != word and edit_distance(word, w) < min_edit_distance:
-                        min_edit_distance = edit_distance(word, w)
-                        replacement = w
-                    if min_edit_distance == 1:
-                        break
+                # must not collide with another word, or the sequence would keep a duplicate
+                replacement = neighbours().substitute(word, rng, exclude=frozenset(words))
                 words[rng.choice([i for i, w in enumerate(words) if w == word])] = replacement
     return " ".join(words)
 
 def contains_only_words_with_same_starting_letter(label: bool, rng: random.Random, low: int= 4, high: int= 8) -> str:
     L = rng.randint(low, high)
-    sampled_words = random.sample(WORDS, L)
+    sampled_words = rng.sample(WORDS, L)
+    first_letter = sampled_words[0][0]
     if label:
-        first_letter = sampled_words[0][0]
+        candidates = WORD_INDEX.starting_with(first_letter)
         for i in range(1, L):
-            while not sampled_words[i].startswith(first_letter):
-                sampled_words[i] = random.choice(WORDS)
+            if not sampled_words[i].startswith(first_letter):
+                sampled_words[i] = rng.choice(candidates)
     else:
-        first_letter = sampled_words[0][0]
+        candidates = WORD_INDEX.not_starting_with(first_letter)
         for i in range(1, L):
-            while sampled_words[i].startswith(first_letter):
-                sampled_words[i] = random.choice(WORDS)
+            if sampled_words[i].startswith(first_letter):
+                sampled_words[i] = rng.choice(candidates)
     rng.shuffle(sampled_words)
     s = " ".join(sampled_words)     
     return s
@@ -144,24 +265,30 @@ def contains_only_words_with_same_starting_letter_counterfactual(word_sequence:
     if label is True:
         first_letter = words[0][0]
         for i in range(1, len(words)):
-            while not words[i].startswith(first_letter):
-                words[i] = random.choice(WORDS)
+            if not words[i].startswith(first_letter):
+                words[i] = rng.choice(WORD_INDEX.starting_with(first_letter))
         rng.shuffle(words)
     else:
         first_letter = words[0][0]
         rand_index = rng.randint(0, len(words)-1)
-        while words[rand_index].startswith(first_letter):
-            words[rand_index] = random.choice(WORDS)
+        if words[rand_index].startswith(first_letter):
+            words[rand_index] = rng.choice(WORD_INDEX.not_starting_with(first_letter))
     return " ".join(words)
 
 def sorted_words_starting_letters(label: bool, rng: random.Random, low: int= 4, high: int= 8) -> list[str]:
     L = rng.randint(low, high)
-    sampled_words = random.sample(WORDS, L)
+    sampled_words = rng.sample(WORDS, L)
     if label:
         sampled_words = sorted(sampled_words, key=lambda w: w[0])
     else:
-        while sorted(sampled_words, key=lambda w: w[0]) == sampled_words:
-            random.shuffle(sampled_words)
+        if len({w[0] for w in sampled_words}) == 1:
+            # no order of words with a single starting letter is unsorted
+            sampled_words[-1] = rng.choice(WORD_INDEX.not_starting_with(sampled_words[0][0]))
+        if sorted(sampled_words, key=lambda w: w[0]) == sampled_words:
+            # swapping any adjacent pair with different starting letters breaks the order
+            swaps = [i for i in range(1, L) if sampled_words[i-1][0] != sampled_words[i][0]]
+            i = rng.choice(swaps)
+            sampled_words[i-1], sampled_words[i] = sampled_words[i], sampled_words[i-1]
     return " ".join(sampled_words)
 
 def sorted_words_starting_letters_counterfactual(word_sequence: str, label: bool, rng: random.Random) -> str:
@@ -169,19 +296,28 @@ def sorted_words_starting_letters_counterfactual(word_sequence: str, label: bool
     if label is True:
         words = sorted(words, key=lambda w: w[0])
     else:
-        rand_index = rng.randint(1, len(words)-1)
-        words[rand_index], words[rand_index-1] = words[rand_index-1], words[rand_index]
+        # swapping two neighbours only breaks the order if their starting letters differ
+        swaps = [i for i in range(1, len(words)) if words[i-1][0] != words[i][0]]
+        if swaps:
+            rand_index = rng.choice(swaps)
+            words[rand_index], words[rand_index-1] = words[rand_index-1], words[rand_index]
+        else:
+            replacement = rng.choice(WORD_INDEX.not_starting_with(words[0][0]))
+            if replacement[0] > words[0][0]:
+                words[0] = replacement
+            else:
+                words[-1] = replacement
     return " ".join(words)
 
 def is_palindrome(label: bool, rng: random.Random, low: int= 4, high: int= 8) -> str:
     L = rng.randint(low, high)
-    sampled_words = random.choices("abcdefghijklmnopqrstuvwxyz", k=(L+1)//2)
+    sampled_words = rng.choices(LETTERS, k=(L+1)//2)
     if label:
         palin_words = sampled_words + sampled_words[::-1]
     else:
-        palin_words = sampled_words + random.choices("abcdefghijklmnopqrstuvwxyz", k=(L+1)//2)
-        while palin_words == palin_words[::-1]:
-            palin_words[-1] = random.choice("abcdefghijklmnopqrstuvwxyz")
+        palin_words = sampled_words + rng.choices(LETTERS, k=(L+1)//2)
+        if palin_words == palin_words[::-1]:
+            palin_words[-1] = rng.choice(LETTERS.replace(palin_words[0], ""))
     return " ".join(palin_words)
 
 def is_palindrome_counterfactual(word_sequence: str, label: bool, rng: random.Random) -> str:
@@ -191,9 +327,7 @@ def is_palindrome_counterfactual(word_sequence: str, label: bool, rng: random.Ra
         words = words[:half] + words[:half][::-1]
     else:
         rand_index = rng.randint(0, len(words)-1)
-        prev_char = words[rand_index]
-        while words[rand_index] == prev_char:
-            words[rand_index] = random.choice("abcdefghijklmnopqrstuvwxyz")
+        words[rand_index] = rng.choice(LETTERS.replace(words[rand_index], ""))
     return " ".join(words)
 
 def is_even_length(label: bool, rng: random.Random, low: int= 4, high: int= 8) -> str:
@@ -204,7 +338,7 @@ def is_even_length(label: bool, rng: random.Random, low: int= 4, high: int= 8) -
     else:
         if L % 2 == 0:
             L += 1
-    sampled_words = random.sample(WORDS, L)
+    sampled_words = rng.sample(WORDS, L)
     s = " ".join(sampled_words)     
     return s
 
@@ -212,43 +346,39 @@ def is_even_length_counterfactual(word_sequence: str, label: bool, rng: random.R
     words = word_sequence.split()
     if label is True:
         if len(words) % 2 != 0:
-            words.append(random.choice(WORDS))
+            words.append(rng.choice(WORDS))
     else:
         if len(words) % 2 == 0:
-            words.append(random.choice(WORDS))
+            words.append(rng.choice(WORDS))
     return " ".join(words)
 
 def all_words_start_with_vowel(label: bool, rng: random.Random, low: int= 4, high: int= 8) -> str:
     L = rng.randint(low, high)
-    sampled_words = random.sample(WORDS, L)
-    vowels = set('aeiou')
     if label:
-        for i in range(L):
-            while sampled_words[i][0].lower() not in vowels:
-                sampled_words[i] = random.choice(WORDS)
+        sampled_words = rng.sample(WORD_INDEX.vowel_start, L)
     else:
-        while all(sampled_words[i][0].lower() in vowels for i in range(L)):
-            sampled_words = random.sample(WORDS, L)
+        sampled_words = rng.sample(WORDS, L)
+        if all(w[0].lower() in VOWELS for w in sampled_words):
+            sampled_words[-1] = rng.choice(WORD_INDEX.consonant_start)
     rng.shuffle(sampled_words)
     s = " ".join(sampled_words)     
     return s
 
 def all_words_start_with_vowel_counterfactual(word_sequence: str, label: bool, rng: random.Random) -> str:
     words = word_sequence.split()
-    vowels = set('aeiou')
     if label is True:
         for i in range(len(words)):
-            while words[i][0].lower() not in vowels:
-                words[i] = random.choice(WORDS)
+            if words[i][0].lower() not in VOWELS:
+                words[i] = rng.choice(WORD_INDEX.vowel_start)
     else:
         rand_index = rng.randint(0, len(words)-1)
-        while words[rand_index][0].lower() in vowels:
-            words[rand_index] = random.choice(WORDS)
+        if words[rand_index][0].lower() in VOWELS:
+            words[rand_index] = rng.choice(WORD_INDEX.consonant_start)
     return " ".join(words)
 
 def is_tab_separator(label: bool, rng: random.Random, low: int= 4, high: int= 8) -> str:
     L = rng.randint(low, high)
-    sampled_words = random.sample(WORDS, L)
+    sampled_words = rng.sample(WORDS, L)
     if label:
         s = "\t".join(sampled_words)     
     else:
@@ -329,6 +459,60 @@ RULES_ALTERNATIVES_CHOICES = {
     ],
 }
 
+# ground-truth predicates, one per entry in RULES
+PREDICATES = {
+    "contains_digit": lambda s: any(c.isdigit() for c in s),
+    "contains_digit_at_first": lambda s: s.split()[0].isdigit(),
+    "contains_word": lambda s: "cat" in s.split(),
+    "contains_duplicate": lambda s: len(set(s.split())) < len(s.split()),
+    "contains_only_words_with_same_starting_letter": lambda s: len({w[0] for w in s.split()}) == 1,
+    "sorted_words_starting_letters": lambda s: all(a[0] <= b[0] for a, b in zip(s.split(), s.split()[1:])),
+    "is_palindrome": lambda s: s.split() == s.split()[::-1],
+    "is_even_length": lambda s: len(s.split()) % 2 == 0,
+    "all_words_start_with_vowel": lambda s: all(w[0].lower() in VOWELS for w in s.split()),
+    "is_tab_separator": lambda s: "\t" in s and " " not in s,
+}
+assert PREDICATES.keys() == RULES.keys()
+
+# the hand-written rules above; the declarative ones below are compiled by rule_dsl
+CORE_RULES = tuple(RULES)
+ALPHABETS = {"words": WORDS, "letters": list(LETTERS), "digits": list("0123456789")}
+
+# specs of the declarative rules, by name
+SPECS = {}
+
+def register(spec: RuleSpec) -> CompiledRule:
+    """Compile a declarative rule and add it to RULES, RULES_ALTERNATIVES_CHOICES and PREDICATES."""
+    if spec.name in RULES:
+        raise ValueError(f"rule {spec.name!r} already exists")
+    rule = CompiledRule(spec, ALPHABETS)
+    SPECS[spec.name] = spec
+    RULES[spec.name] = (rule.sample, rule.description, rule.counterfactual)
+    RULES_ALTERNATIVES_CHOICES[spec.name] = rule.distractors
+    PREDICATES[spec.name] = rule.predicate
+    return rule
+
+DSL_RULES = [
+    *(RuleSpec(f"any_word_starts_with_{c}", Some(StartsWith(c))) for c in "bcdfmpst"),
+    *(RuleSpec(f"all_words_end_with_{c}", Every(EndsWith(c))) for c in "dersty"),
+    *(RuleSpec(f"all_words_at_most_{n}_letters", Every(Length(1, n))) for n in (3, 4, 5, 6)),
+    *(RuleSpec(f"even_number_of_words_with_{c}", EvenCount(Contains(c))) for c in "aeiou"),
+    RuleSpec("first_word_starts_with_vowel", At(StartsWith("aeiou"), 0)),
+    RuleSpec("last_word_ends_with_vowel", At(EndsWith("aeiou"), -1)),
+    RuleSpec("last_word_is_digit", At(IsDigit(), -1), alphabet="words+digits"),
+    RuleSpec("at_least_two_digits", Some(IsDigit(), 2), alphabet="words+digits"),
+    RuleSpec("no_word_contains_e", Not(Some(Contains("e")))),
+    RuleSpec("sorted_words_lengths", Sorted("length")),
+    RuleSpec("at_least_three_words_with_o", Some(Contains("o"), 3)),
+    RuleSpec("second_word_at_least_6_letters", At(Length(6), 1)),
+    RuleSpec("letters_even_number_of_vowels", EvenCount(StartsWith("aeiou")), alphabet="letters", unit="letter", description="Label True iff the input contains an even number of vowels (a, e, i, o, u)."),
+    RuleSpec("comma_separated_contains_the", Some(Equals("the")), separator=","),
+]
+for spec in DSL_RULES:
+    register(spec)
+# what a freshly imported tasks module (e.g. in a worker process) defines
+IMPORTED_RULES = frozenset(RULES)
+
 def synthesize(rule_name:str, n:int, seed:int=0)->list:
     rng = random.Random(seed)
     gen, rule, gen_cf = RULES[rule_name]
@@ -339,15 +523,192 @@ def synthesize(rule_name:str, n:int, seed:int=0)->list:
         out.append((s, y))
     return out
 
-def fewshot(rule_name:str, k:int, seed:int=42)->str:
+def _build_fewshot(rule_name:str, k:int, seed:int)->list:
     data = synthesize(rule_name, k, seed=seed)
-    data = [(d[0], str(d[1])) for d in data]
     rng = random.Random(seed)
     rng.shuffle(data)
-    return get_few_shot_prompt(data)
+    return data
+
+def _build_fewshot_nested(rule_name:str, k:int, seed:int)->list:
+    # shuffle (True, False) pairs and the order within each pair, so that every even-length
+    # prefix is balanced and the k-shot prompt is a prefix of every larger one
+    data = synthesize(rule_name, k, seed=seed)
+    rng = random.Random(seed)
+    pairs = [list(pair) for pair in zip(data[0::2], data[1::2])]
+    rng.shuffle(pairs)
+    for pair in pairs:
+        if rng.random() < 0.5:
+            pair.reverse()
+    return [x for pair in pairs for x in pair] + data[2*len(pairs):]
+
+def _build_counterfactuals(rule_name:str, k:int, seed:int, kind:str = "fewshot")->list:
+    # flip the labels of the k-shot examples, in prompt order
+    gen_cf = RULES[rule_name][2]
+    rng = random.Random(seed+2)
+    return [(gen_cf(s, not y, rng), not y) for s, y in load_dataset(kind, rule_name, k, seed)]
+
+def _build_counterfactuals_nested(rule_name:str, k:int, seed:int)->list:
+    return _build_counterfactuals(rule_name, k, seed, kind="fewshot_nested")
+
+# counterfactual test sets are generated in chunks by worker processes once they are this large
+COUNTERFACTUAL_WORKERS = int(os.getenv("COUNTERFACTUAL_WORKERS", "0")) or os.cpu_count() or 1
+COUNTERFACTUAL_CHUNK = 500
+COUNTERFACTUAL_ROUNDS = 8
+
+def _flip_chunk(rule_name:str, seed:int, chunk:list, spec:RuleSpec | None = None)->list:
+    """Label-flipped edits of `chunk` [(i, s, y)] that pass the ground-truth check.
+
+    `spec` is the spec of a rule registered after import, for worker processes that do not know it yet.
+    """
+    if spec is not None and rule_name not in RULES:
+        register(spec)
+    gen_cf = RULES[rule_name][2]
+    predicate = PREDICATES[rule_name]
+    out = []
+    for i, s, y in chunk:
+        # seeded per input, so the result does not depend on how the inputs are split over workers
+        rng = random.Random(f"{seed}:{i}")
+        cf = gen_cf(s, not y, rng)
+        if cf != s and predicate(cf) == (not y):
+            out.append((i, cf, not y))
+    return out
+
+def _build_counterfactual_test(rule_name:str, m:int, seed:int)->list:
+    # flip sample_test inputs (then fresh samples, for up to COUNTERFACTUAL_ROUNDS rounds) until m unique,
+    # verified counterfactuals are collected, half of them labelled True
+    quota = {True: (m + 1) // 2, False: m // 2}
+    seen = set()
+    out = []
+    executor = None
+    # workers import tasks afresh: rules registered since are compiled there from their spec, and
+    # rules added to RULES by other means are flipped in this process
+    spec = SPECS.get(rule_name) if rule_name not in IMPORTED_RULES else None
+    parallel = COUNTERFACTUAL_WORKERS > 1 and (rule_name in IMPORTED_RULES or spec is not None)
+    flip = partial(_flip_chunk, rule_name, seed, spec=spec)
+    try:
+        for r in range(COUNTERFACTUAL_ROUNDS):
+            source = sample_test(rule_name, m, seed) if r == 0 else synthesize(rule_name, m, seed=f"{seed}:{r}")
+            items = [(r * m + i, s, y) for i, (s, y) in enumerate(source) if quota[not y] > 0]
+            chunks = [items[i:i+COUNTERFACTUAL_CHUNK] for i in range(0, len(items), COUNTERFACTUAL_CHUNK)]
+            if len(chunks) > 1 and parallel and executor is None:
+                import multiprocessing as mp
+                from concurrent.futures import ProcessPoolExecutor
+                # this runs in a worker thread of the sweep's event loop, which must not be forked
+                context = mp.get_context("forkserver" if "forkserver" in mp.get_all_start_methods() else "spawn")
+                executor = ProcessPoolExecutor(min(COUNTERFACTUAL_WORKERS, len(chunks)), mp_context=context)
+            flipped = executor.map(flip, chunks) if executor is not None else map(flip, chunks)
+            for chunk in flipped:
+                for i, cf, y in chunk:
+                    if cf not in seen and quota[y] > 0:
+                        seen.add(cf)
+                        quota[y] -= 1
+                        out.append((cf, y))
+            if not any(quota.values()):
+                break
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    random.Random(seed).shuffle(out)
+    return out
+
+_BUILDERS = {
+    "synthesize": synthesize,
+    "fewshot": _build_fewshot,
+    "counterfactual": _build_counterfactuals,
+    "fewshot_nested": _build_fewshot_nested,
+    "counterfactual_nested": _build_counterfactuals_nested,
+    "counterfactual_test": _build_counterfactual_test,
+}
+
+# generated datasets are stored as gzipped JSON under a hash of everything that determines
+# their content, so repeated runs read back byte-identical data (and hit the response cache)
+DATASET_DIR = os.getenv("DATASET_DIR", "workspace/.cache/datasets")
+_DATASETS = {}
+# one lock per key, so that a dataset requested from several threads at once (e.g. step3 of several
+# runs of a sweep, which build their test sets in threads) is built once and the others wait for it
+_DATASET_LOCKS = {}
+_DATASET_LOCKS_LOCK = threading.Lock()
+
+def _fingerprint(fn)->str:
+    import inspect
+    if hasattr(fn, "source"):
+        # predicates of declarative rules are generated code
+        return fn.source
+    try:
+        source = inspect.getsource(fn)
+    except (OSError, TypeError):
+        source = f"{fn.__module__}.{fn.__qualname__}"
+    # methods of a compiled declarative rule share their source: the spec tells the rules apart and
+    # the DSL's source covers the samplers they dispatch to
+    if hasattr(fn, "__self__"):
+        source += repr(fn.__self__) + inspect.getsource(inspect.getmodule(fn.__self__))
+    return source
+
+def dataset_key(kind:str, rule_name:str, n:int, seed:int)->str:
+    gen, rule, gen_cf = RULES[rule_name]
+    h = hashlib.sha256()
+    h.update(json.dumps([kind, rule_name, rule, n, seed]).encode())
+    fns = [gen, gen_cf, _BUILDERS[kind]]
+    if kind == "counterfactual_test":
+        # the ground-truth check and the chunk worker decide which edits are kept
+        h.update(json.dumps(COUNTERFACTUAL_ROUNDS).encode())
+        fns += [PREDICATES[rule_name], _flip_chunk]
+    for fn in fns:
+        h.update(_fingerprint(fn).encode())
+    h.update("\n".join(WORDS).encode())
+    return h.hexdigest()[:32]
+
+def _stored(key:str, build):
+    """`build()`, or its JSON as stored in `DATASET_DIR` under `key` by an earlier call."""
+    path = os.path.join(DATASET_DIR, f"{key}.json.gz") if DATASET_DIR else None
+    if path and os.path.exists(path):
+        with gzip.open(path, "rt") as f:
+            return json.load(f)
+    data = build()
+    if path:
+        os.makedirs(DATASET_DIR, exist_ok=True)
+        # unique per writer, so other processes building the same key cannot clobber it
+        fd, tmp = tempfile.mkstemp(dir=DATASET_DIR, prefix=f"{key}.", suffix=".tmp")
+        with os.fdopen(fd, "wb") as raw, gzip.GzipFile(filename="", mode="wb", fileobj=raw, mtime=0) as f:
+            f.write(json.dumps(data, separators=(",", ":")).encode())
+        os.replace(tmp, path)
+    return data
+
+def load_dataset(kind:str, rule_name:str, n:int, seed:int)->list[tuple[str, bool]]:
+    key = dataset_key(kind, rule_name, n, seed)
+    if key in _DATASETS:
+        return list(_DATASETS[key])
+    with _DATASET_LOCKS_LOCK:
+        lock = _DATASET_LOCKS.setdefault(key, threading.Lock())
+    with lock:
+        if key in _DATASETS:
+            return list(_DATASETS[key])
+        data = [tuple(x) for x in _stored(key, lambda: _BUILDERS[kind](rule_name, n, seed))]
+        _DATASETS[key] = data
+    return list(data)
+
+def fewshot(rule_name:str, k:int, seed:int=42, max_shots:int | None = None, encoding:str = "multiturn")->str:
+    """k-shot prompt; with `max_shots`, the first k examples of the nested `max_shots` set (balanced at every even k).
+
+    `encoding` is a key of `utils.FEW_SHOT_ENCODINGS`: a user / assistant turn per shot, or all shots in one message.
+    """
+    data = load_dataset("fewshot_nested", rule_name, max_shots, seed)[:k] if max_shots else load_dataset("fewshot", rule_name, k, seed)
+    data = [(d[0], str(d[1])) for d in data]
+    from utils import FEW_SHOT_ENCODINGS
+    return FEW_SHOT_ENCODINGS[encoding](data)
 
 def sample_test(rule_name:str, m:int, seed:int=43)->list[str]:
-    return synthesize(rule_name, m, seed=seed)
+    return load_dataset("synthesize", rule_name, m, seed)
+
+def counterfactuals(rule_name:str, k:int, seed:int=42, max_shots:int | None = None)->list[tuple[str, bool]]:
+    """Label-flipped counterfactuals of the `fewshot(rule_name, k, seed, max_shots)` examples, in prompt order."""
+    if max_shots:
+        return load_dataset("counterfactual_nested", rule_name, max_shots, seed)[:k]
+    return load_dataset("counterfactual", rule_name, k, seed)
+
+def counterfactual_test(rule_name:str, m:int, seed:int=43)->list[tuple[str, bool]]:
+    """Up to m unique, ground-truth-checked, label-flipped edits of `sample_test` inputs, balanced between labels."""
+    return load_dataset("counterfactual_test", rule_name, m, seed)
 
 def label(rule_name:str, s:str)->bool:
-    return RULES[rule_name][0](s)
+    return PREDICATES[rule_name](s)
@@ -0,0 +1,25 @@
+import json
+
+import articulation
+import tasks
+
+def test_snippets_run_with_the_advertised_modules():
+    code = "def rule(s):\n    return collections.Counter(s.split()).most_common(1)[0][1] > 1"
+    assert articulation.run_snippet(code, ["a a", "a b"]) == {"preds": [True, False]}
+
+def test_snippets_cannot_start_processes():
+    code = "def rule(s):\n    return collections._sys.modules['os'].system('true') == 0"
+    assert articulation.run_snippet(code, ["x"]) == {"preds": [None]}
+
+def test_rescore_updates_correctness(tmp_path, monkeypatch):
+    monkeypatch.setattr(tasks, "DATASET_DIR", str(tmp_path / "datasets"))
+    def run(code, is_correct):
+        return {"config": {"task": "contains_digit"}, "step2_freeform": {"predicted_code": code, "is_correct": is_correct}}
+    right = "def rule(s):\n    return any(c.isdigit() for c in s)"
+    wrong = "def rule(s):\n    return False"
+    sweep = {"learning_curve": {"step2_freeform": [False, True]}, "runs": {"8": run(right, False), "16": run(wrong, True)}}
+    (tmp_path / "sweep.json").write_text(json.dumps(sweep))
+    assert articulation.rescore(str(tmp_path), n=50) == 2
+    sweep = json.loads((tmp_path / "sweep.json").read_text())
+    assert [r["step2_freeform"]["is_correct"] for r in sweep["runs"].values()] == [True, False]
+    assert sweep["learning_curve"]["step2_freeform"] == [True, False]
@@ -0,0 +1,72 @@
+import os
+import threading
+
+import pytest
+
+import tasks
+
+@pytest.fixture
+def cold_datasets(tmp_path, monkeypatch):
+    monkeypatch.setattr(tasks, "DATASET_DIR", str(tmp_path))
+    monkeypatch.setattr(tasks, "_DATASETS", {})
+    return tmp_path
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_concurrent_builds_of_one_dataset(cold_datasets, monkeypatch, workers):
+    monkeypatch.setattr(tasks, "COUNTERFACTUAL_WORKERS", workers)
+    results, errors = [], []
+
+    def build():
+        try:
+            results.append(tasks.counterfactual_test("contains_digit", m=1000, seed=43))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=build) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    assert all(r == results[0] for r in results) and len(results[0]) == 1000
+    assert not [name for name in os.listdir(cold_datasets) if name.endswith(".tmp")]
+
+def test_counterfactual_test_key_covers_the_ground_truth_check(monkeypatch):
+    key = tasks.dataset_key("counterfactual_test", "contains_digit", 100, 43)
+    fewshot_key = tasks.dataset_key("fewshot", "contains_digit", 8, 42)
+    monkeypatch.setitem(tasks.PREDICATES, "contains_digit", lambda s: not any(c.isdigit() for c in s))
+    assert tasks.dataset_key("counterfactual_test", "contains_digit", 100, 43) != key
+    assert tasks.dataset_key("fewshot", "contains_digit", 8, 42) == fewshot_key
+
+def test_neighbour_table_is_stored(cold_datasets, monkeypatch):
+    words = ["cat", "cot", "cut", "dog", "dig", "bird"]
+    monkeypatch.setattr(tasks, "WORDS", words)
+    monkeypatch.setattr(tasks, "_NEIGHBOURS", None)
+    table = tasks.neighbours().table()
+    assert table["cat"] == ["cot", "cut"] and table["bird"] == ["dig"]
+
+    # a later process reads the table back instead of searching the tree
+    monkeypatch.setattr(tasks, "_NEIGHBOURS", None)
+    monkeypatch.setattr(tasks.NeighbourIndex, "_search", lambda *args: pytest.fail("searched"))
+    assert tasks.neighbours().table() == table
+
+@pytest.fixture
+def registry(monkeypatch):
+    """Undo rules registered by a test."""
+    for name in ("RULES", "RULES_ALTERNATIVES_CHOICES", "PREDICATES", "SPECS"):
+        monkeypatch.setattr(tasks, name, dict(getattr(tasks, name)))
+
+def test_workers_flip_rules_registered_at_runtime(cold_datasets, registry, monkeypatch):
+    monkeypatch.setattr(tasks, "COUNTERFACTUAL_WORKERS", 2)
+    tasks.register(tasks.RuleSpec("any_word_starts_with_k", tasks.Some(tasks.StartsWith("k"))))
+    data = tasks.counterfactual_test("any_word_starts_with_k", m=1000, seed=43)
+    assert len(data) == 1000
+    assert all(tasks.label("any_word_starts_with_k", s) == y for s, y in data)
+
+def test_failed_flips_are_not_dropped(cold_datasets, monkeypatch):
+    gen, description, _ = tasks.RULES["contains_digit"]
+    def broken(s, label, rng):
+        raise ValueError("cannot flip")
+    monkeypatch.setitem(tasks.RULES, "contains_digit", (gen, description, broken))
+    with pytest.raises(ValueError, match="cannot flip"):
+        tasks.counterfactual_test("contains_digit", m=10, seed=43)
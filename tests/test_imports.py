@@ -0,0 +1,23 @@
+import sys
+import subprocess
+
+from conftest import ROOT
+
+def test_sampling_and_audit_import_after_tasks():
+    # in a fresh interpreter, so that tasks has registered its declarative rules before sampling is imported
+    subprocess.run([sys.executable, "-c", "import tasks, sampling, audit"], cwd=ROOT, check=True)
+
+def test_batch_generators_cover_the_core_rules():
+    import tasks
+    import sampling
+    assert set(sampling.BATCH_GENERATORS) == set(tasks.CORE_RULES)
+    assert set(tasks.RULES) > set(tasks.CORE_RULES)
+
+def test_audit_skips_sources_a_rule_does_not_support():
+    import audit
+    report = audit.audit(["contains_digit", "any_word_starts_with_b"], n=100, chunk_size=100, processes=1)
+    assert {(e["rule"], e["source"]) for e in report} == {
+        ("contains_digit", "generator"), ("contains_digit", "batch"), ("contains_digit", "counterfactual"),
+        ("any_word_starts_with_b", "generator"), ("any_word_starts_with_b", "counterfactual"),
+    }
+    assert all(e["mislabeled"] == 0 for e in report)
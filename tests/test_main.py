@@ -0,0 +1,34 @@
+import asyncio
+
+import pytest
+
+import main
+import utils
+
+REPLIES = {"a": "True", "b": "false.", "c": "True or False", "d": "I cannot tell"}
+
+@pytest.fixture
+def backend(monkeypatch):
+    async def call(model, messages, **kwargs):
+        return utils.ChatResponse(REPLIES[messages[-1]["content"]])
+
+    monkeypatch.setitem(utils.BACKENDS, "test", call)
+    monkeypatch.setattr(utils, "BACKEND", "test")
+    monkeypatch.setattr(utils, "RESPONSE_CACHE", None)
+
+def test_ambiguous_reply_is_scored_as_wrong(backend):
+    few_shot_prompt = utils.get_few_shot_prompt([("x", "True"), ("y", "False")])
+    preds = asyncio.run(main.classify_async(few_shot_prompt, list(REPLIES), "openai/gpt-4o-mini"))
+    assert preds == [True, False, None, None]
+    results = main.classification_results(list(REPLIES), [True, False, True, False], [(p, None) for p in preds], [])
+    assert results["accuracy"] == 50
+    assert results["n_unparsed"] == 2
+
+@pytest.mark.parametrize("n, wave_size", [(0, 10), (10, 0)])
+def test_early_stopping_without_outputs(n, wave_size):
+    async def run_wave(start, stop):
+        return [True] * (stop - start)
+    early_stopping = {"wave_size": wave_size, "ci_width": 10, "threshold": 50}
+    outputs, sequential = asyncio.run(main.run_in_waves(n, run_wave, lambda i, o: o, early_stopping))
+    assert outputs == []
+    assert sequential["n_queries"] == 0 and sequential["ci"] == [0.0, 100.0]
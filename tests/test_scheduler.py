@@ -0,0 +1,38 @@
+from scheduler import PRIORITY_NORMAL, ModelLimiter
+
+def test_request_rate_recovers_after_rate_limits():
+    limiter = ModelLimiter(rps=50)
+    for _ in range(3):
+        limiter.on_rate_limited(retry_after=0)
+    cut = limiter.requests.rate
+    assert cut < 20
+    # about a second's worth of successes at the reduced rate recovers 5% of the configured rate
+    for _ in range(int(cut)):
+        limiter.on_success(latency=0.1)
+    assert 2 < limiter.requests.rate - cut < 3
+    for _ in range(1000):
+        limiter.on_success(latency=0.1)
+    assert limiter.requests.rate == 50
+
+def test_concurrency_limit_recovers_after_rate_limits():
+    limiter = ModelLimiter(concurrency=8, max_concurrency=8)
+    limiter.on_rate_limited(retry_after=0)
+    assert limiter.limit == 4
+    for _ in range(100):
+        limiter.on_success(latency=0.1)
+    assert limiter.limit == 8
+
+def test_hedges_use_a_reserve_while_requests_queue():
+    limiter = ModelLimiter(concurrency=40, max_concurrency=40)
+    class Waiting:
+        def cancelled(self):
+            return False
+    limiter.in_flight = 40
+    limiter._waiters.append((PRIORITY_NORMAL, 0, 0, Waiting()))
+    for _ in range(100):
+        limiter.hedge_started()
+    # 5% of the 40-slot limit
+    assert [limiter.try_hedge(0.05) for _ in range(3)] == [True, True, False]
+    limiter.release_hedge()
+    assert limiter.try_hedge(0.05)
+    assert limiter.in_flight == 42 and limiter.hedges_in_flight == 2
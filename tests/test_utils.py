@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+
+import utils
+
+@pytest.fixture
+def backend(monkeypatch):
+    """A backend that records how many requests were already in flight when each one started."""
+    state = {"in_flight": 0, "seen": []}
+
+    async def call(model, messages, **kwargs):
+        state["seen"].append(state["in_flight"])
+        state["in_flight"] += 1
+        await asyncio.sleep(0.01)
+        state["in_flight"] -= 1
+        return utils.ChatResponse("True")
+
+    monkeypatch.setitem(utils.BACKENDS, "test", call)
+    monkeypatch.setattr(utils, "BACKEND", "test")
+    monkeypatch.setattr(utils, "RESPONSE_CACHE", None)
+    return state
+
+FEW_SHOT = utils.get_few_shot_prompt([("a", "True"), ("b", "False")])
+
+def fan_out(model, waves):
+    async def go():
+        for prompts in waves:
+            await utils.get_messages_with_few_shot_prompt_async(FEW_SHOT, prompts, system_prompt="sys", model=model)
+    asyncio.run(go())
+
+def test_warm_up_only_for_models_with_prompt_caching(backend):
+    fan_out("openai/gpt-4o-mini", [["x1", "x2", "x3"]])
+    assert backend["seen"] == [0, 1, 2]
+    backend["seen"].clear()
+    fan_out("anthropic/claude-haiku-4.5", [["x1", "x2", "x3"]])
+    assert backend["seen"] == [0, 0, 1]
+
+def test_warm_up_once_per_prefix(backend):
+    # e.g. the waves of early stopping: only the first one sends a request on its own
+    fan_out("anthropic/claude-haiku-4.5", [["x1", "x2", "x3"], ["x4", "x5", "x6"]])
+    assert backend["seen"] == [0, 0, 1, 0, 1, 2]
+
+def cached_prefixes(messages):
+    """The (role, text) messages a provider caches up to each breakpoint."""
+    prefixes, seen = [], []
+    for m in messages:
+        blocks = m["content"] if isinstance(m["content"], list) else [{"text": m["content"]}]
+        text = ""
+        for block in blocks:
+            text += block["text"]
+            if "cache_control" in block:
+                prefixes.append(tuple(seen) + ((m["role"], text),))
+        seen.append((m["role"], text))
+    return prefixes
+
+@pytest.mark.parametrize("encoding", utils.FEW_SHOT_ENCODINGS)
+def test_nested_breakpoints(encoding):
+    examples = [(f"input {i}", str(i % 2 == 0)) for i in range(16)]
+    build = lambda k: utils._build_messages(utils.FEW_SHOT_ENCODINGS[encoding](examples[:k]), "x", "sys")
+    largest = utils.cacheable_messages(build(16), (4, 8, 16))
+    text = lambda m: m["content"] if isinstance(m["content"], str) else "".join(b["text"] for b in m["content"])
+    assert [(m["role"], text(m)) for m in largest] == [(m["role"], m["content"]) for m in build(16)]
+    prefixes = cached_prefixes(largest)
+    assert len(prefixes) == 3
+    for k in (4, 8, 16):
+        assert cached_prefixes(utils.cacheable_messages(build(k), (4, 8, 16)))[-1] in prefixes
+
+def test_journal_batches_fsyncs(tmp_path, monkeypatch):
+    synced = []
+    monkeypatch.setattr(utils.os, "fsync", synced.append)
+    journal = utils.Journal(str(tmp_path / "run.jsonl"))
+    for i in range(100):
+        journal.append("step1", str(i), utils.ChatResponse("True"))
+    assert len(synced) <= 1
+    # every record was written through to the OS as it arrived
+    assert len((tmp_path / "run.jsonl").read_text().splitlines()) == 100
+    journal.close()
+    assert len(synced) >= 1
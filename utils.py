@@ -1,14 +1,442 @@
+from __future__ import annotations
+
 import os
+import re
+import json
+import time
+import atexit
+import random
 import asyncio
-from safetytooling.apis import InferenceAPI
-from safetytooling.data_models import Prompt, LLMResponse
+import hashlib
+import weakref
+import contextlib
+import contextvars
+import concurrent.futures
 from pathlib import Path
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING
+
+from scheduler import PRIORITY_HIGH, PRIORITY_NORMAL, Scheduler, is_rate_limit_error, retry_after
+from response_cache import ResponseCache
+
+if TYPE_CHECKING:
+    from safetytooling.apis import InferenceAPI
+    from safetytooling.data_models import LLMResponse
 
 os.environ["OPENAI_API_KEY"] = "dummy"
 os.environ["OPENROUTER_API_KEY"] = os.getenv("OPENROUTER_API_KEY", "")
 
-API = InferenceAPI(cache_dir=Path(os.getenv("OR_CACHE_DIR", "workspace/.cache/openrouter")), openrouter_num_threads=100)
-semaphore = asyncio.Semaphore(100)
+# concurrency is governed per model by the adaptive scheduler; this is only its upper bound
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", "400"))
+SCHEDULER_DEFAULTS = dict(concurrency=100, max_concurrency=MAX_CONCURRENCY)
+# per-model limits, e.g. {"anthropic/claude-haiku-4.5": dict(rps=50, tpm=2_000_000)}
+SCHEDULER_LIMITS = {}
+
+# request hedging: once a request has been in flight longer than this percentile of the model's
+# recent latencies, a duplicate is sent and whichever answers first is used (None = off); duplicates
+# are capped at HEDGE_BUDGET times the number of requests and use idle slots or a small reserve (see
+# `ModelLimiter.try_hedge`)
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0")) or None
+HEDGE_BUDGET = float(os.getenv("HEDGE_BUDGET", "0.05"))
+HEDGE_POLL = 0.1
+
+# safetytooling (and with it every provider SDK) is imported when the first request is made
+_api = None
+
+def get_api() -> InferenceAPI:
+    global _api
+    if _api is None:
+        from safetytooling.apis import InferenceAPI
+        _api = InferenceAPI(cache_dir=Path(os.getenv("OR_CACHE_DIR", "workspace/.cache/openrouter")), openrouter_num_threads=MAX_CONCURRENCY)
+    return _api
+
+# optional single-file response cache (see response_cache.py); when set it replaces safetytooling's
+# one-file-per-response cache directory
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE")
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", "0")) or None
+_response_cache = None
+
+def get_response_cache() -> ResponseCache | None:
+    global _response_cache
+    if RESPONSE_CACHE is None:
+        return None
+    if _response_cache is None or _response_cache.path != RESPONSE_CACHE:
+        _response_cache = ResponseCache(RESPONSE_CACHE, max_bytes=RESPONSE_CACHE_MAX_BYTES)
+        atexit.register(_response_cache.close)
+    return _response_cache
+
+# "openrouter" goes through safetytooling's InferenceAPI (with its response cache); "openai_compatible"
+# talks to any OpenAI-compatible endpoint at OPENAI_COMPATIBLE_BASE_URL, e.g. `python mock_server.py`
+BACKEND = os.getenv("LLM_BACKEND", "openrouter")
+OPENAI_COMPATIBLE_BASE_URL = os.getenv("OPENAI_COMPATIBLE_BASE_URL", "http://127.0.0.1:8123/v1")
+
+# one scheduler per event loop, so the limits also hold (and do not break) when
+# coroutines are driven from a notebook's loop or a worker thread's loop
+_schedulers: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Scheduler]" = weakref.WeakKeyDictionary()
+
+def get_scheduler() -> Scheduler:
+    loop = asyncio.get_running_loop()
+    if loop not in _schedulers:
+        scheduler = Scheduler(**SCHEDULER_DEFAULTS)
+        for model, limits in SCHEDULER_LIMITS.items():
+            scheduler.configure(model, **limits)
+        _schedulers[loop] = scheduler
+    return _schedulers[loop]
+
+def run(coro):
+    """Run a coroutine to completion, also from inside an already running loop (e.g. Jupyter)."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+        return pool.submit(asyncio.run, coro).result()
+
+# models for which OpenRouter honours explicit `cache_control` breakpoints; other providers
+# (OpenAI, DeepSeek, ...) cache long shared prefixes implicitly
+PROMPT_CACHE_MODEL_PREFIXES = ("anthropic/", "google/gemini")
+
+def supports_prompt_cache(model: str) -> bool:
+    return model.startswith(PROMPT_CACHE_MODEL_PREFIXES)
+
+# Anthropic honours at most four cache breakpoints per request
+MAX_CACHE_BREAKPOINTS = 4
+
+def cacheable_messages(messages: list[dict], prefix_shots: tuple[int, ...] = ()) -> list[dict]:
+    """OpenAI-format messages with a cache breakpoint on the last message before the final user turn.
+
+    `prefix_shots` are shot counts of shorter prompts that are prefixes of this one (see
+    `prefix_breakpoints`); the longest of them get breakpoints as well, so this request can read
+    what they cached. With one turn per shot, k shots end with message 2k; a compact few-shot
+    message (`get_compact_few_shot_prompt`) is split into content blocks ending after its k-th line.
+    """
+    messages = [dict(m) for m in messages]
+    if len(messages) < 2:
+        return messages
+    last = len(messages) - 2
+    if last == 1 and messages[1]["content"].startswith(COMPACT_HEADER):
+        content = messages[1]["content"]
+        # ends[k] is the end of the k-th example line, ends[0] the end of the header
+        ends = [m.start() for m in re.finditer("\n", content)] + [len(content)]
+        cuts = sorted({ends[k] for k in prefix_shots if 0 < k < len(ends) - 1})[-(MAX_CACHE_BREAKPOINTS - 1):] + [len(content)]
+        messages[1]["content"] = [
+            {"type": "text", "text": content[start:end], "cache_control": {"type": "ephemeral"}}
+            for start, end in zip([0] + cuts, cuts)
+        ]
+        return messages
+    # after the system prompt, a prefix of k shots ends at index 2k
+    indices = sorted({2 * k for k in prefix_shots if 0 < 2 * k < last})[-(MAX_CACHE_BREAKPOINTS - 1):] + [last]
+    for i in indices:
+        messages[i]["content"] = [
+            {
+                "type": "text",
+                "text": messages[i]["content"],
+                "cache_control": {"type": "ephemeral"},
+            }
+        ]
+    return messages
+
+# shot counts of nested prompts sent within a `prefix_breakpoints` block
+_prefix_shots: contextvars.ContextVar[tuple[int, ...]] = contextvars.ContextVar("prefix_shots", default=())
+
+@contextlib.contextmanager
+def prefix_breakpoints(shot_counts: list[int]):
+    """Mark the ends of nested k-shot prefixes as cache breakpoints in the requests issued within the block."""
+    token = _prefix_shots.set(tuple(shot_counts))
+    try:
+        yield
+    finally:
+        _prefix_shots.reset(token)
+
+def _get(obj, key):
+    if obj is None:
+        return None
+    if isinstance(obj, dict):
+        return obj.get(key)
+    return getattr(obj, key, None)
+
+def response_usage(response: LLMResponse) -> dict:
+    """Input/output token counts of a response, split into cached and uncached input tokens where reported."""
+    usage = _get(response, "usage")
+    input_tokens = _get(usage, "input_tokens")
+    if input_tokens is None:
+        input_tokens = _get(usage, "prompt_tokens")
+    output_tokens = _get(usage, "output_tokens")
+    if output_tokens is None:
+        output_tokens = _get(usage, "completion_tokens")
+    cached_tokens = _get(usage, "cached_input_tokens")
+    if cached_tokens is None:
+        cached_tokens = _get(_get(usage, "prompt_tokens_details"), "cached_tokens")
+    if cached_tokens is None:
+        cached_tokens = _get(usage, "cache_read_input_tokens")
+    return {
+        "input_tokens": input_tokens,
+        "cached_input_tokens": cached_tokens,
+        "uncached_input_tokens": input_tokens - cached_tokens if input_tokens is not None and cached_tokens is not None else None,
+        "output_tokens": output_tokens,
+    }
+
+def response_logprobs(response: LLMResponse) -> list[dict[str, float]] | None:
+    """Top logprobs per output position as `{token: logprob}` dicts, or None if the provider returned none."""
+    logprobs = _get(response, "logprobs")
+    if not logprobs:
+        return None
+    positions = []
+    for position in logprobs:
+        if isinstance(position, dict) and "token" not in position:
+            positions.append({str(k): float(v) for k, v in position.items()})
+        else:
+            # OpenAI-style token logprob, as object or JSON
+            top = _get(position, "top_logprobs") or [position]
+            positions.append({_get(t, "token"): float(_get(t, "logprob")) for t in top})
+    return positions
+
+def summarize_usage(usages: list[dict]) -> dict:
+    summary = {"n_requests": len(usages)}
+    for key in ("input_tokens", "cached_input_tokens", "uncached_input_tokens", "output_tokens"):
+        summary[key] = sum(u[key] or 0 for u in usages)
+    return summary
+
+def percentile(values: list[float], q: float) -> float | None:
+    """Linearly interpolated `q`-th percentile (0-100) of `values`."""
+    if not values:
+        return None
+    values = sorted(values)
+    pos = (len(values) - 1) * q / 100
+    lo = int(pos)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+# per-request fields of a request record (see `get_message_with_few_shot_prompt`) that get percentiles
+METRIC_DISTRIBUTIONS = ("queue_wait", "latency", "total_seconds", "input_tokens", "cached_input_tokens", "output_tokens")
+METRIC_COUNTS = ("attempts", "rate_limited", "journal_hit", "cache_hit", "hedged")
+
+def summarize_metrics(records: list[dict]) -> dict:
+    """p50/p95/p99 and totals of the per-request records of a step, to tell queueing, provider latency and prompt size apart."""
+    summary = {"n_requests": len(records)}
+    for key in METRIC_DISTRIBUTIONS:
+        values = [r[key] for r in records if r.get(key) is not None]
+        summary[key] = {
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "p99": percentile(values, 99),
+            "total": sum(values),
+        }
+    for key in METRIC_COUNTS:
+        summary[key] = sum(int(r.get(key) or 0) for r in records)
+    summary["retries"] = summary["attempts"] - sum(1 for r in records if r.get("attempts"))
+    return summary
+
+# requests issued while a `record_usage()` block is active are logged here; asyncio tasks
+# inherit the context, so everything fanned out from within the block is captured
+_usage_log: contextvars.ContextVar[list | None] = contextvars.ContextVar("usage_log", default=None)
+
+@contextlib.contextmanager
+def record_usage():
+    """Collect one record per request: token usage plus the timing fields of `get_message_with_few_shot_prompt`."""
+    log = []
+    token = _usage_log.set(log)
+    try:
+        yield log
+    finally:
+        _usage_log.reset(token)
+
+# extra fields (e.g. task and seed of a sweep combination) added to the records of requests issued within the block
+_request_labels: contextvars.ContextVar[dict] = contextvars.ContextVar("request_labels", default={})
+
+@contextlib.contextmanager
+def request_labels(**labels):
+    token = _request_labels.set({**_request_labels.get(), **labels})
+    try:
+        yield
+    finally:
+        _request_labels.reset(token)
+
+# profiling hooks, called with every request record as it completes (e.g. to stream them to a file)
+REQUEST_HOOKS = []
+
+def add_request_hook(hook):
+    REQUEST_HOOKS.append(hook)
+
+def remove_request_hook(hook):
+    REQUEST_HOOKS.remove(hook)
+
+def _log_request(record: dict):
+    record = {**_request_labels.get(), **record}
+    log = _usage_log.get()
+    if log is not None:
+        log.append(record)
+    for hook in REQUEST_HOOKS:
+        hook(record)
+
+@dataclass
+class ChatResponse:
+    """A plain response: replayed from a `Journal` or returned by the OpenAI-compatible backend."""
+    completion: str
+    usage: dict = field(default_factory=dict)
+    logprobs: list[dict[str, float]] | None = None
+    duration: float = 0.0
+
+class Journal:
+    """Append-only JSONL record of the responses of one run, keyed by (step, prompt hash).
+
+    Every response is handed to the OS as it arrives, so an interrupted run can be restarted
+    without paying again for the requests it already completed. It is fsynced at most every
+    `SYNC_INTERVAL` seconds, which bounds what a machine crash can lose, and on `close`.
+    """
+
+    SYNC_INTERVAL = 1.0
+
+    def __init__(self, path: str):
+        self.path = path
+        self.records = {}
+        self._synced = time.monotonic()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # torn last line of an interrupted run
+                    self.records[(record["step"], record["key"])] = record
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._f = open(path, "a")
+        if self._f.tell() > 0:
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    self._f.write("\n")
+
+    def get(self, step: str, key: str) -> ChatResponse | None:
+        record = self.records.get((step, key))
+        if record is None:
+            return None
+        return ChatResponse(record["completion"], record["usage"], record.get("logprobs"))
+
+    def append(self, step: str, key: str, response: LLMResponse):
+        record = {"step": step, "key": key, "completion": response.completion, "usage": response_usage(response), "logprobs": response_logprobs(response)}
+        self._f.write(json.dumps(record) + "\n")
+        self._f.flush()
+        # fsync blocks the event loop, so batch it
+        if time.monotonic() - self._synced >= self.SYNC_INTERVAL:
+            self._sync()
+        self.records[(step, key)] = record
+
+    def _sync(self):
+        os.fsync(self._f.fileno())
+        self._synced = time.monotonic()
+
+    def close(self):
+        self._f.flush()
+        self._sync()
+        self._f.close()
+
+def prompt_key(messages: list[dict], model: str, **params) -> str:
+    return hashlib.sha256(json.dumps([messages, model, params], sort_keys=True, default=str).encode()).hexdigest()
+
+# (journal, step) of the step a request belongs to, see `journal_step`; the step is also set without a journal
+_journal_step: contextvars.ContextVar[tuple[Journal | None, str] | None] = contextvars.ContextVar("journal_step", default=None)
+
+@contextlib.contextmanager
+def journal_step(journal: Journal | None, step: str):
+    token = _journal_step.set((journal, step))
+    try:
+        yield
+    finally:
+        _journal_step.reset(token)
+
+async def _call_openrouter(model: str, messages: list[dict], **kwargs) -> LLMResponse:
+    from safetytooling.data_models import Prompt
+
+    responses = await get_api().__call__(
+        model_id=model,
+        prompt=Prompt(messages=messages),
+        max_attempts_per_api_call=1,
+        force_provider="openrouter",
+        use_cache=get_response_cache() is None,
+        **kwargs
+    )
+    return responses[0]
+
+# idle clients per event loop, as their connections are bound to the loop they were created on. Each
+# client holds one connection and serves one request at a time: a shared pool hands a burst of requests
+# the same idle connection and re-queues all but one, rescanning itself each time (~7 times per request
+# in benchmark.py). The scheduler bounds the requests in flight, and with them the number of clients.
+_http_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, list]" = weakref.WeakKeyDictionary()
+# shared by all clients: building one takes ~25 ms
+_ssl_context = None
+
+async def _call_openai_compatible(model: str, messages: list[dict], extra_body: dict | None = None, **kwargs) -> ChatResponse:
+    # plain httpx rather than the openai SDK, which took ~24 ms of client CPU per request in benchmark.py against ~1.5 ms
+    import httpx
+
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = httpx.create_ssl_context()
+    idle = _http_clients.setdefault(asyncio.get_running_loop(), [])
+    client = idle.pop() if idle else httpx.AsyncClient(
+        base_url=OPENAI_COMPATIBLE_BASE_URL,
+        headers={"Authorization": f"Bearer {os.getenv('OPENAI_COMPATIBLE_API_KEY', 'dummy')}"},
+        limits=httpx.Limits(max_connections=1, max_keepalive_connections=1),
+        timeout=httpx.Timeout(600.0),
+        verify=_ssl_context,
+    )
+    start = time.perf_counter()
+    try:
+        r = await client.post("/chat/completions", json={"model": model, "messages": messages, **kwargs, **(extra_body or {})})
+    finally:
+        idle.append(client)
+    r.raise_for_status()
+    body = r.json()
+    choice = body["choices"][0]
+    return ChatResponse(
+        completion=choice["message"]["content"] or "",
+        usage=body.get("usage") or {},
+        logprobs=response_logprobs({"logprobs": (choice.get("logprobs") or {}).get("content")}),
+        duration=time.perf_counter() - start,
+    )
+
+BACKENDS = {
+    "openrouter": _call_openrouter,
+    "openai_compatible": _call_openai_compatible,
+}
+
+async def _call_hedged(call, limiter, model: str, messages: list[dict], **kwargs) -> tuple[LLMResponse, bool]:
+    """`call`, plus a duplicate once it turns out to be a straggler; returns the first answer and whether it was hedged.
+
+    The delay and the free slot are re-checked while the request is in flight, so the stragglers of the
+    first wave of a fan-out, sent before any latencies were known, are hedged as well (see `ModelLimiter.hedge_delay`).
+    """
+    if not HEDGE_PERCENTILE:
+        return await call(model, messages, **kwargs), False
+    started = limiter.hedge_started()
+    primary = asyncio.ensure_future(call(model, messages, **kwargs))
+    pending, hedged = {primary}, False
+    try:
+        while True:
+            timeout = None
+            if not hedged:
+                delay = limiter.hedge_delay(HEDGE_PERCENTILE)
+                elapsed = time.monotonic() - started
+                if delay is not None and elapsed >= delay and limiter.try_hedge(HEDGE_BUDGET):
+                    hedged = True
+                    pending.add(asyncio.ensure_future(call(model, messages, **kwargs)))
+                elif delay is not None and elapsed < delay:
+                    timeout = delay - elapsed
+                else:
+                    timeout = HEDGE_POLL
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            answered = [task for task in done if task.exception() is None]
+            if answered:
+                return answered[0].result(), hedged
+            if not pending:
+                return primary.result(), hedged
+    finally:
+        for task in pending:
+            task.cancel()
+        limiter.hedge_finished(started)
+        if hedged:
+            limiter.release_hedge()
 
 def get_few_shot_prompt(prompts_and_responses: list[tuple[str, str]]) -> list[dict]:
   messages = []
@@ -28,18 +456,31 @@ def get_few_shot_prompt(prompts_and_responses: list[tuple[str, str]]) -> list[di
 
   return messages
 
-async def get_message_with_few_shot_prompt(
-    few_shot_prompt: list[dict],
-    prompt: str,
-    system_prompt: str,
-    model: str = "google/gemini-2.5-flash",
-    max_retries: int = 5,
-    max_tokens: int = 500,
-    temperature: float = 0,
-    verbose: bool = False,
-    **kwargs
-) -> LLMResponse:
+# compact encoding: all shots in one user message, one line each, instead of a user and an assistant
+# turn per shot. Inputs are written as JSON strings, so tabs (is_tab_separator), newlines and quotes
+# cannot be confused with the layout; the inputs to classify have to be sent as `encode_input(x)`.
+COMPACT_HEADER = "Labelled examples, one per line: the input as a JSON string, then -> and its label."
+COMPACT_LINE_RE = re.compile(r'^("(?:[^"\\]|\\.)*") -> (.*)$', re.MULTILINE)
+
+def encode_input(x: str) -> str:
+    return json.dumps(x, ensure_ascii=False)
+
+def get_compact_few_shot_prompt(prompts_and_responses: list[tuple[str, str]]) -> list[dict]:
+    lines = [f"{encode_input(p)} -> {r}" for p, r in prompts_and_responses]
+    return [{"role": "user", "content": "\n".join([COMPACT_HEADER, *lines])}]
 
+def parse_compact_few_shot_prompt(content: str) -> list[tuple[str, str]] | None:
+    """The (input, label) pairs of a `get_compact_few_shot_prompt` message, or None for other messages."""
+    if not content.startswith(COMPACT_HEADER):
+        return None
+    return [(json.loads(x), r) for x, r in COMPACT_LINE_RE.findall(content)]
+
+FEW_SHOT_ENCODINGS = {
+    "multiturn": get_few_shot_prompt,
+    "compact": get_compact_few_shot_prompt,
+}
+
+def _build_messages(few_shot_prompt: list[dict], prompt: str, system_prompt: str) -> list[dict]:
     system_prompt = [
         {
             "role": "system",
@@ -54,33 +495,154 @@ async def get_message_with_few_shot_prompt(
         }
     ]
 
-    messages = system_prompt + few_shot_prompt + user_prompt
-    prompt = Prompt(messages=messages)
+    return system_prompt + few_shot_prompt + user_prompt
 
-    async with semaphore:
+def _cache_key(
+    few_shot_prompt: list[dict],
+    prompt: str,
+    system_prompt: str,
+    model: str = "google/gemini-2.5-flash",
+    max_tokens: int = 500,
+    temperature: float = 0,
+    backend: str | None = None,
+    max_retries: int | None = None,
+    verbose: bool | None = None,
+    cache_prefix: bool | None = None,
+    priority: int | None = None,
+    **kwargs
+) -> str:
+    """Response-cache key of a `get_message_with_few_shot_prompt` call; scheduling options do not change the response."""
+    messages = _build_messages(few_shot_prompt, prompt, system_prompt)
+    return prompt_key(messages, model, backend=backend or BACKEND, max_tokens=max_tokens, temperature=temperature, **kwargs)
 
-        responses = await API.__call__(
-            model_id=model,
-            prompt=prompt,
-            max_attempts_per_api_call=max_retries,
-            force_provider="openrouter",
-            max_tokens=max_tokens,
-            temperature=temperature,
-            **kwargs
-        )
-        response = responses[0]
-        if verbose:
-            print(f"Got response from {model} after {response.duration:.2f}s")
+async def get_message_with_few_shot_prompt(
+    few_shot_prompt: list[dict],
+    prompt: str,
+    system_prompt: str,
+    model: str = "google/gemini-2.5-flash",
+    max_retries: int = 5,
+    max_tokens: int = 500,
+    temperature: float = 0,
+    verbose: bool = False,
+    cache_prefix: bool = True,
+    priority: int = PRIORITY_NORMAL,
+    backend: str | None = None,
+    **kwargs
+) -> LLMResponse:
+
+    messages = _build_messages(few_shot_prompt, prompt, system_prompt)
+
+    journal, step = _journal_step.get() or (None, None)
+    start = time.monotonic()
+    if journal is not None:
+        key = prompt_key(messages, model, max_tokens=max_tokens, temperature=temperature, **kwargs)
+        response = journal.get(step, key)
+        if response is not None:
+            _log_request({**response.usage, "step": step, "model": model, "queue_wait": 0.0, "latency": 0.0, "total_seconds": time.monotonic() - start, "attempts": 0, "rate_limited": 0, "journal_hit": True, "cache_hit": True})
+            return response
 
-        return response
+    cache = get_response_cache()
+    if cache is not None:
+        cache_key = _cache_key(few_shot_prompt, prompt, system_prompt, model=model, max_tokens=max_tokens, temperature=temperature, backend=backend, **kwargs)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            response = ChatResponse(**cached)
+            _log_request({**response.usage, "step": step, "model": model, "queue_wait": 0.0, "latency": 0.0, "total_seconds": time.monotonic() - start, "attempts": 0, "rate_limited": 0, "journal_hit": False, "cache_hit": True})
+            if journal is not None:
+                journal.append(step, key, response)
+            return response
 
-async def _get_messages_with_few_shot_prompt(
+    if cache_prefix and supports_prompt_cache(model):
+        # the Prompt model only carries plain-text content, so the cache breakpoint is sent by
+        # overriding the request body's messages; also ask OpenRouter to report cached tokens
+        kwargs["extra_body"] = {
+            **kwargs.get("extra_body", {}),
+            "messages": cacheable_messages(messages, _prefix_shots.get()),
+            "usage": {"include": True},
+        }
+
+    call = BACKENDS[backend or BACKEND]
+    # retries happen here rather than inside the API client, so that every 429 reaches the scheduler
+    scheduler = get_scheduler()
+    est_tokens = sum(len(m["content"]) for m in messages) // 4 + max_tokens
+    queue_wait = 0.0
+    rate_limited = 0
+    for attempt in range(max_retries):
+        try:
+            queued = time.monotonic()
+            async with scheduler.slot(model, priority=priority, tokens=est_tokens) as slot:
+                queue_wait += slot.started - queued
+                response, hedged = await _call_hedged(call, slot.limiter, model, messages, max_tokens=max_tokens, temperature=temperature, **kwargs)
+                latency = time.monotonic() - slot.started
+                usage = response_usage(response)
+                slot.succeeded(tokens=(usage["input_tokens"] or 0) + (usage["output_tokens"] or 0))
+            break
+        except Exception as e:
+            if is_rate_limit_error(e):
+                rate_limited += 1
+            if attempt == max_retries - 1:
+                raise
+            if not is_rate_limit_error(e):
+                # the scheduler's cooldown paces retries after 429s; other errors back off here
+                await asyncio.sleep(min(2 ** attempt, 30) * random.uniform(0.5, 1.0))
+
+    _log_request({
+        **usage,
+        "step": step,
+        "model": model,
+        "queue_wait": queue_wait,
+        "latency": latency,
+        "total_seconds": time.monotonic() - start,
+        "attempts": attempt + 1,
+        "rate_limited": rate_limited,
+        "journal_hit": False,
+        "hedged": hedged,
+        # safetytooling replays cached responses with the duration of the original request
+        "cache_hit": bool(getattr(response, "duration", None)) and latency < 0.5 * response.duration,
+    })
+    if cache is not None:
+        cache.put(cache_key, {"completion": response.completion, "usage": usage, "logprobs": response_logprobs(response), "duration": response.duration})
+    if journal is not None:
+        journal.append(step, key, response)
+    if verbose:
+        print(f"Got response from {model} after {response.duration:.2f}s ({usage['cached_input_tokens']}/{usage['input_tokens']} input tokens cached)")
+
+    return response
+
+# warm-up requests of the shared prefixes sent on each event loop, keyed by prefix hash (see below)
+_prefix_warmups: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict[str, asyncio.Task]]" = weakref.WeakKeyDictionary()
+
+async def get_messages_with_few_shot_prompt_async(
     few_shot_prompt: list[dict] | list[str],
     prompts: list[str],
     system_prompt: str,
     **kwargs
 ) -> list[LLMResponse]:
-  messages = await asyncio.gather(
+  cache = get_response_cache()
+  if cache is not None:
+    # one batched lookup for the whole fan-out instead of one query per request
+    cache.prefetch([_cache_key(few_shot_prompt, p, system_prompt, **kwargs) for p in prompts])
+
+  messages = []
+  model = kwargs.get("model", "google/gemini-2.5-flash")
+  if kwargs.get("cache_prefix", True) and supports_prompt_cache(model) and few_shot_prompt and len(prompts) > 1:
+    # warm the provider's prompt cache with one request before fanning out the rest; only once per
+    # prefix, so later waves and other steps with the same prefix just wait for that request
+    warmups = _prefix_warmups.setdefault(asyncio.get_running_loop(), {})
+    prefix = prompt_key(_build_messages(few_shot_prompt, "", system_prompt)[:-1], model)
+    if prefix not in warmups:
+      warmups[prefix] = asyncio.ensure_future(
+          get_message_with_few_shot_prompt(
+              few_shot_prompt,
+              prompt=prompts[0],
+              system_prompt=system_prompt,
+              **{**kwargs, "priority": PRIORITY_HIGH}
+          )
+      )
+      messages.append(await warmups[prefix])
+    else:
+      await asyncio.wait([warmups[prefix]])
+  messages += await asyncio.gather(
       *[
           get_message_with_few_shot_prompt(
               few_shot_prompt,
@@ -88,7 +650,7 @@ async def _get_messages_with_few_shot_prompt(
               system_prompt=system_prompt,
               **kwargs
           )
-          for p in prompts
+          for p in prompts[len(messages):]
       ]
   )
   return messages
@@ -99,8 +661,8 @@ def get_messages_with_few_shot_prompt(
     system_prompt: str,
     **kwargs
 ) -> list[LLMResponse]:
-  return asyncio.run(
-      _get_messages_with_few_shot_prompt(
+  return run(
+      get_messages_with_few_shot_prompt_async(
           few_shot_prompt,
           prompts,
           system_prompt,
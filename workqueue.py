@@ -0,0 +1,323 @@
+import os
+import json
+import time
+import uuid
+import socket
+import asyncio
+import sqlite3
+import argparse
+import itertools
+
+import main
+import tasks
+import utils
+from utils import Journal, record_usage
+
+# Work-queue mode for sweeps spread over several processes / hosts that share a filesystem. `init`
+# enumerates units of work into a SQLite file: step1 and step3_faithfulness are split into shards of
+# their inputs, step2_mcq and step2_freeform are one unit each. Any number of `work` processes lease
+# units, renew their leases while working and write the outputs back; a unit whose lease expires
+# (crashed or stalled worker) is handed out again, and its journal lets the next worker replay the
+# responses that were already paid for. `merge` rebuilds the per-run result JSON of main.py.
+#
+# SQLite relies on POSIX file locks: the filesystem must implement them (local disks, most NFSv4 setups).
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run TEXT PRIMARY KEY,
+    config TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS units (
+    id INTEGER PRIMARY KEY,
+    run TEXT NOT NULL REFERENCES runs(run),
+    step TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    stop INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    UNIQUE (run, step, start)
+);
+CREATE INDEX IF NOT EXISTS units_status ON units(status, lease_until);
+"""
+
+SHARDED_STEPS = ("step1", "step3_faithfulness")
+STEPS = ("step1", "step2_mcq", "step2_freeform", "step3_faithfulness")
+
+def connect(db: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(db, timeout=60, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def run_name(config: dict) -> str:
+    path = main.result_path("", config["task"], config["shots"], config["n_test"], config["model"], config["seed"])
+    return os.path.basename(path)[:-len(".json")]
+
+def step_data(config: dict, step: str) -> list[tuple[str, bool]]:
+    task, seed = config["task"], config["seed"]
+    if step == "step1":
+        return tasks.sample_test(task, m=config["n_test"], seed=seed+1)
+    return main.counterfactual_inputs(task, config["shots"], seed, n_counterfactual=config.get("n_counterfactual", 0))
+
+def step_size(config: dict, step: str) -> int:
+    return config["n_test"] if step == "step1" else len(step_data(config, step))
+
+def init(db: str, configs: list[dict], shard_size: int) -> int:
+    """Enumerate the units of every run config; runs that are already in the queue are left as they are."""
+    conn = connect(db)
+    conn.executescript(SCHEMA)
+    n = 0
+    with conn:
+        for config in configs:
+            run = run_name(config)
+            if conn.execute("INSERT OR IGNORE INTO runs (run, config) VALUES (?, ?)", (run, json.dumps(config))).rowcount == 0:
+                continue
+            for step in STEPS:
+                size = step_size(config, step) if step in SHARDED_STEPS else 1
+                chunk = shard_size if step in SHARDED_STEPS and shard_size > 0 else size
+                for start in range(0, size, chunk):
+                    conn.execute("INSERT INTO units (run, step, start, stop) VALUES (?, ?, ?, ?)", (run, step, start, min(size, start + chunk)))
+                    n += 1
+    conn.close()
+    return n
+
+def lease(db: str, worker: str, lease_seconds: float, max_attempts: int) -> dict | None:
+    """Atomically take the oldest pending (or expired) unit; None once nothing is left to lease."""
+    conn = connect(db)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        now = time.time()
+        conn.execute("UPDATE units SET status = 'failed', error = 'lease expired' WHERE status = 'leased' AND lease_until < ? AND attempts >= ?", (now, max_attempts))
+        row = conn.execute(
+            "SELECT units.*, runs.config FROM units JOIN runs USING (run) "
+            "WHERE (status = 'pending' OR (status = 'leased' AND lease_until < ?)) AND attempts < ? "
+            "ORDER BY id LIMIT 1",
+            (now, max_attempts),
+        ).fetchone()
+        if row is None:
+            conn.execute("COMMIT")
+            return None
+        conn.execute(
+            "UPDATE units SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1 WHERE id = ?",
+            (worker, now + lease_seconds, row["id"]),
+        )
+        conn.execute("COMMIT")
+        return {**dict(row), "config": json.loads(row["config"])}
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+def heartbeat(db: str, worker: str, unit_ids: list[int], lease_seconds: float):
+    if not unit_ids:
+        return
+    conn = connect(db)
+    with conn:
+        conn.execute(
+            f"UPDATE units SET lease_until = ? WHERE worker = ? AND status = 'leased' AND id IN ({','.join('?' * len(unit_ids))})",
+            (time.time() + lease_seconds, worker, *unit_ids),
+        )
+    conn.close()
+
+def finish(db: str, worker: str, unit_id: int, result: dict | None = None, error: str | None = None, max_attempts: int = 3):
+    """Store a unit's result, or hand it back (failed for good after `max_attempts`); a worker whose lease was taken over is ignored."""
+    conn = connect(db)
+    with conn:
+        if error is None:
+            conn.execute("UPDATE units SET status = 'done', result = ?, error = NULL WHERE id = ? AND worker = ?", (json.dumps(result), unit_id, worker))
+        else:
+            conn.execute(
+                "UPDATE units SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, error = ?, lease_until = NULL WHERE id = ? AND worker = ? AND status = 'leased'",
+                (max_attempts, error, unit_id, worker),
+            )
+    conn.close()
+
+def outstanding(db: str) -> int:
+    """Units that are still pending or leased (possibly by a worker that died)."""
+    conn = connect(db)
+    n = conn.execute("SELECT COUNT(*) FROM units WHERE status IN ('pending', 'leased')").fetchone()[0]
+    conn.close()
+    return n
+
+def release(db: str, worker: str, unit_ids: list[int]):
+    """Hand units back without counting the attempt, e.g. when a worker is stopped."""
+    if not unit_ids:
+        return
+    conn = connect(db)
+    with conn:
+        conn.execute(
+            f"UPDATE units SET status = 'pending', worker = NULL, lease_until = NULL, attempts = attempts - 1 WHERE worker = ? AND status = 'leased' AND id IN ({','.join('?' * len(unit_ids))})",
+            (worker, *unit_ids),
+        )
+    conn.close()
+
+async def run_unit(unit: dict, journal_dir: str) -> dict:
+    config = unit["config"]
+    task, shots, model, seed = config["task"], config["shots"], config["model"], config["seed"]
+    step, start, stop = unit["step"], unit["start"], unit["stop"]
+
+    if step in SHARDED_STEPS:
+        async def shard():
+            few_shot_prompt = tasks.fewshot(task, k=shots, seed=seed, encoding=config.get("encoding", "multiturn"))
+            data = step_data(config, step)
+            with record_usage() as usage:
+                out = await main._classify_wave(few_shot_prompt, [x[0] for x in data[start:stop]], model, pack_size=config.get("pack_size", 0), logprobs=config.get("logprobs", False), encoding=config.get("encoding", "multiturn"))
+            return {"out": out, "usage": usage}
+        coro = shard()
+    elif step == "step2_mcq":
+        coro = main.step2_mcq_async(task, shots, model, seed=seed, n_orderings=config.get("mcq_orderings", 24), escalate=config.get("mcq_escalate", False), encoding=config.get("encoding", "multiturn"))
+    else:
+        coro = main.step2_freeform_async(task, shots, model, seed=seed, scoring=config.get("freeform_scoring", "verifier"), n_score=config.get("n_score", 2000), encoding=config.get("encoding", "multiturn"))
+
+    # one journal per unit, so a re-leased unit replays what its previous worker already received
+    journal = Journal(os.path.join(journal_dir, f"{unit['run']}.{step}.{start}.jsonl"))
+    try:
+        with utils.request_labels(task=task, seed=seed):
+            return await main._journaled(journal, step, coro)
+    finally:
+        journal.close()
+
+async def work_async(db: str, journal_dir: str, worker: str, concurrency: int = 4, lease_seconds: float = 300, max_attempts: int = 3) -> int:
+    """Lease and run units, `concurrency` at a time on this process's loop, until the queue is drained."""
+    active = {}
+    done = 0
+
+    async def beat():
+        while True:
+            await asyncio.sleep(lease_seconds / 3)
+            await asyncio.to_thread(heartbeat, db, worker, list(active), lease_seconds)
+
+    async def one(unit):
+        nonlocal done
+        try:
+            result = await run_unit(unit, journal_dir)
+        except Exception as e:
+            print(f"[{worker}] {unit['run']} {unit['step']}[{unit['start']}:{unit['stop']}] failed: {e!r}")
+            await asyncio.to_thread(finish, db, worker, unit["id"], error=repr(e), max_attempts=max_attempts)
+        else:
+            await asyncio.to_thread(finish, db, worker, unit["id"], result=result)
+            done += 1
+        finally:
+            del active[unit["id"]]
+
+    heart = asyncio.create_task(beat())
+    running = set()
+    try:
+        while True:
+            while len(running) < concurrency:
+                unit = await asyncio.to_thread(lease, db, worker, lease_seconds, max_attempts)
+                if unit is None:
+                    break
+                active[unit["id"]] = unit
+                running.add(asyncio.create_task(one(unit)))
+            poll = min(lease_seconds / 3, 10)
+            if not running:
+                if not await asyncio.to_thread(outstanding, db):
+                    return done
+                # units leased by other workers come back if those workers die
+                await asyncio.sleep(poll)
+                continue
+            finished, running = await asyncio.wait(running, timeout=poll, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        heart.cancel()
+        for t in running:
+            t.cancel()
+        # hand unfinished units back right away instead of waiting for their leases to expire
+        release(db, worker, list(active))
+
+def status(db: str) -> dict:
+    conn = connect(db)
+    counts = {row["status"]: row["n"] for row in conn.execute("SELECT status, COUNT(*) AS n FROM units GROUP BY status")}
+    expired = conn.execute("SELECT COUNT(*) FROM units WHERE status = 'leased' AND lease_until < ?", (time.time(),)).fetchone()[0]
+    workers = [row[0] for row in conn.execute("SELECT DISTINCT worker FROM units WHERE status = 'leased' AND lease_until >= ?", (time.time(),))]
+    conn.close()
+    return {**counts, "expired_leases": expired, "active_workers": workers}
+
+def merge_run(config: dict, units: list[sqlite3.Row]) -> dict:
+    """Assemble main.run_experiment_async's result dict from the finished units of one run."""
+    results = {"config": config}
+    for step in STEPS:
+        step_units = sorted((u for u in units if u["step"] == step), key=lambda u: u["start"])
+        outputs = [json.loads(u["result"]) for u in step_units]
+        if step not in SHARDED_STEPS:
+            results[step] = outputs[0]
+            continue
+        data = step_data(config, step)
+        out = [tuple(o) for output in outputs for o in output["out"]]
+        usage = [record for output in outputs for record in output["usage"]]
+        results[step] = main.classification_results([x[0] for x in data], [x[1] for x in data], out, usage, logprobs=config.get("logprobs", False))
+        # summed over shards, i.e. worker time rather than elapsed time
+        results[step]["wall_seconds"] = sum(output["wall_seconds"] for output in outputs)
+    return {k: results[k] for k in ("config", *STEPS)}
+
+def merge(db: str, out: str, overwrite: bool = False) -> list[str]:
+    """Write the result file of every run whose units are all done; returns the paths written."""
+    conn = connect(db)
+    os.makedirs(out, exist_ok=True)
+    paths = []
+    for run in conn.execute("SELECT * FROM runs ORDER BY run").fetchall():
+        config = json.loads(run["config"])
+        path = main.result_path(out, config["task"], config["shots"], config["n_test"], config["model"], config["seed"])
+        if os.path.exists(path) and not overwrite:
+            continue
+        units = conn.execute("SELECT * FROM units WHERE run = ?", (run["run"],)).fetchall()
+        if any(u["status"] != "done" for u in units):
+            continue
+        with open(path + ".tmp", "w") as f:
+            json.dump(merge_run(config, units), f, indent=2)
+        os.replace(path + ".tmp", path)
+        paths.append(path)
+    conn.close()
+    return paths
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Shard a sweep over any number of workers sharing a SQLite queue file.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    # init takes main.py's options; --shots becomes a list to span a shot-count grid
+    p = sub.add_parser("init", parents=[main.get_parser()], add_help=False, conflict_handler="resolve")
+    p.add_argument("--shots", type=int, nargs="+", default=[64])
+    p.add_argument("--shard_size", type=int, default=100, help="inputs per step1 / step3_faithfulness unit (0 = one unit per step)")
+    p = sub.add_parser("work")
+    p.add_argument("--worker", type=str, default=f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}")
+    p.add_argument("--concurrency", type=int, default=4, help="units run at the same time by this worker")
+    p.add_argument("--lease_seconds", type=float, default=300, help="a unit is handed out again if its lease is not renewed for this long")
+    p.add_argument("--max_attempts", type=int, default=3)
+    p.add_argument("--journal_dir", type=str, default="workspace/journal")
+    p.add_argument("--backend", type=str, default=utils.BACKEND, choices=utils.BACKENDS.keys())
+    p.add_argument("--response_cache", type=str, default=utils.RESPONSE_CACHE)
+    p.add_argument("--hedge_percentile", type=float, default=utils.HEDGE_PERCENTILE)
+    p.add_argument("--hedge_budget", type=float, default=utils.HEDGE_BUDGET)
+    sub.add_parser("status")
+    p = sub.add_parser("merge")
+    p.add_argument("--out", type=str, default="workspace/results")
+    p.add_argument("--overwrite", action="store_true")
+    for p in sub.choices.values():
+        p.add_argument("--db", type=str, default="workspace/queue.sqlite")
+    return parser
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    if args.command == "init":
+        if args.early_stopping or args.compare_packing or args.compare_encoding or args.shot_sweep:
+            raise SystemExit("--early_stopping, --compare_packing, --compare_encoding and --shot_sweep are not supported in work-queue mode")
+        os.makedirs(os.path.dirname(args.db) or ".", exist_ok=True)
+        options = {k: v for k, v in vars(args).items() if k not in ("command", "db", "shard_size", "task", "seed", "model", "shots", "shot_sweep")}
+        configs = [
+            {**options, "task": task, "seed": seed, "model": model, "shots": shots}
+            for task, seed, model, shots in itertools.product(args.task, args.seed, args.model, args.shots)
+        ]
+        print(f"queued {init(args.db, configs, args.shard_size)} units for {len(configs)} runs")
+    elif args.command == "work":
+        utils.BACKEND = args.backend
+        utils.RESPONSE_CACHE = args.response_cache
+        utils.HEDGE_PERCENTILE, utils.HEDGE_BUDGET = args.hedge_percentile, args.hedge_budget
+        print(f"[{args.worker}] finished {asyncio.run(work_async(args.db, args.journal_dir, args.worker, args.concurrency, args.lease_seconds, args.max_attempts))} units")
+    elif args.command == "status":
+        print(json.dumps(status(args.db), indent=2))
+    else:
+        print(f"merged {len(merge(args.db, args.out, overwrite=args.overwrite))} runs into {args.out}")